@@ -4,7 +4,7 @@ Common utilities for API routes
 import logging
 import os
 from sqlalchemy.orm import Session
-from fastapi import Depends
+from fastapi import Depends, HTTPException
 
 from app.database import SessionLocal
 from app.config import settings
@@ -34,3 +34,19 @@ def resolve_file_path(file_path: str, subfolder: str = None) -> str:
         else:
             file_path = os.path.join(settings.workdir, file_path)
     return file_path
+
+def require_admission(priority=None):
+    """
+    Raises 429 Too Many Requests with a Retry-After header while the pipeline is over
+    the in-flight budget of the priority lane (see app.utils.admission), by default the
+    interactive one.
+    """
+    from app.utils.admission import check_admission
+    from app.utils.priority_lanes import PRIORITY_INTERACTIVE
+    refusal = check_admission(PRIORITY_INTERACTIVE if priority is None else priority)
+    if refusal:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Processing pipeline is busy ({refusal['reason']}), please retry later.",
+            headers={"Retry-After": str(refusal["retry_after"])},
+        )
@@ -46,3 +46,39 @@ async def diagnostic_settings(request: Request, current_user: dict = Depends(get
         "settings": safe_settings,
         "message": "Full settings have been dumped to application logs"
     }
+
+@router.get("/diagnostic/cache")
+@require_login
+async def diagnostic_cache(request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    API endpoint showing hit/miss counters of the OCR/GPT result cache
+    """
+    from app.utils.result_cache import get_cache_stats
+    return {
+        "status": "success",
+        "enabled": settings.result_cache_enabled,
+        "max_bytes": settings.result_cache_max_bytes,
+        "stats": get_cache_stats(),
+    }
+
+@router.get("/diagnostic/result-backend")
+@require_login
+async def diagnostic_result_backend(request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    API endpoint reporting the Redis memory used by stored task results, per task name
+    """
+    from app.utils.result_backend import result_backend_report
+    return {"status": "success", **result_backend_report()}
+
+@router.get("/diagnostic/queues")
+@require_login
+async def diagnostic_queues(request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    API endpoint showing the queue depth per priority lane and recent queue wait times
+    """
+    from app.celery_app import QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD, QUEUE_DEFAULT
+    from app.utils.priority_lanes import lane_report
+    return {
+        "status": "success",
+        **lane_report([QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD, QUEUE_DEFAULT]),
+    }
@@ -7,19 +7,71 @@ import logging
 import os
 import uuid
 import mimetypes
+import hashlib
 
 from app.auth import require_login
-from app.models import FileRecord
+from app.models import FileRecord, PipelineState, DocumentFacts
 from app.config import settings
-from app.api.common import get_db
+from app.api.common import get_db, require_admission
+from app.utils.deduplication import claim_ingestion
+from app.utils.priority_lanes import PRIORITY_INTERACTIVE
+from app.utils.pipeline_state import get_state
+from app.utils.preflight import get_facts
+from app.utils.tracing import document_trace
 from app.tasks.process_document import process_document
 from app.tasks.convert_to_pdf import convert_to_pdf
+from app.tasks.resume_pipeline import resume_pipeline
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Uploads are written to disk in chunks of this size while being hashed
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # 500MB
+
+
+async def _stream_upload_to_disk(upload: UploadFile, target_path: str, max_size: int):
+    """
+    Streams an uploaded file to `target_path` in fixed-size chunks.
+
+    The SHA-256 hash is updated while writing, so the file never has to be read
+    again, and the upload is aborted as soon as it grows past `max_size`.
+
+    Returns:
+        tuple: (sha256 hex digest, size in bytes)
+    """
+    sha256 = hashlib.sha256()
+    file_size = 0
+    try:
+        with open(target_path, "wb") as f:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > max_size:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"File too large: more than {max_size} bytes"
+                    )
+                sha256.update(chunk)
+                f.write(chunk)
+    except HTTPException:
+        # Remove the partial file if the upload was rejected
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    except Exception as e:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to save file: {e}"
+        )
+    return sha256.hexdigest(), file_size
+
 @router.get("/files")
 @require_login
 def list_files_api(request: Request, db: Session = Depends(get_db)):
@@ -83,7 +135,9 @@ def delete_file_record(request: Request, file_id: int, db: Session = Depends(get
         # Log the deletion
         logger.info(f"Deleting file record: ID={file_id}, Filename={file_record.original_filename}")
         
-        # Delete the record
+        # Delete the record (and its pipeline checkpoint and facts)
+        db.query(PipelineState).filter(PipelineState.file_id == file_id).delete()
+        db.query(DocumentFacts).filter(DocumentFacts.file_id == file_id).delete()
         db.delete(file_record)
         db.commit()
         
@@ -102,6 +156,50 @@ def delete_file_record(request: Request, file_id: int, db: Session = Depends(get
             detail=f"Error deleting file record: {str(e)}"
         )
 
+@router.get("/files/{file_id}/pipeline")
+@require_login
+def get_pipeline_state(request: Request, file_id: int):
+    """
+    Returns the last completed pipeline step of a file, its status ("running", "failed",
+    "completed"), the last error and the outcome of each upload.
+    """
+    state = get_state(file_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"No pipeline state for file {file_id}")
+    return state
+
+@router.get("/files/{file_id}/facts")
+@require_login
+def get_document_facts(request: Request, file_id: int, db: Session = Depends(get_db)):
+    """
+    Returns the facts recorded about a file's content at ingestion: page count, pages with
+    a text layer, encryption and PDF version, plus its size and MIME type.
+    """
+    record = db.query(FileRecord.filehash).filter(FileRecord.id == file_id).first()
+    facts = get_facts(filehash=record.filehash) if record else None
+    if facts is None:
+        raise HTTPException(status_code=404, detail=f"No document facts for file {file_id}")
+    del facts["filehash"]
+    return facts
+
+@router.post("/files/{file_id}/resume")
+@require_login
+def resume_file_pipeline(request: Request, file_id: int, db: Session = Depends(get_db)):
+    """
+    Resumes the pipeline of a file from its last completed step, e.g. after a failure.
+    For completed files, failed uploads are re-queued.
+    """
+    if not db.query(FileRecord.id).filter(FileRecord.id == file_id).first():
+        raise HTTPException(status_code=404, detail=f"File record with ID {file_id} not found")
+    state = get_state(file_id)
+    task = resume_pipeline.apply_async(args=[file_id], priority=PRIORITY_INTERACTIVE)
+    return {
+        "task_id": task.id,
+        "status": "queued",
+        "previous_state": state["state"] if state else None,
+        "previous_status": state["status"] if state else None,
+    }
+
 @router.post("/ui-upload")
 @require_login
 async def ui_upload(request: Request, file: UploadFile = File(...)):
@@ -123,29 +221,34 @@ async def ui_upload(request: Request, file: UploadFile = File(...)):
     # Store both the safe original name and the unique name
     target_path = os.path.join(workdir, target_filename)
     
-    try:
-        with open(target_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-    except Exception as e:
+    # Don't accept more work than the pipeline can absorb
+    require_admission()
+
+    # Reject obviously oversized uploads (body plus some multipart overhead) before copying them
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + 1024 * 1024:
         raise HTTPException(
-            status_code=500,
-            detail=f"Failed to save file: {e}"
+            status_code=413,
+            detail=f"File too large: {content_length} bytes (max {MAX_UPLOAD_SIZE} bytes)"
         )
 
+    filehash, file_size = await _stream_upload_to_disk(file, target_path, MAX_UPLOAD_SIZE)
+
     # Log the mapping between original and safe filename
-    logger.info(f"Saved uploaded file '{safe_filename}' as '{target_filename}'")
-    
-    # Check file size
-    file_size = os.path.getsize(target_path)
-    max_size = 500 * 1024 * 1024  # 500MB
-    if file_size > max_size:
-        # Remove the file if it's too large
+    logger.info(f"Saved uploaded file '{safe_filename}' as '{target_filename}' ({file_size} bytes)")
+
+    # Reject duplicates right away instead of queueing work that process_document would discard
+    duplicate = claim_ingestion(filehash)
+    if duplicate:
         os.remove(target_path)
-        raise HTTPException(
-            status_code=413,
-            detail=f"File too large: {file_size} bytes (max {max_size} bytes)"
-        )
+        logger.info(f"Upload '{safe_filename}' is a duplicate (hash={filehash[:10]}...): {duplicate['status']}")
+        return {
+            "task_id": None,
+            "status": duplicate["status"],
+            "file_id": duplicate["file_id"],
+            "original_filename": safe_filename,
+            "stored_filename": None
+        }
     
     # Same set of allowed file types as in the IMAP task
     ALLOWED_MIME_TYPES = {
@@ -176,26 +279,34 @@ async def ui_upload(request: Request, file: UploadFile = File(...)):
     # Check if it's a PDF by extension or MIME type
     is_pdf = file_ext == ".pdf" or mime_type == "application/pdf"
     
-    if is_pdf:
-        # If it's a PDF, process directly
-        task = process_document.delay(target_path)
-        logger.info(f"Enqueued PDF for processing: {target_path}")
-    elif mime_type in IMAGE_MIME_TYPES or any(file_ext.endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.svg']):
-        # If it's an image, convert to PDF first
-        task = convert_to_pdf.delay(target_path)
-        logger.info(f"Enqueued image for PDF conversion: {target_path}")
-    elif mime_type in ALLOWED_MIME_TYPES or any(file_ext.endswith(ext) for ext in ['.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt', '.ods', '.odp', '.rtf', '.txt', '.csv']):
-        # If it's an office document, convert to PDF first
-        task = convert_to_pdf.delay(target_path)
-        logger.info(f"Enqueued office document for PDF conversion: {target_path}")
-    else:
-        # For any other file type, attempt conversion but log a warning
-        logger.warning(f"Unsupported MIME type {mime_type} for {target_path}, attempting conversion")
-        task = convert_to_pdf.delay(target_path)
+    # The document's trace starts here; every task of its pipeline joins it
+    with document_trace("upload", filename=safe_filename, filehash=filehash) as trace_id:
+        if is_pdf:
+            # If it's a PDF, process directly
+            # Hand over the hash computed while streaming so the worker does not re-read the file
+            task = process_document.apply_async((target_path,), {"filehash": filehash, "file_size": file_size},
+                                                priority=PRIORITY_INTERACTIVE)
+            logger.info(f"Enqueued PDF for processing: {target_path}")
+        elif mime_type in IMAGE_MIME_TYPES or any(file_ext.endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.svg']):
+            # If it's an image, convert to PDF first
+            task = convert_to_pdf.apply_async((target_path,), {"source_hash": filehash},
+                                              priority=PRIORITY_INTERACTIVE)
+            logger.info(f"Enqueued image for PDF conversion: {target_path}")
+        elif mime_type in ALLOWED_MIME_TYPES or any(file_ext.endswith(ext) for ext in ['.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt', '.ods', '.odp', '.rtf', '.txt', '.csv']):
+            # If it's an office document, convert to PDF first
+            task = convert_to_pdf.apply_async((target_path,), {"source_hash": filehash},
+                                              priority=PRIORITY_INTERACTIVE)
+            logger.info(f"Enqueued office document for PDF conversion: {target_path}")
+        else:
+            # For any other file type, attempt conversion but log a warning
+            logger.warning(f"Unsupported MIME type {mime_type} for {target_path}, attempting conversion")
+            task = convert_to_pdf.apply_async((target_path,), {"source_hash": filehash},
+                                              priority=PRIORITY_INTERACTIVE)
     
     return {
         "task_id": task.id, 
         "status": "queued", 
         "original_filename": safe_filename,
-        "stored_filename": target_filename
+        "stored_filename": target_filename,
+        "trace_id": trace_id,
     }
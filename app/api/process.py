@@ -7,7 +7,9 @@ import os
 
 from app.auth import require_login
 from app.config import settings
-from app.api.common import resolve_file_path
+from app.api.common import resolve_file_path, require_admission
+from app.utils.priority_lanes import PRIORITY_INTERACTIVE, PRIORITY_BULK
+from app.utils.tracing import document_trace
 from app.tasks.process_document import process_document
 from app.tasks.upload_to_dropbox import upload_to_dropbox
 from app.tasks.upload_to_paperless import upload_to_paperless
@@ -15,6 +17,7 @@ from app.tasks.upload_to_nextcloud import upload_to_nextcloud
 from app.tasks.upload_to_google_drive import upload_to_google_drive
 from app.tasks.upload_to_onedrive import upload_to_onedrive
 from app.tasks.send_to_all import send_to_all_destinations
+from app.tasks.ingest_backlog import ingest_backlog, enqueue_while_admitted
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -32,8 +35,10 @@ def process(file_path: str):
             status_code=400, detail=f"File {file_path} not found."
         )
 
-    task = process_document.delay(file_path)
-    return {"task_id": task.id, "status": "queued"}
+    require_admission()
+    with document_trace("process", file=file_path) as trace_id:
+        task = process_document.apply_async((file_path,), priority=PRIORITY_INTERACTIVE)
+    return {"task_id": task.id, "status": "queued", "trace_id": trace_id}
 
 @router.post("/send_to_dropbox/")
 @require_login
@@ -127,14 +132,20 @@ def process_all_pdfs_in_workdir():
     if not pdf_files:
         return {"message": "No PDF files found in that directory."}
 
-    task_ids = []
-    for pdf in pdf_files:
-        file_path = os.path.join(target_dir, pdf)
-        task = process_document.delay(file_path)
-        task_ids.append(task.id)
+    # Backfills go to the bulk lane so interactive uploads are not stuck behind them, and
+    # only as many files as admission control allows; the rest is fed in by ingest_backlog
+    file_paths = [os.path.join(target_dir, pdf) for pdf in pdf_files]
+    task_ids, remaining, refusal = enqueue_while_admitted(file_paths, priority=PRIORITY_BULK)
+    backlog_task_id = None
+    if remaining:
+        backlog_task_id = ingest_backlog.apply_async(
+            (remaining,), countdown=refusal["retry_after"], priority=PRIORITY_BULK
+        ).id
 
     return {
-        "message": f"Enqueued {len(pdf_files)} PDFs to upload_to_s3",
+        "message": f"Enqueued {len(task_ids)} PDFs for processing, {len(remaining)} deferred",
         "pdf_files": pdf_files,
-        "task_ids": task_ids
+        "task_ids": task_ids,
+        "deferred": len(remaining),
+        "backlog_task_id": backlog_task_id,
     }
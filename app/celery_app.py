@@ -2,6 +2,10 @@
 
 from celery import Celery
 from app.config import settings
+from app.utils.result_backend import configure_result_policies
+from app.utils.priority_lanes import configure_priorities
+from app.utils import metrics  # noqa: F401  Connects the task timing signals (see app/utils/metrics.py)
+from app.utils import tracing  # noqa: F401  Carries trace contexts through task headers (see app/utils/tracing.py)
 
 celery = Celery(
     "document_processor",
@@ -13,8 +17,45 @@ celery = Celery(
 # Optionally add this line to retain connection retry behavior at startup:
 celery.conf.broker_connection_retry_on_startup = True
 
-# Set the default queue and routing so that tasks are enqueued on "document_processor"
-celery.conf.task_default_queue = 'document_processor'
+# Queues per resource class, so each can be served by a worker pool that suits it:
+#   pdf     - CPU-bound PyMuPDF/PyPDF2 work -> prefork pool sized to the cores
+#   ocr     - waiting on Azure Document Intelligence -> gevent pool, high concurrency
+#   llm     - waiting on the OpenAI API -> gevent pool
+#   upload  - network transfers to the storage destinations -> gevent pool
+#   default - everything else (beat tasks, conversion, bookkeeping)
+QUEUE_PDF = "pdf"
+QUEUE_OCR = "ocr"
+QUEUE_LLM = "llm"
+QUEUE_UPLOAD = "upload"
+QUEUE_DEFAULT = "default"
+
+celery.conf.task_default_queue = QUEUE_DEFAULT
 celery.conf.task_routes = {
-    "app.tasks.*": {"queue": "document_processor"},
+    # CPU
+    "app.tasks.process_document.process_document": {"queue": QUEUE_PDF},
+    "app.tasks.rotate_pdf_pages.rotate_pdf_pages": {"queue": QUEUE_PDF},
+    "app.tasks.embed_metadata_into_pdf.embed_metadata_into_pdf": {"queue": QUEUE_PDF},
+    "app.tasks.optimize_pdf.optimize_pdf": {"queue": QUEUE_PDF},
+    "app.tasks.ocr_shards.split_ocr_shards": {"queue": QUEUE_PDF},
+    "app.tasks.ocr_shards.merge_ocr_shards": {"queue": QUEUE_PDF},
+    "app.tasks.process_with_azure_document_intelligence.splice_ocr_result": {"queue": QUEUE_PDF},
+    "app.tasks.collect_azure_ocr_results.finish_azure_ocr": {"queue": QUEUE_PDF},
+    # OCR wait
+    "app.tasks.process_with_azure_document_intelligence.*": {"queue": QUEUE_OCR},
+    "app.tasks.ocr_shards.ocr_pdf_shard": {"queue": QUEUE_OCR},
+    "app.tasks.collect_azure_ocr_results.collect_azure_ocr_results": {"queue": QUEUE_OCR},
+    # LLM
+    "app.tasks.refine_text_with_gpt.*": {"queue": QUEUE_LLM},
+    "app.tasks.extract_metadata_with_gpt.*": {"queue": QUEUE_LLM},
+    # Uploads
+    "app.tasks.send_to_all.*": {"queue": QUEUE_UPLOAD},
+    "app.tasks.upload_*": {"queue": QUEUE_UPLOAD},
+    # Everything else
+    "app.tasks.*": {"queue": QUEUE_DEFAULT},
 }
+
+# Don't store results nobody reads, and let the rest expire (see app/utils/result_backend.py)
+configure_result_policies(celery)
+
+# Priority lanes: interactive uploads ahead of IMAP ahead of bulk jobs (see app/utils/priority_lanes.py)
+configure_priorities(celery)
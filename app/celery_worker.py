@@ -11,10 +11,13 @@ from app import tasks  # <— This imports app/tasks.py so Celery can register t
 # **Ensure all tasks are imported before Celery starts**
 from app.tasks.process_document import process_document
 from app.tasks.process_with_azure_document_intelligence import process_with_azure_document_intelligence
+from app.tasks.ocr_shards import split_ocr_shards, ocr_pdf_shard, merge_ocr_shards
+from app.tasks.collect_azure_ocr_results import collect_azure_ocr_results, finish_azure_ocr
 from app.tasks.rotate_pdf_pages import rotate_pdf_pages
 from app.tasks.refine_text_with_gpt import refine_text_with_gpt
 from app.tasks.extract_metadata_with_gpt import extract_metadata_with_gpt
 from app.tasks.embed_metadata_into_pdf import embed_metadata_into_pdf
+from app.tasks.optimize_pdf import optimize_pdf
 from app.tasks.convert_to_pdf import convert_to_pdf
 
 # Import new send tasks
@@ -32,10 +35,9 @@ from app.tasks.upload_to_email import upload_to_email
 from app.tasks.imap_tasks import pull_all_inboxes
 from app.tasks.send_to_all import send_to_all_destinations
 from app.tasks.uptime_kuma_tasks import ping_uptime_kuma
-
-celery.conf.task_routes = {
-    "app.tasks.*": {"queue": "default"},
-}
+from app.tasks.purge_blobs import purge_blobs
+from app.tasks.ingest_backlog import ingest_backlog
+from app.tasks.resume_pipeline import resume_pipeline
 
 @celery.task
 def test_task():
@@ -56,6 +58,18 @@ celery.conf.beat_schedule = {
         "schedule": crontab(minute=f"*/{settings.uptime_kuma_ping_interval}"),
         "options": {"expires": 55},  # Ensure tasks don't pile up
     } if settings.uptime_kuma_url else None,
+    # Collect results of OCR jobs submitted to Azure without waiting
+    "collect-azure-ocr-results": {
+        "task": "app.tasks.collect_azure_ocr_results.collect_azure_ocr_results",
+        "schedule": float(settings.azure_ocr_collect_interval_seconds),
+        "options": {"expires": settings.azure_ocr_collect_interval_seconds},  # Ensure sweeps don't pile up
+    } if settings.azure_ocr_async else None,
+    # Remove text blobs left behind by finished or abandoned pipelines
+    "purge-text-blobs-hourly": {
+        "task": "app.tasks.purge_blobs.purge_blobs",
+        "schedule": crontab(minute=0),
+        "options": {"expires": 3300},  # Ensure tasks don't pile up
+    },
 }
 
 # Remove None entries from beat_schedule
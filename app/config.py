@@ -121,6 +121,71 @@ class Settings(BaseSettings):
     # Feature flags
     allow_file_delete: bool = True  # Default to allowing file deletion from database
 
+    # Ingestion / deduplication
+    inflight_hash_ttl_seconds: int = 6 * 60 * 60  # How long a queued file hash blocks identical uploads
+    pipeline_lease_ttl_seconds: int = 60 * 60  # Upper bound for one document's pipeline run
+
+    # Local text extraction
+    pdf_text_parallel_page_threshold: int = 200  # Extract PDFs with more pages in a process pool (0 = never)
+    pdf_text_max_workers: int = 0  # Process pool size for text extraction (0 = number of CPUs)
+
+    # OCR sharding: PDFs above the threshold are OCR'd as parallel page-range chunks
+    azure_ocr_shard_threshold_pages: int = 300  # 0 disables sharding
+    azure_ocr_shard_size_pages: int = 100
+
+    # Non-blocking OCR: submit to Azure and collect results in a periodic sweep
+    azure_ocr_async: bool = False
+    azure_ocr_collect_interval_seconds: int = 5
+    azure_ocr_timeout_seconds: int = 60 * 60  # Give up on operations that are still running after this
+
+    # Content-addressed cache of OCR and GPT results (<workdir>/cache)
+    result_cache_enabled: bool = True
+    result_cache_max_bytes: int = 2 * 1024 * 1024 * 1024  # Least recently used entries are evicted beyond this
+
+    # Claim-check for large texts passed between tasks (<workdir>/blobs)
+    blob_inline_threshold_bytes: int = 64 * 1024  # Smaller texts are passed inline in the task message
+    blob_ttl_seconds: int = 7 * 24 * 60 * 60  # Blobs older than this are purged hourly
+
+    # Celery result backend
+    celery_result_expires_seconds: int = 24 * 60 * 60  # TTL of stored task results
+    celery_shard_result_expires_seconds: int = 60 * 60  # OCR shard results are only needed until merged
+    celery_ignore_intermediate_results: bool = True  # Don't store results of pipeline hops nobody reads
+    celery_result_compression: Optional[str] = "zlib"  # Compression of stored results (empty to disable)
+
+    # Fused pipeline: small documents run all steps in one worker instead of hopping through the queue
+    fused_pipeline_max_pages: int = 3  # 0 disables fused mode
+    fused_pipeline_max_bytes: int = 5 * 1024 * 1024
+
+    # Page rotation after OCR: applied in the metadata save, so the PDF is written once (False: rotate right away)
+    pdf_rotation_with_metadata: bool = True
+
+    # Optimization of processed PDFs before the uploads (see app/utils/pdf_optimizer.py)
+    pdf_optimize_enabled: bool = False
+    pdf_optimize_image_dpi: int = 150  # Images above 1.5x this resolution are downsampled (0 = keep resolution)
+    pdf_optimize_image_quality: int = 75  # JPEG quality of recompressed images (0 = leave images as they are)
+    pdf_optimize_linearize: bool = True  # Linearize for fast web view (needs pikepdf)
+
+    # Admission control: ingestion is deferred (API: 429) while a stage is over its in-flight budget
+    admission_control_enabled: bool = True
+    admission_max_queue_depth: int = 200  # Per stage queue (pdf, ocr, llm, upload), counting own and higher lanes
+    admission_max_outstanding_ocr: int = 100  # Running Azure operations, incl. async ones
+    admission_max_outstanding_llm: int = 50  # Running OpenAI calls
+    admission_retry_after_seconds: int = 30
+    admission_call_stale_seconds: int = 60 * 60  # Calls older than this are assumed dead
+    admission_bulk_share: float = 0.75  # Share of each budget bulk jobs may use; the rest is kept for uploads and IMAP
+
+    # Prometheus metrics (see app/utils/metrics.py); the API serves them on /metrics
+    metrics_enabled: bool = True
+    metrics_worker_port: int = 9808  # Port on which each Celery worker serves its metrics
+
+    # ProcessingLog rows are buffered per process and bulk-inserted (see app/utils/logging.py)
+    processing_log_batch_size: int = 50  # 1 writes every row right away
+    processing_log_flush_seconds: float = 2.0
+
+    # Tracing of document pipelines (see app/utils/tracing.py); disabled unless an exporter is set
+    tracing_otlp_endpoint: Optional[str] = None  # e.g. http://jaeger:4318/v1/traces
+    tracing_file: Optional[str] = None  # Offline alternative: append spans as JSON lines to this file
+
     # Get version from file or environment
     @property
     def version(self) -> str:
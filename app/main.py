@@ -2,7 +2,7 @@
 import os
 import logging
 
-from fastapi import FastAPI, HTTPException, Request, status
+from fastapi import FastAPI, HTTPException, Request, Response, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
@@ -14,6 +14,7 @@ from pathlib import Path
 from app.database import init_db
 from app.config import settings
 from app.utils.config_validator import check_all_configs
+from app.utils.tracing import init_tracing
 
 # Import the routers - now using views directly instead of frontend
 from app.views import router as frontend_router
@@ -49,6 +50,7 @@ app.mount("/static", StaticFiles(directory=frontend_static_dir), name="static")
 @app.on_event("startup")
 def on_startup():
     init_db()  # Create tables if they don't exist
+    init_tracing("docuelevate-api")
 
 @app.on_event("startup")
 async def startup_event():
@@ -90,6 +92,15 @@ async def custom_500_handler(request: Request, exc: Exception):
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR
     )
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus metrics (see app/utils/metrics.py)."""
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404)
+    from app.utils.metrics import render_metrics
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/test-500")
 def test_500():
     raise RuntimeError("Testing forced 500 error!")
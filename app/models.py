@@ -1,7 +1,7 @@
 # app/models.py
 #!/usr/bin/env python3
 
-from sqlalchemy import Column, String, Integer, DateTime, func, ForeignKey
+from sqlalchemy import Column, String, Integer, Boolean, DateTime, Text, func, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from app.database import Base
 
@@ -38,6 +38,21 @@ class FileRecord(Base):
     # Timestamp when we inserted this record
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+class DocumentFacts(Base):
+    """Facts about a file's content, computed once at ingestion (see app/utils/preflight.py)."""
+    __tablename__ = "document_facts"
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), unique=True, index=True, nullable=False)
+    filehash = Column(String, unique=True, index=True, nullable=False)  # Same as FileRecord.filehash
+
+    page_count = Column(Integer, nullable=True)  # None if the file could not be opened as a document
+    text_pages = Column(Text, nullable=True)     # Ranges of the 0-based pages with a text layer, e.g. "0-3,7"
+    encrypted = Column(Boolean, nullable=False, default=False)
+    needs_password = Column(Boolean, nullable=False, default=False)  # Encrypted with a user password
+    pdf_version = Column(String, nullable=True)  # e.g. "PDF 1.7"
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class ProcessingLog(Base):
     __tablename__ = "processing_logs"
     id = Column(Integer, primary_key=True, index=True)
@@ -47,3 +62,24 @@ class ProcessingLog(Base):
     status = Column(String)              # "pending", "in_progress", "success", "failure"
     message = Column(String, nullable=True)  # Error text or success note
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+class PipelineState(Base):
+    """Checkpoint of a document's pipeline run (see app/utils/pipeline_state.py)."""
+    __tablename__ = "pipeline_states"
+    id = Column(Integer, primary_key=True, index=True)
+    file_id = Column(Integer, ForeignKey("files.id"), unique=True, index=True, nullable=False)
+
+    # Last completed step: "staged", "text_extracted", "pdf_ready", "metadata_extracted", "embedded", "completed"
+    state = Column(String, nullable=False)
+    status = Column(String, nullable=False)  # "running", "failed", "completed"
+    last_error = Column(Text, nullable=True)
+
+    # Step outputs needed to resume from the last completed step
+    working_file = Column(String)              # <workdir>/tmp/<uuid>.pdf
+    text_ref = Column(String, nullable=True)   # Blob reference to the document text
+    rotation_data = Column(Text, nullable=True)  # JSON {page index: detected angle} of pages not turned yet
+    metadata_json = Column(Text, nullable=True)  # JSON of the extracted metadata
+    processed_file = Column(String, nullable=True, index=True)  # <workdir>/processed/<name>.pdf
+    uploads = Column(Text, nullable=True)      # JSON {destination: "queued"/"success"/"failure"}
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import logging
+import redis
+from celery.signals import task_failure
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+from app.config import settings
+from app.tasks.retry_config import BaseTaskWithRetry
+from app.tasks.process_with_azure_document_intelligence import (
+    get_analysis_status,
+    download_searchable_pdf,
+    check_page_rotation,
+    continue_after_ocr,
+    page_texts_from_result,
+    store_ocr_result,
+)
+from app.celery_app import celery
+from app.utils.pipeline_state import fail_pipeline
+from app.utils.metrics import record_azure_pages
+from app.utils.priority_lanes import current_priority
+from app.utils.blob_store import put_json, get_json, blob_exists
+from app.utils.deduplication import (
+    current_lease_owner,
+    find_filehash_by_local_filename,
+    refresh_pipeline_lease,
+    LEASE_OWNER_HEADER,
+)
+
+logger = logging.getLogger(__name__)
+
+redis_client = redis.StrictRedis.from_url(settings.redis_url, decode_responses=True)
+
+PENDING_KEY = "azure_ocr_pending"        # hash: operation id -> JSON context
+PROCESSING_KEY = "azure_ocr_processing"  # hash: operation id -> JSON context handed to finish_azure_ocr
+SWEEP_LOCK_KEY = "azure_ocr_collect_lock"
+
+# Handed-over operations whose finish_azure_ocr neither succeeded nor failed by then
+# (e.g. the sweep died before dispatching it) are handed over again, at most MAX_HANDOVERS times
+HANDOVER_TIMEOUT_SECONDS = 15 * 60
+MAX_HANDOVERS = 3
+
+# Moves an operation from the pending to the processing hash; only one sweep can claim it
+HANDOVER_SCRIPT = """
+if redis.call('hdel', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+# Releases the sweep lock only if this sweep still holds it
+UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def register_pending_ocr(operation_id, operation_location, filename,
+                         splice_into=None, ocr_pages=None, page_texts=None, cache_key=None):
+    """
+    Remembers a submitted Azure operation together with everything needed to resume the
+    pipeline. Page texts are kept as a blob reference if they are large, not in Redis.
+    """
+    document_path = os.path.join(settings.workdir, "tmp", splice_into or filename)
+    context = {
+        "operation_location": operation_location,
+        "filename": filename,
+        "splice_into": splice_into,
+        "ocr_pages": ocr_pages,
+        "page_texts": put_json(page_texts),
+        "cache_key": cache_key,
+        "priority": current_priority(),
+        "lease_owner": current_lease_owner(),
+        "filehash": find_filehash_by_local_filename(document_path),
+        "submitted_at": time.time(),
+    }
+    redis_client.hset(PENDING_KEY, operation_id, json.dumps(context))
+    logger.info(f"Submitted {filename} to Azure Document Intelligence (operation {operation_id})")
+
+
+def _abandon(operation_id, context, error_msg, key=PENDING_KEY):
+    """Drops an operation that failed or timed out and frees the document's pipeline lease."""
+    if redis_client.hdel(key, operation_id):
+        logger.error(f"OCR of {context['filename']} failed: {error_msg}")
+        document_path = os.path.join(settings.workdir, "tmp", context["splice_into"] or context["filename"])
+        fail_pipeline(document_path, error_msg, lease_owner=context.get("lease_owner"))
+
+
+def _hand_over(operation_id, context, source_key, result=None):
+    """
+    Moves an operation to the processing hash and dispatches `finish_azure_ocr` for it.
+    The entry stays there until the finish succeeds or fails for good, so a handover
+    lost on the way is retried by a later sweep.
+
+    The `result` the sweep polled is stored as a blob and handed over by reference, so the
+    finish does not download it again.
+
+    Returns:
+        bool: False if another sweep claimed the operation first
+    """
+    if result is not None:
+        context = {**context, "result_ref": put_json(result.as_dict(), force=True)}
+    handover = {**context, "handed_over_at": time.time(), "handovers": context.get("handovers", 0) + 1}
+    if not redis_client.eval(HANDOVER_SCRIPT, 2, source_key, PROCESSING_KEY, operation_id, json.dumps(handover)):
+        return False
+    # Resume in the document's priority lane and under its lease, not the collector's
+    headers = {LEASE_OWNER_HEADER: context["lease_owner"]} if context.get("lease_owner") else None
+    finish_azure_ocr.apply_async((operation_id, json.dumps(context)), priority=context.get("priority"),
+                                 headers=headers)
+    return True
+
+
+def _retry_lost_handovers():
+    """Hands over again the operations whose finish_azure_ocr did not end in time."""
+    retried = 0
+    for operation_id, raw_context in redis_client.hgetall(PROCESSING_KEY).items():
+        context = json.loads(raw_context)
+        if time.time() - context["handed_over_at"] < HANDOVER_TIMEOUT_SECONDS:
+            continue
+        if context["handovers"] >= MAX_HANDOVERS:
+            _abandon(operation_id, context, "Azure result was not processed", key=PROCESSING_KEY)
+        elif _hand_over(operation_id, context, PROCESSING_KEY):
+            logger.warning(f"Handing over Azure operation {operation_id} of {context['filename']} again")
+            retried += 1
+    return retried
+
+
+@celery.task
+def collect_azure_ocr_results():
+    """
+    Periodic sweep over all pending Azure operations.
+
+    Each operation is polled once. Finished ones are handed to `finish_azure_ocr`, which
+    downloads the searchable PDF and resumes the pipeline, so worker slots are only busy
+    while there is actual work to do instead of waiting on Azure.
+    Handed-over operations stay in the processing hash until the finish succeeds or
+    fails for good, so none is lost if a worker dies in between.
+    """
+    # Only one sweep at a time; the lock expires in case a worker dies mid-sweep
+    lock_token = uuid.uuid4().hex
+    if not redis_client.set(SWEEP_LOCK_KEY, lock_token, nx=True, ex=max(settings.azure_ocr_collect_interval_seconds * 6, 30)):
+        logger.info("Another OCR collector sweep is running, skipping.")
+        return {"status": "skipped"}
+
+    finished, failed, running = 0, 0, 0
+    try:
+        for operation_id, raw_context in redis_client.hgetall(PENDING_KEY).items():
+            context = json.loads(raw_context)
+            try:
+                status, result, error = get_analysis_status(context["operation_location"])
+            except Exception as e:
+                logger.warning(f"Could not poll Azure operation {operation_id}: {e}")
+                status, result, error = "running", None, None
+
+            if status == "succeeded":
+                if _hand_over(operation_id, context, PENDING_KEY, result):
+                    finished += 1
+            elif status == "failed":
+                _abandon(operation_id, context, f"Azure analysis failed: {error}")
+                failed += 1
+            elif time.time() - context["submitted_at"] > settings.azure_ocr_timeout_seconds:
+                _abandon(operation_id, context, "Azure analysis timed out")
+                failed += 1
+            else:
+                # Waiting on Azure does not checkpoint, so keep the document's lease alive here
+                if context.get("filehash"):
+                    refresh_pipeline_lease(context["filehash"], context.get("lease_owner"))
+                running += 1
+        _retry_lost_handovers()
+    finally:
+        # The lock may have expired and been taken by the next sweep in the meantime
+        redis_client.eval(UNLOCK_SCRIPT, 1, SWEEP_LOCK_KEY, lock_token)
+
+    if finished or failed:
+        logger.info(f"OCR collector: {finished} finished, {failed} failed, {running} still running")
+    return {"finished": finished, "failed": failed, "running": running}
+
+
+@celery.task(base=BaseTaskWithRetry)
+def finish_azure_ocr(operation_id: str, raw_context: str):
+    """
+    Downloads the searchable PDF of a finished Azure operation and resumes the document
+    pipeline. The analysis result comes from the blob the collector stored while polling;
+    it is only fetched again if that blob is gone.
+    """
+    context = json.loads(raw_context)
+    filename = context["filename"]
+    tmp_file_path = os.path.join(settings.workdir, "tmp", filename)
+
+    if blob_exists(context.get("result_ref")):
+        # Polled by the collector already
+        status, result, error = "succeeded", AnalyzeResult(get_json(context["result_ref"])), None
+    else:
+        status, result, error = get_analysis_status(context["operation_location"])
+    if status != "succeeded" or result is None:
+        raise RuntimeError(f"Azure operation {operation_id} for {filename} is {status}: {error}")
+    record_azure_pages(result)
+
+    rotation_data = check_page_rotation(result, filename)
+    download_searchable_pdf(result, operation_id, tmp_file_path)
+    ocr_page_texts = page_texts_from_result(result)
+    if context.get("cache_key"):
+        store_ocr_result(context["cache_key"], result.content, ocr_page_texts, rotation_data, tmp_file_path)
+
+    splice_into = context.get("splice_into")
+    document_filename = continue_after_ocr(
+        filename, result.content, ocr_page_texts if splice_into else None, rotation_data,
+        splice_into=splice_into, ocr_pages=context.get("ocr_pages"), page_texts=context.get("page_texts"),
+    )
+    redis_client.hdel(PROCESSING_KEY, operation_id)
+    return {"file": document_filename, "operation_id": operation_id, "characters": len(result.content or "")}
+
+
+@task_failure.connect(sender=finish_azure_ocr)
+def _finish_failed(sender=None, args=None, **kwargs):
+    """A finish that failed for good is recorded by the pipeline state; do not hand it over again."""
+    if args:
+        redis_client.hdel(PROCESSING_KEY, args[0])
@@ -7,20 +7,38 @@ import json
 from celery import shared_task
 from app.config import settings
 from app.tasks.process_document import process_document
+from app.tasks.pipeline import enqueue
+from app.utils.deduplication import release_ingestion
 
 logger = logging.getLogger(__name__)
 
 @shared_task
-def convert_to_pdf(file_path):
+def convert_to_pdf(file_path, source_hash=None):
     """
     Converts a file to PDF using Gotenberg's API.
     Determines the appropriate Gotenberg endpoint based on the file's MIME type.
     On success, saves the PDF locally and enqueues it for processing.
+
+    `source_hash` is the hash of `file_path` claimed by the ingestion path (see
+    app.utils.deduplication). It is handed on to process_document, which releases it, or
+    released right away if the conversion fails.
     """
+    converted_file_path = _convert_with_gotenberg(file_path)
+    if not converted_file_path:
+        release_ingestion(source_hash)
+        return None
+
+    # Enqueue the PDF for further processing
+    enqueue(process_document, converted_file_path, source_hash=source_hash)
+    return converted_file_path
+
+
+def _convert_with_gotenberg(file_path):
+    """Converts `file_path` with Gotenberg; returns the path of the PDF, or None on failure."""
     gotenberg_url = getattr(settings, "gotenberg_url", None)
     if not gotenberg_url:
         logger.error("Gotenberg URL is not configured in settings.")
-        return
+        return None
 
     # Try to guess the MIME type based on file content and extension
     mime_type, encoding = mimetypes.guess_type(file_path)
@@ -162,10 +180,6 @@ def convert_to_pdf(file_path):
                 out_file.write(response.content)
             
             logger.info(f"Converted file saved as PDF: {converted_file_path}")
-            
-            # Enqueue the PDF for further processing
-            process_document.delay(converted_file_path)
-            
             return converted_file_path
         else:
             logger.error(
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
 import os
-import shutil
 import fitz  # PyMuPDF for PDF metadata editing
 import json
 from app.config import settings
 from app.tasks.retry_config import BaseTaskWithRetry
 from app.tasks.finalize_document_storage import finalize_document_storage
+from app.tasks.optimize_pdf import optimize_pdf
+from app.utils.pipeline_state import fail_pipeline, checkpoint, STATE_EMBEDDED
+from app.utils.file_operations import stage_file, atomic_path, atomic_write
+from app.utils.pdf_rotation import apply_page_rotations, save_in_place
+from app.utils.tracing import span
 
 # Import the shared Celery instance
 from app.celery_app import celery
+from app.tasks.pipeline import enqueue_next
 
 def unique_filepath(directory, base_filename, extension=".pdf"):
     """
@@ -26,6 +31,15 @@ def unique_filepath(directory, base_filename, extension=".pdf"):
             return candidate
         counter += 1
 
+def restore_working_copy(processed_file, original_file, original_size):
+    """
+    Puts a consumed working copy back after a failed embedding, so the step can be retried.
+    An incremental save only appends, so cutting the file to its original size undoes it.
+    """
+    if os.path.getsize(processed_file) > original_size:
+        os.truncate(processed_file, original_size)
+    stage_file(processed_file, original_file, keep_source=False)
+
 def persist_metadata(metadata, final_pdf_path):
     """
     Saves the metadata dictionary to a JSON file with the same base name as the final PDF.
@@ -34,12 +48,12 @@ def persist_metadata(metadata, final_pdf_path):
     """
     base, _ = os.path.splitext(final_pdf_path)
     json_path = base + ".json"
-    with open(json_path, "w", encoding="utf-8") as f:
+    with atomic_write(json_path, "w", encoding="utf-8") as f:
         json.dump(metadata, f, ensure_ascii=False, indent=2)
     return json_path
 
 @celery.task(base=BaseTaskWithRetry)
-def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata: dict):
+def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata: dict, rotation_data: dict = None):
     """
     Embeds extracted metadata into the PDF's standard metadata fields.
     The mapping is as follows:
@@ -51,8 +65,12 @@ def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata:
     After processing, the file is moved to
       <workdir>/processed/<suggested_filename.pdf>
     where <suggested_filename.pdf> is derived from metadata["filename"].
-    The output PDF is saved incrementally while preserving its original encryption.
+    The output PDF is saved incrementally while preserving its original encryption, in a
+    temporary file next to its final name that then replaces it with a single rename.
+    Pages whose rotation was deferred by rotate_pdf_pages (`rotation_data`, {page index:
+    detected angle}) are turned in the same save.
     Additionally, the metadata is persisted to a JSON file with the same base name.
+    `extracted_text` is the document text or a blob reference to it (see app.utils.blob_store).
     """
     # Check for file existence; if not found, try the known shared tmp directory.
     if not os.path.exists(local_file_path):
@@ -63,32 +81,8 @@ def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata:
             print(f"[ERROR] Local file {local_file_path} not found, cannot embed metadata.")
             return {"error": "File not found"}
 
-    # Work on a safe copy in /tmp
-    tmp_dir = "/tmp"
     original_file = local_file_path
-    processed_file = os.path.join(tmp_dir, f"processed_{os.path.basename(local_file_path)}")
-
-    # Create a safe copy to work on
-    shutil.copy(original_file, processed_file)
-
     try:
-        print(f"[DEBUG] Embedding metadata into {processed_file}...")
-
-        # Open the PDF
-        doc = fitz.open(processed_file)
-        # Set PDF metadata using only the standard keys.
-        doc.set_metadata({
-            "title": metadata.get("filename", "Unknown Document"),
-            "author": metadata.get("absender", "Unknown"),
-            "subject": metadata.get("document_type", "Unknown"),
-            "keywords": ", ".join(metadata.get("tags", []))
-        })
-        # Save incrementally and preserve encryption
-        doc.save(processed_file, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
-        doc.close()
-
-        print(f"[INFO] Metadata embedded successfully in {processed_file}")
-
         # Use the suggested filename from metadata; if not provided, use the original basename.
         suggested_filename = metadata.get("filename", os.path.splitext(os.path.basename(local_file_path))[0])
         # Remove any extension and then add .pdf
@@ -99,21 +93,48 @@ def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata:
         # Get a unique filepath in case of collisions.
         final_file_path = unique_filepath(final_dir, suggested_filename, extension=".pdf")
 
-        # Move the processed file using shutil.move to handle cross-device moves.
-        shutil.move(processed_file, final_file_path)
-        # Ensure the temporary file is deleted if it still exists.
-        if os.path.exists(processed_file):
-            os.remove(processed_file)
+        # The PDF is saved in a temporary file next to its final name and renamed into place.
+        # The working copy itself becomes that file (a rename, or one copy across devices) when
+        # nothing else needs it: it is in <workdir>/tmp and has no other hard links. Otherwise the
+        # incremental save must not write into it, and a private copy is made (a reflink if possible).
+        workdir_tmp = os.path.join(settings.workdir, "tmp")
+        consume = original_file.startswith(workdir_tmp) and os.stat(original_file).st_nlink == 1
+        original_size = os.path.getsize(original_file)
 
-        # Persist the metadata into a JSON file with the same base name.
-        json_path = persist_metadata(metadata, final_file_path)
+        with atomic_path(final_file_path) as processed_file:
+            staging_strategy = stage_file(original_file, processed_file, keep_source=not consume,
+                                          allow_hardlink=False)
+            try:
+                print(f"[DEBUG] Embedding metadata into {processed_file}...")
+                with span("pdf.embed_metadata", file=final_file_path), fitz.open(processed_file) as doc:
+                    applied_rotations = apply_page_rotations(doc, rotation_data)
+                    # Set PDF metadata using only the standard keys.
+                    doc.set_metadata({
+                        "title": metadata.get("filename", "Unknown Document"),
+                        "author": metadata.get("absender", "Unknown"),
+                        "subject": metadata.get("document_type", "Unknown"),
+                        "keywords": ", ".join(metadata.get("tags", []))
+                    })
+                    # Save incrementally and preserve encryption
+                    save_in_place(doc, processed_file)
+
+                # The sidecar is in place before the PDF, uploads read it next to the PDF.
+                json_path = persist_metadata(metadata, final_file_path)
+            except Exception:
+                if consume:
+                    restore_working_copy(processed_file, original_file, original_size)
+                raise
+
+        print(f"[INFO] Metadata embedded successfully in {final_file_path}")
         print(f"[INFO] Metadata persisted to {json_path}")
+        checkpoint(original_file, STATE_EMBEDDED, processed_file=final_file_path)
 
-        # Trigger the next step: final storage.
-        finalize_document_storage.delay(original_file, final_file_path, metadata)
+        # Trigger the next step: optimization if enabled, else final storage.
+        next_step = optimize_pdf if settings.pdf_optimize_enabled else finalize_document_storage
+        enqueue_next(next_step, original_file, final_file_path, metadata)
 
-        # After triggering final storage, delete the original file if it is in workdir/tmp.
-        workdir_tmp = os.path.join(settings.workdir, "tmp")
+        # After triggering final storage, delete the original file if it is in workdir/tmp
+        # (unless it became the processed file).
         if original_file.startswith(workdir_tmp) and os.path.exists(original_file):
             try:
                 os.remove(original_file)
@@ -121,8 +142,15 @@ def embed_metadata_into_pdf(local_file_path: str, extracted_text: str, metadata:
             except Exception as e:
                 print(f"[ERROR] Could not delete original file {original_file}: {e}")
 
-        return {"file": final_file_path, "metadata_file": json_path, "status": "Metadata embedded"}
+        return {
+            "file": final_file_path,
+            "metadata_file": json_path,
+            "status": "Metadata embedded",
+            "applied_rotations": applied_rotations,
+            "staging": {"working_copy": staging_strategy},
+        }
 
     except Exception as e:
-        print(f"[ERROR] Failed to embed metadata into {processed_file}: {e}")
+        print(f"[ERROR] Failed to embed metadata into {original_file}: {e}")
+        fail_pipeline(original_file, e)
         return {"error": str(e)}
@@ -5,9 +5,18 @@ import re
 from app.config import settings
 from app.tasks.retry_config import BaseTaskWithRetry
 from app.tasks.embed_metadata_into_pdf import embed_metadata_into_pdf
+from app.utils.pipeline_state import (
+    fail_pipeline, checkpoint, working_file, STATE_PDF_READY, STATE_METADATA_EXTRACTED,
+)
+from app.utils.admission import outstanding_call, STAGE_LLM
+from app.utils.metrics import record_openai_usage
+from app.utils.tracing import span
+from app.utils.blob_store import get_text, put_text
+from app.utils.result_cache import cache_key, text_digest, get_cached, put_cached
 
 # Import the shared Celery instance
 from app.celery_app import celery
+from app.tasks.pipeline import enqueue_next
 import openai
 
 # Initialize OpenAI client dynamically
@@ -34,8 +43,17 @@ def extract_json_from_text(text):
     return None
 
 @celery.task(base=BaseTaskWithRetry)
-def extract_metadata_with_gpt(filename: str, cleaned_text: str):
-    """Uses OpenAI to classify document metadata."""
+def extract_metadata_with_gpt(filename: str, cleaned_text: str, rotation_data: dict = None):
+    """
+    Uses OpenAI to classify document metadata.
+    `cleaned_text` may be a blob reference (see app.utils.blob_store); it is passed on unchanged.
+    `rotation_data` are page rotations deferred to embed_metadata_into_pdf (see rotate_pdf_pages).
+    """
+    text = get_text(cleaned_text)
+    # Reaching this step means the working copy is final (OCR'd), except for deferred rotations.
+    # A text reference is checkpointed as it is instead of storing the text again.
+    checkpoint(working_file(filename), STATE_PDF_READY, text_ref=put_text(cleaned_text, force=True),
+               rotation_data=rotation_data or {})
     prompt = f"""
 You are a specialized document analyzer trained to extract structured metadata from documents.
 Your task is to analyze the given text and return a well-structured JSON object.
@@ -63,21 +81,32 @@ Extract and return the following fields:
 - **Output Language**: Maintain the document's original language.
 
 Extracted text:
-{cleaned_text}
+{text}
 
 Return only valid JSON with no additional commentary.
 """
 
     try:
+        # The prompt contains the text, so its digest plus the model identifies the answer
+        key = cache_key(text_digest(prompt), settings.openai_model)
+        cached = get_cached("metadata", key)
+        if cached:
+            print(f"[INFO] Using cached metadata for {filename}")
+            checkpoint(working_file(filename), STATE_METADATA_EXTRACTED, metadata=cached["metadata"])
+            enqueue_next(embed_metadata_into_pdf, filename, cleaned_text, cached["metadata"], rotation_data=rotation_data)
+            return {"s3_file": filename, "metadata": cached["metadata"]}
+
         print(f"[DEBUG] Sending classification request for {filename}...")
-        completion = client.chat.completions.create(
-            model=settings.openai_model,
-            messages=[
-                {"role": "system", "content": "You are an intelligent document classifier."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0
-        )
+        with outstanding_call(STAGE_LLM), span("openai.extract_metadata", model=settings.openai_model):
+            completion = client.chat.completions.create(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": "You are an intelligent document classifier."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0
+            )
+        record_openai_usage("metadata", completion)
 
         content = completion.choices[0].message.content
         print(f"[DEBUG] Raw classification response for {filename}: {content}")
@@ -85,16 +114,20 @@ Return only valid JSON with no additional commentary.
         json_text = extract_json_from_text(content)
         if not json_text:
             print(f"[ERROR] Could not find valid JSON in GPT response for {filename}.")
+            fail_pipeline(working_file(filename), "No metadata JSON")
             return {}
 
         metadata = json.loads(json_text)
         print(f"[DEBUG] Extracted metadata: {metadata}")
+        put_cached("metadata", key, {"metadata": metadata})
+        checkpoint(working_file(filename), STATE_METADATA_EXTRACTED, metadata=metadata)
 
         # Trigger the next step: embedding metadata into the PDF
-        embed_metadata_into_pdf.delay(filename, cleaned_text, metadata)
+        enqueue_next(embed_metadata_into_pdf, filename, cleaned_text, metadata, rotation_data=rotation_data)
 
         return {"s3_file": filename, "metadata": metadata}
 
     except Exception as e:
         print(f"[ERROR] OpenAI classification failed for {filename}: {e}")
+        fail_pipeline(working_file(filename), e)
         return {}
@@ -4,9 +4,11 @@ from app.config import settings
 from app.tasks.retry_config import BaseTaskWithRetry
 # Import the shared Celery instance
 from app.celery_app import celery
+from app.tasks.pipeline import enqueue_next
 
 # 1) Import the aggregator task
 from app.tasks.send_to_all import send_to_all_destinations
+from app.utils.deduplication import find_filehash_by_local_filename
 
 
 @celery.task(base=BaseTaskWithRetry)
@@ -17,8 +19,10 @@ def finalize_document_storage(original_file: str, processed_file: str, metadata:
     """
     print(f"[INFO] Finalizing document storage for {processed_file}")
 
-    # 2) Enqueue uploads to all destinations (Dropbox, Nextcloud, Paperless)
-    send_to_all_destinations.delay(processed_file)
+    # 2) Enqueue uploads to all destinations (Dropbox, Nextcloud, Paperless).
+    # The file hash lets the aggregator release the pipeline lease once uploads are queued.
+    filehash = find_filehash_by_local_filename(original_file)
+    enqueue_next(send_to_all_destinations, processed_file, filehash=filehash)
 
     return {
         "status": "Completed",
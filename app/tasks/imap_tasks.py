@@ -6,11 +6,16 @@ import imaplib
 import logging
 import redis
 import re
+import hashlib
 from datetime import datetime, timedelta, timezone
 from celery import shared_task
 from app.config import settings
 from app.tasks.process_document import process_document  # Updated import
 from app.tasks.convert_to_pdf import convert_to_pdf  # new conversion task
+from app.utils.deduplication import claim_ingestion
+from app.utils.priority_lanes import PRIORITY_IMAP
+from app.utils.admission import check_admission
+from app.utils.tracing import document_trace
 
 logger = logging.getLogger(__name__)
 
@@ -192,6 +197,13 @@ def pull_inbox(mailbox_key, host, port, username, password, use_ssl,
         logger.info("Found %d unread emails in %s.", len(msg_numbers), mailbox_key)
 
         for num in msg_numbers:
+            # Backpressure: leave the remaining mails in the inbox for the next poll
+            refusal = check_admission(PRIORITY_IMAP)
+            if refusal:
+                logger.info("Pipeline busy (%s), deferring remaining emails in %s.",
+                            refusal["reason"], mailbox_key)
+                break
+
             status, msg_data = mail.fetch(num, "(RFC822)")
             if status != "OK":
                 logger.warning("Failed to fetch message %s in %s. Status=%s",
@@ -269,6 +281,9 @@ def fetch_attachments_and_enqueue(email_message):
     
     If the attachment is a PDF (by extension or MIME type), it is enqueued for upload;
     any other allowed file is enqueued for conversion to PDF.
+
+    Attachments whose content hash is already known (processed or in flight) are
+    skipped before anything is written to disk or enqueued.
     
     Returns True if at least one allowed attachment was processed.
     """
@@ -305,18 +320,29 @@ def fetch_attachments_and_enqueue(email_message):
                         filename, mime_type)
             continue
 
+        payload = part.get_payload(decode=True)
+        filehash = hashlib.sha256(payload).hexdigest()
+        duplicate = claim_ingestion(filehash)
+        if duplicate:
+            logger.info("Skipping duplicate attachment %s (%s, file_id=%s)",
+                        filename, duplicate["status"], duplicate["file_id"])
+            continue
+
         file_path = os.path.join(settings.workdir, filename)
         with open(file_path, "wb") as f:
-            f.write(part.get_payload(decode=True))
-
-        # If it's a PDF by MIME type or extension, process it directly
-        if mime_type == "application/pdf" or is_pdf_by_extension:
-            process_document.delay(file_path)
-            logger.info("Enqueued PDF for upload: %s (MIME: %s)", filename, mime_type)
-        elif mime_type in ALLOWED_MIME_TYPES:
-            # Other allowed files are sent for conversion
-            convert_to_pdf.delay(file_path)
-            logger.info("Enqueued file for conversion to PDF: %s", filename)
+            f.write(payload)
+
+        # Each attachment is a document of its own, with its own trace
+        with document_trace("imap", filename=filename, filehash=filehash):
+            # If it's a PDF by MIME type or extension, process it directly
+            if mime_type == "application/pdf" or is_pdf_by_extension:
+                process_document.apply_async((file_path,), {"filehash": filehash, "file_size": len(payload)},
+                                             priority=PRIORITY_IMAP)
+                logger.info("Enqueued PDF for upload: %s (MIME: %s)", filename, mime_type)
+            elif mime_type in ALLOWED_MIME_TYPES:
+                # Other allowed files are sent for conversion
+                convert_to_pdf.apply_async((file_path,), {"source_hash": filehash}, priority=PRIORITY_IMAP)
+                logger.info("Enqueued file for conversion to PDF: %s", filename)
 
         has_attachment = True
     return has_attachment
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import logging
+
+from app.celery_app import celery
+from app.tasks.process_document import process_document
+from app.utils.admission import check_admission
+from app.utils.priority_lanes import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_while_admitted(file_paths, priority=PRIORITY_BULK):
+    """
+    Enqueues `process_document` for the given files until admission control refuses.
+
+    Returns:
+        tuple: (ids of the enqueued tasks, files not enqueued yet, refusal or None)
+    """
+    task_ids = []
+    for index, file_path in enumerate(file_paths):
+        refusal = check_admission(priority)
+        if refusal:
+            return task_ids, list(file_paths[index:]), refusal
+        task_ids.append(process_document.apply_async((file_path,), priority=priority).id)
+    return task_ids, [], None
+
+
+@celery.task
+def ingest_backlog(file_paths: list):
+    """
+    Feeds a bulk backlog into the pipeline at the pace the pipeline can absorb: files are
+    enqueued while admission control allows, then the task re-schedules itself for the
+    rest after the suggested retry delay.
+    """
+    task_ids, remaining, refusal = enqueue_while_admitted(file_paths)
+    if remaining:
+        logger.info(f"Backlog: enqueued {len(task_ids)}, deferring {len(remaining)} files "
+                    f"for {refusal['retry_after']}s ({refusal['reason']})")
+        ingest_backlog.apply_async((remaining,), countdown=refusal["retry_after"], priority=PRIORITY_BULK)
+    return {"enqueued": len(task_ids), "deferred": len(remaining)}
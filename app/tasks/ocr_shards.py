@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import fitz  # PyMuPDF for splitting and merging shards
+from celery import chord
+
+from app.config import settings
+from app.tasks.retry_config import BaseTaskWithRetry
+from app.tasks.pipeline import enqueue_next
+from app.tasks.process_with_azure_document_intelligence import (
+    AZURE_DOC_INTELLIGENCE_LIMITS,
+    analyze_document,
+    download_searchable_pdf,
+    check_page_rotation,
+    continue_after_ocr,
+    store_ocr_result,
+)
+from app.celery_app import celery
+from app.utils.priority_lanes import current_priority
+from app.utils.file_operations import atomic_path
+from app.utils.blob_store import put_text, get_text, put_json, get_json
+from app.utils.ocr_planner import page_texts_from_result
+
+logger = logging.getLogger(__name__)
+
+
+def shard_filename(filename, shard_index):
+    """Name of the working file of one shard, e.g. <uuid>_shard3.pdf"""
+    base, ext = os.path.splitext(filename)
+    return f"{base}_shard{shard_index}{ext}"
+
+
+def shard_page_ranges(page_count, shard_size):
+    """Splits `page_count` pages into consecutive (start, stop) ranges of at most `shard_size` pages."""
+    return [(start, min(start + shard_size, page_count)) for start in range(0, page_count, shard_size)]
+
+
+def dispatch_ocr_shards(filename, page_count, splice_into=None, ocr_pages=None, page_texts=None, cache_key=None):
+    """
+    Has <workdir>/tmp/<filename> split into page-range shards (by `split_ocr_shards` on the
+    CPU queue) that are OCR'd in parallel as a Celery chord. `merge_ocr_shards` runs once all
+    shards are done, stores the merged result in the OCR cache under `cache_key` and
+    continues the pipeline.
+
+    Returns:
+        int: number of shards
+    """
+    shard_size = min(settings.azure_ocr_shard_size_pages, AZURE_DOC_INTELLIGENCE_LIMITS["max_pages"])
+    ranges = shard_page_ranges(page_count, shard_size)
+    logger.info(f"Splitting {filename} ({page_count} pages) into {len(ranges)} OCR shards of up to {shard_size} pages")
+    enqueue_next(split_ocr_shards, filename, ranges, splice_into=splice_into, ocr_pages=ocr_pages,
+                 page_texts=page_texts, cache_key=cache_key)
+    return len(ranges)
+
+
+@celery.task(base=BaseTaskWithRetry)
+def split_ocr_shards(filename: str, ranges: list, splice_into: str = None, ocr_pages: list = None,
+                     page_texts=None, cache_key: str = None):
+    """
+    Writes one shard PDF per (start, stop) page range of <workdir>/tmp/<filename>, stored next
+    to the document, and starts the chord that OCRs them.
+    """
+    tmp_dir = os.path.join(settings.workdir, "tmp")
+    with fitz.open(os.path.join(tmp_dir, filename)) as doc:
+        for shard_index, (start, stop) in enumerate(ranges):
+            with fitz.open() as shard_doc:
+                shard_doc.insert_pdf(doc, from_page=start, to_page=stop - 1)
+                with atomic_path(os.path.join(tmp_dir, shard_filename(filename, shard_index))) as tmp_path:
+                    shard_doc.save(tmp_path, garbage=3, deflate=True)
+
+    header = [
+        ocr_pdf_shard.s(filename, shard_index, start, stop)
+        for shard_index, (start, stop) in enumerate(ranges)
+    ]
+    callback = merge_ocr_shards.s(filename, splice_into=splice_into, ocr_pages=ocr_pages, page_texts=page_texts,
+                                  cache_key=cache_key)
+    # Shards and merge stay in the priority lane of the document
+    priority = current_priority()
+    chord([shard.set(priority=priority) for shard in header])(callback.set(priority=priority))
+    return {"file": filename, "shards": len(ranges)}
+
+
+@celery.task(base=BaseTaskWithRetry)
+def ocr_pdf_shard(filename: str, shard_index: int, start_page: int, stop_page: int):
+    """
+    OCRs pages [start_page, stop_page) of <workdir>/tmp/<filename>, split off by
+    `split_ocr_shards`, with Azure Document Intelligence.
+
+    The searchable PDF replaces the shard. Page indices in the returned rotation data are
+    already mapped to the full document. Large texts are returned as blob references, so
+    they don't go through the result backend.
+    """
+    shard_path = os.path.join(settings.workdir, "tmp", shard_filename(filename, shard_index))
+
+    logger.info(f"OCR shard {shard_index} of {filename}: pages {start_page + 1}-{stop_page}")
+    result, operation_id = analyze_document(shard_path)
+    download_searchable_pdf(result, operation_id, shard_path)
+
+    rotation_data = check_page_rotation(result, shard_path)
+    return {
+        "shard_index": shard_index,
+        "start_page": start_page,
+        "path": shard_path,
+        "content": put_text(result.content or ""),
+        "page_texts": put_json(page_texts_from_result(result)),
+        "rotation_data": {start_page + int(i): angle for i, angle in rotation_data.items()},
+    }
+
+
+@celery.task(base=BaseTaskWithRetry)
+def merge_ocr_shards(shard_results: list, filename: str, splice_into: str = None,
+                     ocr_pages: list = None, page_texts: list = None, cache_key: str = None):
+    """
+    Chord callback: merges the searchable PDFs, texts and rotation maps of all shards back
+    into <workdir>/tmp/<filename> in page order and continues the pipeline.
+    """
+    shard_results = sorted(shard_results, key=lambda shard: shard["shard_index"])
+    target_path = os.path.join(settings.workdir, "tmp", filename)
+
+    with fitz.open() as merged:
+        for shard in shard_results:
+            with fitz.open(shard["path"]) as shard_doc:
+                merged.insert_pdf(shard_doc)
+        with atomic_path(target_path) as tmp_path:
+            merged.save(tmp_path, garbage=3, deflate=True)
+
+    for shard in shard_results:
+        if os.path.exists(shard["path"]):
+            os.remove(shard["path"])
+
+    content = "\n".join(get_text(shard["content"]) for shard in shard_results)
+    ocr_page_texts = [text for shard in shard_results for text in get_json(shard["page_texts"])]
+    rotation_data = {}
+    for shard in shard_results:
+        rotation_data.update({int(i): angle for i, angle in shard["rotation_data"].items()})
+    logger.info(f"Merged {len(shard_results)} OCR shards into {target_path}")
+    if cache_key:
+        store_ocr_result(cache_key, content, ocr_page_texts, rotation_data, target_path)
+
+    document_filename = continue_after_ocr(
+        filename, content, ocr_page_texts, rotation_data,
+        splice_into=splice_into, ocr_pages=ocr_pages, page_texts=page_texts,
+    )
+    return {"file": document_filename, "shards": len(shard_results), "characters": len(content)}
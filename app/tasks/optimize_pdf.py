@@ -0,0 +1,46 @@
+import logging
+
+from app.config import settings
+from app.tasks.retry_config import BaseTaskWithRetry
+from app.tasks.finalize_document_storage import finalize_document_storage
+from app.tasks.pipeline import enqueue_next
+from app.celery_app import celery
+from app.utils.metrics import record_pdf_optimization
+from app.utils.pdf_optimizer import optimize_pdf_file
+from app.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+@celery.task(base=BaseTaskWithRetry)
+def optimize_pdf(original_file: str, processed_file: str, metadata: dict):
+    """
+    Shrinks the processed PDF before it is uploaded (enabled by `pdf_optimize_enabled`):
+    downsamples and recompresses images, merges duplicate objects and drops unused ones
+    (see app.utils.pdf_optimizer). Runs on the CPU queue after embed_metadata_into_pdf;
+    every byte saved here is saved again for each upload destination.
+
+    The optimization is best effort: if it fails, the document continues unoptimized.
+
+    Args:
+        original_file: The document's working copy (passed on to finalize_document_storage)
+        processed_file: The PDF in <workdir>/processed, replaced if the optimized version is smaller
+        metadata: The extracted metadata (passed on)
+    """
+    try:
+        with span("pdf.optimize", file=processed_file):
+            result = optimize_pdf_file(
+                processed_file,
+                image_dpi=settings.pdf_optimize_image_dpi,
+                image_quality=settings.pdf_optimize_image_quality,
+                linearize=settings.pdf_optimize_linearize,
+            )
+        record_pdf_optimization(result["bytes_before"], result["bytes_after"])
+        logger.info(f"Optimized {processed_file}: saved {result['bytes_saved']} of {result['bytes_before']} bytes")
+        status = "optimized" if result["replaced"] else "not_smaller"
+    except Exception as e:
+        logger.error(f"Error optimizing PDF {processed_file}: {e}")
+        result, status = {"error": str(e)}, "optimization_failed"
+
+    # Continue with final storage, optimized or not
+    enqueue_next(finalize_document_storage, original_file, processed_file, metadata)
+    return {"file": processed_file, "status": status, **result}
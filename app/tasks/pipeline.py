@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Hand-off between the steps of the document pipeline.
+
+Every step triggers the next one with `enqueue_next(task, ...)` rather than `task.delay(...)`.
+Normally that is the same thing. For small documents `process_document` switches to fused
+mode (see `fused_pipeline`): the remaining steps up to `send_to_all_destinations` then run
+one after the other inside the same worker, without broker round-trips, and document texts
+stay in memory instead of going through the blob store. Uploads are still queued as
+separate tasks.
+
+If a step fails in fused mode, it is handed to the queue like any other task, so it gets
+the usual retries; the rest of the pipeline continues from there.
+
+Steps run in-process are timed like tasks (see app.utils.metrics).
+
+Queued steps inherit the priority lane of the task that triggers them
+(see app.utils.priority_lanes), so a whole pipeline stays in its lane.
+"""
+
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from app.config import settings
+from app.utils.blob_store import put_text, put_json
+from app.utils.metrics import observe_step
+from app.utils.tracing import span
+from app.utils.priority_lanes import current_priority
+
+logger = logging.getLogger(__name__)
+
+_fused = contextvars.ContextVar("fused_pipeline", default=False)
+
+
+def should_fuse(file_size, page_count):
+    """True if a document is small enough to run the whole pipeline in one worker."""
+    if not settings.fused_pipeline_max_pages:
+        return False
+    return (
+        page_count is not None
+        and page_count <= settings.fused_pipeline_max_pages
+        and file_size is not None
+        and file_size <= settings.fused_pipeline_max_bytes
+    )
+
+
+def is_fused():
+    return _fused.get()
+
+
+@contextmanager
+def fused_pipeline(enabled=True):
+    """Runs steps triggered with `enqueue_next` inside this block in-process."""
+    token = _fused.set(bool(enabled))
+    try:
+        yield
+    finally:
+        _fused.reset(token)
+
+
+def enqueue(task, *args, **kwargs):
+    """Like `task.delay`, but in the priority lane of the running pipeline."""
+    return task.apply_async(args, kwargs, priority=current_priority())
+
+
+def enqueue_next(task, *args, **kwargs):
+    """Triggers the next pipeline step: queued normally, called directly in fused mode."""
+    if not _fused.get():
+        return enqueue(task, *args, **kwargs)
+
+    started = time.monotonic()
+    try:
+        with span(f"step.{task.name.rsplit('.', 1)[-1]}", fused=True):
+            result = task(*args, **kwargs)
+    except Exception as e:
+        observe_step(task.name, time.monotonic() - started, "failure")
+        logger.warning(f"Fused step {task.name} failed ({e}), handing it to the queue for retries")
+        return enqueue(task, *args, **kwargs)
+    observe_step(task.name, time.monotonic() - started, "success")
+    return result
+
+
+def pass_text(text):
+    """What to pass to the next step for a document text: the text itself in fused mode,
+    a blob reference for large texts otherwise (see app.utils.blob_store)."""
+    return text if _fused.get() else put_text(text)
+
+
+def pass_json(value):
+    """Like `pass_text` for other large payloads, e.g. per-page texts (see `put_json`)."""
+    return value if _fused.get() else put_json(value)
@@ -2,54 +2,103 @@
 
 import os
 import uuid
-import shutil
 import mimetypes
-import fitz  # PyMuPDF for checking embedded text
 
 from app.config import settings
 from app.tasks.retry_config import BaseTaskWithRetry
-from app.tasks.process_with_azure_document_intelligence import process_with_azure_document_intelligence
+from app.tasks.process_with_azure_document_intelligence import process_with_azure_document_intelligence, ocr_cache_key
 from app.tasks.extract_metadata_with_gpt import extract_metadata_with_gpt
+from app.tasks.pipeline import enqueue_next, fused_pipeline, pass_text, pass_json, should_fuse
 from app.celery_app import celery
 from app.database import SessionLocal
 from app.models import FileRecord
-from app.utils import hash_file
+from app.utils import hash_file, stage_file
+from app.utils.pdf_text import join_page_texts
+from app.utils.preflight import inspect_document, store_facts
+from app.utils.ocr_planner import plan_ocr, build_ocr_subset, OCR_MODE_NONE, OCR_MODE_PARTIAL
+from app.utils.tracing import span
+from app.utils.pipeline_state import checkpoint, fail_pipeline, get_state, STATE_STAGED, STATUS_COMPLETED
+from app.utils.deduplication import (
+    release_ingestion,
+    acquire_pipeline_lease,
+    release_pipeline_lease,
+    get_pipeline_result,
+)
+from sqlalchemy.exc import IntegrityError
 
 
 @celery.task(base=BaseTaskWithRetry)
-def process_document(original_local_file: str):
+def process_document(original_local_file: str, filehash: str = None, file_size: int = None,
+                     source_hash: str = None):
     """
     Process a document file and trigger appropriate text extraction.
 
+    If the caller already knows the SHA-256 hash and size of the file (e.g. the upload
+    endpoint computes them while streaming the upload to disk), they can be passed in
+    via `filehash` and `file_size` so the file is not read a second time just to hash it.
+    For PDFs converted from another format, `source_hash` is the hash of the original file
+    that the ingestion path claimed (see app.utils.deduplication); it is released together
+    with the PDF's own hash.
+
     Steps:
-      1. Check if we have a FileRecord entry (via SHA-256 hash). If found, skip re-processing.
+      0. Take the cluster-wide pipeline lease for the file hash. If another pipeline is
+         already running for identical content, attach to it instead of redoing the work.
+      1. Check if we have a FileRecord entry (via SHA-256 hash). If found, skip re-processing,
+         unless its pipeline never completed: then resume it from its last checkpoint.
       2. If not found, insert a new DB row and continue with the pipeline:
-         - Copy file to /workdir/tmp
-         - Check for embedded text. If present, run local GPT extraction
-         - Otherwise, queue Azure Document Intelligence processing
+         - Stage file into /workdir/tmp (reflink/hardlink if possible, copy otherwise)
+         - Preflight: record the document's facts (page count, text layer per page,
+           encryption) next to the FileRecord, so later steps need not parse the PDF again
+         - Check for embedded text per page. If every page has text, run local GPT extraction
+         - If only some pages lack text, OCR just those pages (they are spliced back later)
+         - Otherwise, queue Azure Document Intelligence processing for the whole document
+      3. Small documents (see `should_fuse`) run all further steps inside this worker.
     """
 
     if not os.path.exists(original_local_file):
         print(f"[ERROR] File {original_local_file} not found.")
+        release_ingestion(source_hash)
         return {"error": "File not found"}
 
-    # 0. Compute the file hash and check for duplicates
-    filehash = hash_file(original_local_file)
+    # 0. Compute the file hash (unless provided) and check for duplicates
+    if not filehash:
+        filehash = hash_file(original_local_file)
     original_filename = os.path.basename(original_local_file)
-    file_size = os.path.getsize(original_local_file)
+    if file_size is None:
+        file_size = os.path.getsize(original_local_file)
     mime_type, _ = mimetypes.guess_type(original_local_file)
     if not mime_type:
         mime_type = "application/octet-stream"
 
+    # Only one pipeline per content hash may run at a time (released by send_to_all_destinations)
+    lease_owner = acquire_pipeline_lease(filehash, process_document.request.id or original_local_file)
+    if lease_owner:
+        print(f"[INFO] Pipeline for hash={filehash[:10]}... is already running ({lease_owner}). Attaching to it.")
+        release_ingestion(filehash, source_hash)
+        return {
+            "status": "duplicate_in_progress",
+            "pipeline_task_id": lease_owner,
+            "detail": "Identical file is currently being processed."
+        }
+
     # Acquire DB session in the task
     with SessionLocal() as db:
         existing = db.query(FileRecord).filter_by(filehash=filehash).one_or_none()
         if existing:
+            release_ingestion(filehash, source_hash)
+            state = get_state(existing.id)
+            if state and state["status"] != STATUS_COMPLETED:
+                # An earlier run failed or died; we hold the lease now, so pick it up from there
+                from app.tasks.resume_pipeline import resume_document
+                print(f"[INFO] Pipeline of file {existing.id} did not complete ({state['state']}), resuming it.")
+                return resume_document(existing.id, source_file=original_local_file)
             print(f"[INFO] Duplicate file detected (hash={filehash[:10]}...) Skipping processing.")
+            release_pipeline_lease(filehash)
             return {
                 "status": "duplicate_file",
                 "file_id": existing.id,
-                "detail": "File already processed."
+                "detail": "File already processed.",
+                "pipeline_result": get_pipeline_result(filehash)
             }
 
         # Not a duplicate -> insert a new record
@@ -61,9 +110,20 @@ def process_document(original_local_file: str):
             mime_type=mime_type,
         )
         db.add(new_record)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            # Someone inserted the same hash in the meantime; that is a duplicate, not a retryable error
+            db.rollback()
+            print(f"[INFO] Duplicate file inserted concurrently (hash={filehash[:10]}...) Skipping processing.")
+            release_ingestion(filehash, source_hash)
+            release_pipeline_lease(filehash)
+            return {"status": "duplicate_file", "detail": "File already processed."}
         db.refresh(new_record)
 
+        # From here on the FileRecord catches duplicates, so the in-flight marker can go
+        release_ingestion(filehash, source_hash)
+
         # 1. Generate a UUID-based filename and place it in /workdir/tmp
         file_ext = os.path.splitext(original_local_file)[1]
         file_uuid = str(uuid.uuid4())
@@ -73,32 +133,80 @@ def process_document(original_local_file: str):
         os.makedirs(tmp_dir, exist_ok=True)
         new_local_path = os.path.join(tmp_dir, new_filename)
 
-        # Copy the file instead of moving it
-        shutil.copy(original_local_file, new_local_path)
+        # Keep the original in place; hardlinks are fine because later steps replace the
+        # working copy atomically instead of writing into it
+        staging_strategy = stage_file(original_local_file, new_local_path, keep_source=True)
 
         # Update the DB with final local filename
         new_record.local_filename = new_local_path
         db.commit()
+    checkpoint(new_local_path, STATE_STAGED)
 
-    # 2. Check for embedded text (outside the DB session to avoid long open transactions)
-    pdf_doc = fitz.open(new_local_path)
-    has_text = any(page.get_text() for page in pdf_doc)
-    pdf_doc.close()
+    result = start_text_extraction(original_local_file, new_local_path, file_size, filehash)
+    result["staging"] = staging_strategy
+    return result
 
-    if has_text:
-        print(f"[INFO] PDF {original_local_file} contains embedded text. Processing locally.")
 
-        # Extract text locally
-        extracted_text = ""
-        pdf_doc = fitz.open(new_local_path)
-        for page in pdf_doc:
-            extracted_text += page.get_text("text") + "\n"
-        pdf_doc.close()
+def start_text_extraction(original_local_file, new_local_path, file_size, filehash):
+    """
+    Step 2 for a staged document (<workdir>/tmp/<uuid>.<ext>): inspects it and extracts the
+    embedded text, then triggers local metadata extraction or OCR, in-process for small documents.
+    """
+    new_filename = os.path.basename(new_local_path)
+    file_uuid, file_ext = os.path.splitext(new_filename)
+
+    # Preflight and text extraction in a single pass (outside the DB session to avoid long open transactions)
+    with span("pdf.preflight", file=new_local_path):
+        facts, page_texts = inspect_document(new_local_path)
+    store_facts(new_local_path, facts)
+
+    if facts["needs_password"]:
+        # Neither text extraction nor OCR can read it; retrying would not help
+        error = f"{original_local_file} is protected by a password"
+        print(f"[ERROR] {error}.")
+        fail_pipeline(new_local_path, error)
+        return {"file": new_local_path, "error": error, "status": "Failed - Password protected"}
+
+    text_pages = set(facts["text_pages"])
+    ocr_plan = plan_ocr([i in text_pages for i in range(len(page_texts))])
+
+    fused = should_fuse(file_size, facts["page_count"])
+    if fused:
+        print(f"[INFO] {original_local_file} is small ({len(page_texts)} pages), running the pipeline in-process.")
+    with fused_pipeline(fused):
+        result = _dispatch_text_extraction(original_local_file, new_filename, new_local_path, file_uuid,
+                                           file_ext, page_texts, ocr_plan, filehash)
+    result["fused"] = fused
+    return result
+
+
+def _dispatch_text_extraction(original_local_file, new_filename, new_local_path, file_uuid, file_ext,
+                              page_texts, ocr_plan, filehash):
+    """Triggers the next step for the staged document according to its OCR plan."""
+    tmp_dir = os.path.dirname(new_local_path)
+
+    if ocr_plan["mode"] == OCR_MODE_NONE:
+        print(f"[INFO] PDF {original_local_file} contains embedded text. Processing locally.")
+        extracted_text = join_page_texts(page_texts)
 
         # Call metadata extraction directly
-        extract_metadata_with_gpt.delay(new_filename, extracted_text)
+        enqueue_next(extract_metadata_with_gpt, new_filename, pass_text(extracted_text))
         return {"file": new_local_path, "status": "Text extracted locally"}
 
+    if ocr_plan["mode"] == OCR_MODE_PARTIAL:
+        # 3a. Mixed document: only send the image-only pages to OCR
+        ocr_pages = ocr_plan["ocr_pages"]
+        subset_filename = f"{file_uuid}_ocr{file_ext}"
+        with span("pdf.build_ocr_subset", pages=len(ocr_pages)):
+            build_ocr_subset(new_local_path, ocr_pages, os.path.join(tmp_dir, subset_filename))
+        print(f"[INFO] PDF {original_local_file}: {len(ocr_pages)} of {len(page_texts)} pages need OCR.")
+        enqueue_next(
+            process_with_azure_document_intelligence,
+            subset_filename, splice_into=new_filename, ocr_pages=ocr_pages, page_texts=pass_json(page_texts),
+            ocr_key=ocr_cache_key(filehash, ocr_pages)
+        )
+        return {"file": new_local_path, "status": "Queued for partial OCR", "ocr_pages": ocr_pages}
+
     # 3. If no embedded text, queue Azure Document Intelligence processing
-    process_with_azure_document_intelligence.delay(new_filename)
+    enqueue_next(process_with_azure_document_intelligence, new_filename, ocr_key=ocr_cache_key(filehash))
     return {"file": new_local_path, "status": "Queued for OCR"}
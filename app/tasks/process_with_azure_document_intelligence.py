@@ -2,13 +2,31 @@ import os
 import logging
 import PyPDF2
 from azure.core.credentials import AzureKeyCredential
+from azure.core.rest import HttpRequest
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeOutputOption, AnalyzeResult
 
 from app.config import settings
 from app.tasks.retry_config import BaseTaskWithRetry
 from app.tasks.rotate_pdf_pages import rotate_pdf_pages
+from app.tasks.pipeline import enqueue_next, pass_text
 from app.celery_app import celery
+from app.utils.admission import outstanding_call, STAGE_OCR
+from app.utils.blob_store import put_text, put_json, get_json
+from app.utils.metrics import record_azure_pages
+from app.utils.tracing import span
+from app.utils.pipeline_state import fail_pipeline, checkpoint, working_file, STATE_TEXT_EXTRACTED
+from app.utils.file_operations import atomic_write
+from app.utils.deduplication import find_filehash_by_local_filename
+from app.utils.ocr_planner import (
+    splice_ocr_pages,
+    page_texts_from_result,
+    merge_page_texts,
+    remap_page_indices,
+)
+from app.utils.pdf_text import join_page_texts
+from app.utils.preflight import get_facts, encode_page_set
+from app.utils.result_cache import cache_key, get_cached, put_cached
 
 logger = logging.getLogger(__name__)
 
@@ -24,8 +42,11 @@ AZURE_DOC_INTELLIGENCE_LIMITS = {
     "max_pages": 2000,
 }
 
+# Azure model used for OCR; part of the result cache key
+OCR_MODEL_ID = "prebuilt-read"
+
 def get_pdf_page_count(file_path):
-    """Get the number of pages in a PDF file."""
+    """Get the number of pages in a PDF file (for files without preflight facts)."""
     try:
         with open(file_path, 'rb') as file:
             pdf_reader = PyPDF2.PdfReader(file)
@@ -66,17 +87,184 @@ def check_page_rotation(result, filename):
             
     return rotation_data
 
+def analyze_document(file_path):
+    """
+    Sends a file to Azure Document Intelligence (prebuilt-read) and waits for the result.
+
+    Returns:
+        tuple: (AnalyzeResult, operation id needed to download the searchable PDF)
+    """
+    with outstanding_call(STAGE_OCR), span("azure.analyze_document", file=file_path):
+        with open(file_path, "rb") as f:
+            poller = document_intelligence_client.begin_analyze_document(
+                OCR_MODEL_ID, body=f, output=[AnalyzeOutputOption.PDF]
+            )
+        result: AnalyzeResult = poller.result()
+    record_azure_pages(result)
+    return result, poller.details["operation_id"]
+
+
+def submit_document(file_path):
+    """
+    Starts an Azure Document Intelligence analysis without waiting for it to finish.
+
+    Returns:
+        tuple: (operation id, Operation-Location URL to poll for the result)
+    """
+    operation_location = {}
+
+    def capture_operation_location(pipeline_response):
+        operation_location["url"] = pipeline_response.http_response.headers.get("Operation-Location")
+
+    with span("azure.submit_document", file=file_path), open(file_path, "rb") as f:
+        poller = document_intelligence_client.begin_analyze_document(
+            OCR_MODEL_ID, body=f, output=[AnalyzeOutputOption.PDF],
+            polling=False, raw_response_hook=capture_operation_location,
+        )
+    return poller.details["operation_id"], operation_location.get("url")
+
+
+def get_analysis_status(operation_location):
+    """
+    Polls a submitted analysis once.
+
+    Returns:
+        tuple: (status string, e.g. "running"/"succeeded"/"failed",
+                AnalyzeResult or None, error dict or None)
+    """
+    with span("azure.get_analysis_status"):
+        response = document_intelligence_client.send_request(HttpRequest("GET", operation_location))
+    response.raise_for_status()
+    data = response.json()
+    result = AnalyzeResult(data["analyzeResult"]) if data.get("analyzeResult") else None
+    return data.get("status"), result, data.get("error")
+
+
+def download_searchable_pdf(result, operation_id, target_path):
+    """Downloads the searchable PDF of a finished analysis and atomically replaces `target_path` with it."""
+    with span("azure.download_searchable_pdf", operation_id=operation_id):
+        response = document_intelligence_client.get_analyze_result_pdf(
+            model_id=result.model_id, result_id=operation_id
+        )
+        with atomic_write(target_path, "wb") as writer:
+            writer.writelines(response)
+    logger.info(f"Searchable PDF saved at: {target_path}")
+
+
+def ocr_cache_key(filehash, ocr_pages=None):
+    """
+    Result cache key of the OCR of a document: its content hash (FileRecord.filehash) plus
+    the Azure model, and for the OCR sub-PDF of a partially scanned document its page list.
+    """
+    if ocr_pages is None:
+        return cache_key(filehash, OCR_MODEL_ID)
+    return cache_key(filehash, OCR_MODEL_ID, encode_page_set(ocr_pages))
+
+
+def _lookup_ocr_cache_key(document_path, ocr_pages=None):
+    """`ocr_cache_key` of the document whose working copy is `document_path`, None if it has no FileRecord."""
+    filehash = find_filehash_by_local_filename(document_path)
+    return ocr_cache_key(filehash, ocr_pages) if filehash else None
+
+
+def store_ocr_result(key, content, ocr_page_texts, rotation_data, searchable_pdf_path):
+    """Caches an OCR result (text, page texts, rotation map and searchable PDF) under `key`."""
+    put_cached("ocr", key, {
+        "content": content or "",
+        "page_texts": ocr_page_texts,
+        "rotation_data": rotation_data,
+    }, blob_source=searchable_pdf_path)
+
+
+def splice_partial_ocr(filename, splice_into, ocr_pages, page_texts, ocr_page_texts, rotation_data):
+    """
+    Puts the OCR result of a sub-PDF (only the image-only pages of a document) back into
+    the full document <workdir>/tmp/<splice_into>.
+
+    Returns:
+        tuple: (merged document text, rotation data keyed by page index of the full document)
+    """
+    tmp_dir = os.path.join(settings.workdir, "tmp")
+    subset_path = os.path.join(tmp_dir, filename)
+    with span("pdf.splice_ocr_pages", pages=len(ocr_pages)):
+        splice_ocr_pages(os.path.join(tmp_dir, splice_into), subset_path, ocr_pages)
+    os.remove(subset_path)
+
+    merged_texts = merge_page_texts(get_json(page_texts), get_json(ocr_page_texts), ocr_pages)
+    extracted_text = join_page_texts(merged_texts)
+    return extracted_text, remap_page_indices(rotation_data, ocr_pages)
+
+
+def finish_text_extraction(document_filename, extracted_text, rotation_data):
+    """Checkpoints the OCR'd text of <workdir>/tmp/<document_filename> and triggers page rotation."""
+    logger.info(f"Extracted text for {document_filename}: {len(extracted_text)} characters")
+    checkpoint(working_file(document_filename), STATE_TEXT_EXTRACTED,
+               text_ref=put_text(extracted_text, force=True), rotation_data=rotation_data or {})
+
+    # Trigger page rotation task if rotation is detected, otherwise proceed to metadata extraction.
+    # Large texts travel as a reference to a blob instead of inside the task message.
+    enqueue_next(rotate_pdf_pages, document_filename, pass_text(extracted_text), rotation_data)
+
+
+def continue_after_ocr(filename, content, ocr_page_texts, rotation_data,
+                       splice_into=None, ocr_pages=None, page_texts=None):
+    """
+    Common tail of every OCR path once the searchable PDF is stored at <workdir>/tmp/<filename>:
+    triggers page rotation (which in turn triggers metadata extraction), for partial OCR
+    results after `splice_ocr_result` has spliced them back into the full document.
+
+    Returns:
+        str: filename of the pipeline's document
+    """
+    if splice_into:
+        # Only the image-only pages were OCR'd: put them back into the full document on the CPU queue
+        enqueue_next(splice_ocr_result, filename, splice_into, ocr_pages, put_json(page_texts),
+                     put_json(ocr_page_texts), rotation_data)
+        return splice_into
+    finish_text_extraction(filename, content or "", rotation_data)
+    return filename
+
+
 @celery.task(base=BaseTaskWithRetry)
-def process_with_azure_document_intelligence(filename: str):
+def splice_ocr_result(filename: str, splice_into: str, ocr_pages: list, page_texts, ocr_page_texts,
+                      rotation_data: dict):
+    """
+    Splices the searchable sub-PDF <workdir>/tmp/<filename> back into the full document
+    <workdir>/tmp/<splice_into> and continues the pipeline (see `splice_partial_ocr`).
+    Routed to the CPU queue, unlike the OCR calls of this module.
+    """
+    rotation_data = {int(i): angle for i, angle in (rotation_data or {}).items()}
+    extracted_text, rotation_data = splice_partial_ocr(
+        filename, splice_into, ocr_pages, page_texts, ocr_page_texts, rotation_data
+    )
+    finish_text_extraction(splice_into, extracted_text, rotation_data)
+    return {"file": splice_into, "ocr_pages": len(ocr_pages), "characters": len(extracted_text)}
+
+
+@celery.task(base=BaseTaskWithRetry)
+def process_with_azure_document_intelligence(filename: str, splice_into: str = None,
+                                             ocr_pages: list = None, page_texts: list = None,
+                                             ocr_key: str = None):
     """
     Processes a PDF document using Azure Document Intelligence and overlays OCR text onto
     the local temporary file (stored under <workdir>/tmp).
+
+    For documents where only some pages lack a text layer, `filename` is a sub-PDF with
+    just those pages. `splice_into` then names the full document, `ocr_pages` lists the
+    page index in the full document of every sub-PDF page, and `page_texts` holds the
+    embedded text of all pages of the full document (or a blob reference to them, see
+    app.utils.blob_store.put_json). `ocr_key` is the OCR cache key of `filename` (see
+    `ocr_cache_key`), passed in by the caller or looked up by the document's FileRecord.
+
+    PDFs with more than `azure_ocr_shard_threshold_pages` pages are split into shards
+    that are OCR'd in parallel (see app.tasks.ocr_shards) and merged afterwards.
     
     Steps:
       0. Verify the file meets Azure Document Intelligence service limits
       1. Uploads the document for OCR using Azure Document Intelligence.
       2. Retrieves the processed PDF with embedded text.
-      3. Saves the OCR-processed PDF locally in the same location as before.
+      3. Saves the OCR-processed PDF locally in the same location as before
+         (or splices its pages back into the full document).
       4. Checks for page rotation and triggers page rotation if needed.
       5. Triggers downstream metadata extraction.
     """
@@ -84,55 +272,86 @@ def process_with_azure_document_intelligence(filename: str):
         tmp_file_path = os.path.join(settings.workdir, "tmp", filename)
         if not os.path.exists(tmp_file_path):
             raise FileNotFoundError(f"Local file not found: {tmp_file_path}")
+        # The pipeline's document is the full document, not the OCR sub-PDF
+        document_path = os.path.join(settings.workdir, "tmp", splice_into or filename)
+
+        # Identical content has been OCR'd before: reuse the cached searchable PDF and text
+        ocr_key = ocr_key or _lookup_ocr_cache_key(document_path, ocr_pages if splice_into else None)
+        cached = get_cached("ocr", ocr_key, blob_target=tmp_file_path) if ocr_key else None
+        if cached:
+            rotation_data = {int(i): angle for i, angle in cached["rotation_data"].items()}
+            document_filename = continue_after_ocr(
+                filename, cached["content"], cached["page_texts"] if splice_into else None, rotation_data,
+                splice_into=splice_into, ocr_pages=ocr_pages, page_texts=page_texts,
+            )
+            return {"file": document_filename, "searchable_pdf": document_path, "cache": "hit"}
+
+        # Page count and size of the file to OCR: the preflight facts of the document, or for
+        # the OCR sub-PDF of a partially scanned document its page list and a stat()
+        facts = None if splice_into else get_facts(local_filename=tmp_file_path)
+        if facts:
+            page_count, file_size = facts["page_count"], facts["file_size"]
+        else:
+            page_count = len(ocr_pages) if ocr_pages else None
+            if page_count is None and filename.lower().endswith('.pdf'):
+                page_count = get_pdf_page_count(tmp_file_path)
+            file_size = os.path.getsize(tmp_file_path)
+
+        # Large PDFs are OCR'd as parallel shards, each of which has to respect the limits on its own
+        shard_threshold = settings.azure_ocr_shard_threshold_pages
+        if page_count and shard_threshold and page_count > shard_threshold:
+            from app.tasks.ocr_shards import dispatch_ocr_shards
+            shard_count = dispatch_ocr_shards(filename, page_count, splice_into, ocr_pages, put_json(page_texts),
+                                              cache_key=ocr_key)
+            return {"file": splice_into or filename, "status": "Sharded OCR", "shards": shard_count}
 
         # Check file size against service limits
-        file_size = os.path.getsize(tmp_file_path)
         if file_size > AZURE_DOC_INTELLIGENCE_LIMITS["max_file_size_bytes"]:
             error_msg = f"File size ({file_size / (1024 * 1024):.2f} MB) exceeds Azure Document Intelligence limit of 500 MB"
             logger.error(error_msg)
+            fail_pipeline(document_path, error_msg)
             return {"error": error_msg, "file": filename, "status": "Failed - Size limit exceeded"}
 
         # For PDF files, check page count against service limits
         # "Fail open" approach: only reject if we're sure it exceeds the limit
         if filename.lower().endswith('.pdf'):
-            page_count = get_pdf_page_count(tmp_file_path)
             if page_count is not None and page_count > AZURE_DOC_INTELLIGENCE_LIMITS["max_pages"]:
                 error_msg = f"PDF page count ({page_count}) exceeds Azure Document Intelligence limit of 2000 pages"
                 logger.error(error_msg)
+                fail_pipeline(document_path, error_msg)
                 return {"error": error_msg, "file": filename, "status": "Failed - Page limit exceeded"}
             if page_count is None:
                 logger.warning(f"Could not determine page count for {filename}, proceeding with processing anyway")
 
         logger.info(f"Processing {filename} with Azure Document Intelligence OCR.")
 
-        # Open and send the document for processing
-        with open(tmp_file_path, "rb") as f:
-            poller = document_intelligence_client.begin_analyze_document(
-                "prebuilt-read", body=f, output=[AnalyzeOutputOption.PDF]
-            )
-        result: AnalyzeResult = poller.result()
-        operation_id = poller.details["operation_id"]
+        if settings.azure_ocr_async:
+            # Submit now; the periodic collector picks up the result and resumes the pipeline
+            from app.tasks.collect_azure_ocr_results import register_pending_ocr
+            operation_id, operation_location = submit_document(tmp_file_path)
+            register_pending_ocr(operation_id, operation_location, filename,
+                                 splice_into=splice_into, ocr_pages=ocr_pages, page_texts=put_json(page_texts),
+                                 cache_key=ocr_key)
+            return {"file": splice_into or filename, "status": "OCR submitted", "operation_id": operation_id}
+
+        # Send the document for processing and wait for the result
+        result, operation_id = analyze_document(tmp_file_path)
 
         # Check and log page rotation information
         rotation_data = check_page_rotation(result, filename)
 
-        # Retrieve the processed searchable PDF
-        response = document_intelligence_client.get_analyze_result_pdf(
-            model_id=result.model_id, result_id=operation_id
-        )
-        searchable_pdf_path = tmp_file_path  # Overwrite the original PDF location
-        with open(searchable_pdf_path, "wb") as writer:
-            writer.writelines(response)
-        logger.info(f"Searchable PDF saved at: {searchable_pdf_path}")
+        # Retrieve the processed searchable PDF, replacing the original PDF location
+        download_searchable_pdf(result, operation_id, tmp_file_path)
+        ocr_page_texts = page_texts_from_result(result)
+        if ocr_key:
+            store_ocr_result(ocr_key, result.content, ocr_page_texts, rotation_data, tmp_file_path)
 
-        # Extract raw text content from the result
-        extracted_text = result.content if result.content else ""
-        logger.info(f"Extracted text for {filename}: {len(extracted_text)} characters")
-
-        # Trigger page rotation task if rotation is detected, otherwise proceed to metadata extraction
-        rotate_pdf_pages.delay(filename, extracted_text, rotation_data)
+        document_filename = continue_after_ocr(
+            filename, result.content, ocr_page_texts if splice_into else None, rotation_data,
+            splice_into=splice_into, ocr_pages=ocr_pages, page_texts=page_texts,
+        )
 
-        return {"file": filename, "searchable_pdf": searchable_pdf_path, "cleaned_text": extracted_text}
+        return {"file": document_filename, "searchable_pdf": document_path, "characters": len(result.content or "")}
     except Exception as e:
         logger.error(f"Error processing {filename} with Azure Document Intelligence: {e}")
         raise
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+from app.celery_app import celery
+from app.utils.blob_store import purge_expired_blobs
+
+
+@celery.task
+def purge_blobs():
+    """Periodically removes text blobs (see app.utils.blob_store) of finished or abandoned pipelines."""
+    return {"purged": purge_expired_blobs()}
@@ -3,9 +3,15 @@
 from app.config import settings
 import openai
 from app.tasks.retry_config import BaseTaskWithRetry
+from app.utils.admission import outstanding_call, STAGE_LLM
+from app.utils.blob_store import get_text
+from app.utils.metrics import record_openai_usage
+from app.utils.tracing import span
+from app.utils.result_cache import cache_key, text_digest, get_cached, put_cached
 
 # Import the shared Celery instance
 from app.celery_app import celery
+from app.tasks.pipeline import enqueue_next, pass_text
 
 # Initialize OpenAI client dynamically
 client = openai.OpenAI(
@@ -13,22 +19,38 @@ client = openai.OpenAI(
     base_url=settings.openai_base_url
 )
 
+REFINE_PROMPT = "Clean and format the following text. The idea is that the text you see comes from an OCR system and your task is to eliminate OCR errors. Keep the original language when doing so."
+
 @celery.task(base=BaseTaskWithRetry)
 def refine_text_with_gpt(filename: str, raw_text: str):
-    """Uses OpenAI to clean and refine OCR text."""
-    response = client.chat.completions.create(
-        model=settings.openai_model,
-        messages=[
-            {"role": "system", "content": "Clean and format the following text. The idea is that the text you see comes from an OCR system and your task is to eliminate OCR errors. Keep the original language when doing so."},
-            {"role": "user", "content": raw_text}
-        ]
-    )
-    
-    cleaned_text = response.choices[0].message.content
+    """
+    Uses OpenAI to clean and refine OCR text.
+    `raw_text` may be a blob reference (see app.utils.blob_store); so is the cleaned text passed on.
+    """
+    raw_text = get_text(raw_text)
+    # Same text, prompt and model: reuse the previous answer
+    key = cache_key(text_digest(REFINE_PROMPT + raw_text), settings.openai_model)
+    cached = get_cached("refine", key)
+    if cached:
+        cleaned_text = cached["cleaned_text"]
+    else:
+        with outstanding_call(STAGE_LLM), span("openai.refine", model=settings.openai_model):
+            response = client.chat.completions.create(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": REFINE_PROMPT},
+                    {"role": "user", "content": raw_text}
+                ]
+            )
+        record_openai_usage("refine", response)
+
+        cleaned_text = response.choices[0].message.content
+        put_cached("refine", key, {"cleaned_text": cleaned_text})
 
     # Trigger next task (import locally if needed to avoid circular imports)
     from app.tasks.extract_metadata_with_gpt import extract_metadata_with_gpt
-    extract_metadata_with_gpt.delay(filename, cleaned_text)
+    cleaned_text_ref = pass_text(cleaned_text)
+    enqueue_next(extract_metadata_with_gpt, filename, cleaned_text_ref)
 
-    return {"filename": filename, "cleaned_text": cleaned_text}
+    return {"filename": filename, "cleaned_text": cleaned_text_ref}
 
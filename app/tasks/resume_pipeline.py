@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import logging
+import importlib
+
+from app.celery_app import celery
+from app.database import SessionLocal
+from app.models import FileRecord
+from app.tasks.pipeline import enqueue
+from app.utils.blob_store import blob_exists
+from app.utils.deduplication import acquire_pipeline_lease, release_pipeline_lease
+from app.utils.file_operations import stage_file
+from app.utils.pipeline_state import (
+    get_state,
+    fail_pipeline,
+    record_upload,
+    STATE_STAGED,
+    STATE_TEXT_EXTRACTED,
+    STATE_PDF_READY,
+    STATE_METADATA_EXTRACTED,
+    STATE_EMBEDDED,
+    STATE_COMPLETED,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _retry_failed_uploads(file_id, state, filehash):
+    """Re-queues the uploads of a completed document that failed."""
+    processed_file = state["processed_file"]
+    failed = [name for name, status in state["uploads"].items() if status == "failure"]
+    try:
+        if failed and not (processed_file and os.path.exists(processed_file)):
+            return {"file_id": file_id, "error": f"Processed file {processed_file} not found"}
+        for destination in failed:
+            module = importlib.import_module(f"app.tasks.upload_to_{destination}")
+            enqueue(getattr(module, f"upload_to_{destination}"), processed_file)
+            record_upload(processed_file, destination, "queued")
+    finally:
+        release_pipeline_lease(filehash)
+    return {"file_id": file_id, "status": "Uploads re-queued" if failed else "Already completed",
+            "uploads": failed}
+
+
+def resume_document(file_id: int, source_file: str = None):
+    """
+    Continues the pipeline of a document after the last step it completed
+    (see app.utils.pipeline_state). The caller must hold the document's pipeline lease;
+    the resumed pipeline releases it like any other.
+
+    Steps whose inputs are gone fall back to an earlier step: a purged text blob means
+    extracting the text again, a missing working copy means staging the document again
+    from `source_file` (e.g. the same file arriving once more).
+    """
+    from app.tasks.process_document import start_text_extraction
+    from app.tasks.rotate_pdf_pages import rotate_pdf_pages
+    from app.tasks.extract_metadata_with_gpt import extract_metadata_with_gpt
+    from app.tasks.embed_metadata_into_pdf import embed_metadata_into_pdf
+    from app.tasks.finalize_document_storage import finalize_document_storage
+
+    with SessionLocal() as db:
+        record = db.get(FileRecord, file_id)
+        if record is None:
+            return {"file_id": file_id, "error": "File not found"}
+        filehash, local_filename, file_size = record.filehash, record.local_filename, record.file_size
+
+    state = get_state(file_id) or {"state": STATE_STAGED, "working_file": local_filename}
+    step = state["state"]
+    if step == STATE_COMPLETED:
+        return _retry_failed_uploads(file_id, state, filehash)
+
+    working_file = state["working_file"] or local_filename
+    filename = os.path.basename(working_file)
+    has_working_file = os.path.exists(working_file)
+    text_ref = state.get("text_ref")
+    has_text = blob_exists(text_ref)
+    metadata = state.get("metadata")
+    processed_file = state.get("processed_file")
+    # Detected angles of pages that are not turned yet (deferred to the metadata save)
+    pending_rotations = state.get("rotation_data") or None
+
+    logger.info(f"Resuming pipeline of file {file_id} after {step}")
+    if step == STATE_EMBEDDED and processed_file and os.path.exists(processed_file):
+        # Optimization is skipped: the processed file may have been optimized already
+        enqueue(finalize_document_storage, working_file, processed_file, metadata)
+        return {"file_id": file_id, "resumed_from": step, "status": "Queued for final storage"}
+
+    if has_working_file:
+        if step in (STATE_EMBEDDED, STATE_METADATA_EXTRACTED) and metadata:
+            enqueue(embed_metadata_into_pdf, working_file, text_ref if has_text else "", metadata,
+                    rotation_data=pending_rotations)
+            return {"file_id": file_id, "resumed_from": step, "status": "Queued for embedding"}
+        if step == STATE_PDF_READY and has_text:
+            enqueue(extract_metadata_with_gpt, filename, text_ref, rotation_data=pending_rotations)
+            return {"file_id": file_id, "resumed_from": step, "status": "Queued for metadata extraction"}
+        if step == STATE_TEXT_EXTRACTED and has_text:
+            enqueue(rotate_pdf_pages, filename, text_ref, pending_rotations)
+            return {"file_id": file_id, "resumed_from": step, "status": "Queued for rotation"}
+    elif source_file and os.path.exists(source_file):
+        os.makedirs(os.path.dirname(working_file), exist_ok=True)
+        stage_file(source_file, working_file, keep_source=True)
+    else:
+        error = f"Working copy {working_file} is gone and no source file was given"
+        fail_pipeline(working_file, error)
+        return {"file_id": file_id, "error": error}
+
+    # Nothing usable after staging: extract the text again
+    result = start_text_extraction(source_file or working_file, working_file, file_size, filehash)
+    result.update({"file_id": file_id, "resumed_from": step})
+    return result
+
+
+@celery.task
+def resume_pipeline(file_id: int):
+    """Resumes a failed or interrupted document pipeline from its last checkpoint."""
+    with SessionLocal() as db:
+        record = db.get(FileRecord, file_id)
+        if record is None:
+            return {"file_id": file_id, "error": "File not found"}
+        filehash = record.filehash
+
+    lease_owner = acquire_pipeline_lease(filehash, resume_pipeline.request.id or f"resume-{file_id}")
+    if lease_owner:
+        return {"file_id": file_id, "status": "in_progress", "pipeline_task_id": lease_owner}
+    return resume_document(file_id)
@@ -15,6 +15,9 @@ from app.tasks.upload_to_email import upload_to_email
 from app.tasks.upload_to_onedrive import upload_to_onedrive
 from app.tasks.upload_to_s3 import upload_to_s3
 from app.celery_app import celery
+from app.tasks.pipeline import enqueue
+from app.utils.deduplication import release_pipeline_lease
+from app.utils.pipeline_state import complete_pipeline
 
 logger = logging.getLogger(__name__)
 
@@ -68,8 +71,13 @@ def _should_upload_to_s3():
             settings.aws_secret_access_key)
 
 @celery.task(base=BaseTaskWithRetry)
-def send_to_all_destinations(file_path: str):
-    """Distribute a file to all configured storage destinations."""
+def send_to_all_destinations(file_path: str, filehash: str = None):
+    """
+    Distribute a file to all configured storage destinations.
+
+    If `filehash` is given, this is the last step of a document pipeline and the
+    pipeline lease for that hash is released once all uploads are queued.
+    """
     
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
@@ -135,11 +143,15 @@ def send_to_all_destinations(file_path: str):
     for service in services:
         if service["should_upload"]():
             logger.info(f"Queueing {file_path} for {service['name']} upload")
-            task = service["upload_func"].delay(file_path)
+            task = enqueue(service["upload_func"], file_path)
             results[f"{service['name']}_task_id"] = task.id
-    
-    return {
+
+    result = {
         "status": "Queued",
         "file_path": file_path,
         "tasks": results
     }
+    if filehash:
+        complete_pipeline(file_path, {name[:-len("_task_id")]: "queued" for name in results})
+        release_pipeline_lease(filehash, result=result)
+    return result
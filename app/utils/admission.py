@@ -0,0 +1,107 @@
+"""
+Admission control for the ingestion paths (web/API uploads, IMAP, /api/processall).
+
+A new document is only admitted while every stage of the pipeline is within its in-flight
+budget:
+  - the depth of each stage queue (pdf, ocr, llm, upload) must be below
+    `admission_max_queue_depth`; only the document's own priority lane and the lanes
+    served before it count, so a bulk backlog never blocks uploads or IMAP
+  - the number of outstanding Azure Document Intelligence operations (blocking calls plus
+    operations waiting for the async collector) must be below `admission_max_outstanding_ocr`
+  - the number of outstanding OpenAI calls must be below `admission_max_outstanding_llm`
+
+Bulk jobs only get `admission_bulk_share` of each budget, the rest is headroom for
+interactive uploads and IMAP. When the budget is exhausted the API answers 429 with a Retry-After header, IMAP leaves
+the remaining mails in the inbox for the next poll, and bulk jobs defer the rest of their
+files. This keeps Redis memory and third-party rate limits under control during bursts.
+
+Outstanding calls are tracked in Redis sorted sets (one member per call, scored by its
+start time), so calls of crashed workers age out after `admission_call_stale_seconds`.
+Admission control fails open if Redis cannot be reached.
+"""
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+
+import redis
+
+from app.config import settings
+from app.utils.priority_lanes import queue_depth, PRIORITY_IMAP, PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+OUTSTANDING_KEY_PREFIX = "outstanding_calls:"
+STAGE_OCR = "ocr"
+STAGE_LLM = "llm"
+
+redis_client = redis.StrictRedis.from_url(settings.redis_url, decode_responses=True)
+
+
+@contextmanager
+def outstanding_call(stage):
+    """Counts the enclosed block as an outstanding third-party call of `stage` ("ocr"/"llm")."""
+    key = OUTSTANDING_KEY_PREFIX + stage
+    member = uuid.uuid4().hex
+    try:
+        redis_client.zadd(key, {member: time.time()})
+    except redis.RedisError as e:
+        logger.warning(f"Could not track outstanding {stage} call: {e}")
+    try:
+        yield
+    finally:
+        try:
+            redis_client.zrem(key, member)
+        except redis.RedisError:
+            pass
+
+
+def outstanding_calls(stage):
+    """Number of outstanding calls of `stage`, ignoring entries of crashed workers."""
+    key = OUTSTANDING_KEY_PREFIX + stage
+    redis_client.zremrangebyscore(key, "-inf", time.time() - settings.admission_call_stale_seconds)
+    return redis_client.zcard(key)
+
+
+def _budget(limit, priority):
+    """The part of a budget a lane may use: bulk jobs leave headroom for the other lanes."""
+    if priority >= PRIORITY_BULK:
+        return max(1, int(limit * settings.admission_bulk_share))
+    return limit
+
+
+def check_admission(priority=PRIORITY_IMAP):
+    """
+    Checks whether a new document of the given priority lane (see app.utils.priority_lanes)
+    may enter the pipeline.
+
+    Returns:
+        dict or None: None if admitted, otherwise {"stage", "reason", "retry_after"}
+    """
+    if not settings.admission_control_enabled:
+        return None
+
+    from app.celery_app import QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD
+    from app.tasks.collect_azure_ocr_results import PENDING_KEY
+
+    def refuse(stage, reason):
+        logger.info(f"Admission refused: {reason}")
+        return {"stage": stage, "reason": reason, "retry_after": settings.admission_retry_after_seconds}
+
+    try:
+        for queue in (QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD):
+            depth = queue_depth(queue, max_priority=priority)
+            if depth >= _budget(settings.admission_max_queue_depth, priority):
+                return refuse(queue, f"{depth} tasks queued for {queue}")
+
+        ocr_calls = outstanding_calls(STAGE_OCR) + redis_client.hlen(PENDING_KEY)
+        if ocr_calls >= _budget(settings.admission_max_outstanding_ocr, priority):
+            return refuse(STAGE_OCR, f"{ocr_calls} Azure operations outstanding")
+
+        llm_calls = outstanding_calls(STAGE_LLM)
+        if llm_calls >= _budget(settings.admission_max_outstanding_llm, priority):
+            return refuse(STAGE_LLM, f"{llm_calls} OpenAI calls outstanding")
+    except redis.RedisError as e:
+        logger.warning(f"Admission control unavailable, admitting: {e}")
+
+    return None
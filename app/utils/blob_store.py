@@ -0,0 +1,138 @@
+"""
+Claim-check store for large text payloads passed between Celery tasks.
+
+Instead of sending a document's full text through Redis with every task message (and again
+with every task result), the sender stores it once under <workdir>/blobs and passes a short
+reference such as ``blob://<sha256>.zz``. Texts below `blob_inline_threshold_bytes` are
+passed inline as before, so a task argument is always either the text itself or a reference;
+`get_text` accepts both. `put_json`/`get_json` do the same for other payloads, such as the
+per-page texts of a document.
+
+Blobs are compressed with zstd when the `zstandard` package is installed and with zlib
+otherwise. The file extension records the codec, and blobs are content-addressed, so the
+same text is stored only once. `purge_expired_blobs` removes blobs older than
+`blob_ttl_seconds`.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import logging
+
+from app.config import settings
+from app.utils.file_operations import atomic_write
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zlib is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+BLOB_REF_PREFIX = "blob://"
+BLOB_REF_PATTERN = re.compile(r"^blob://([0-9a-f]{64}\.(?:zst|zz))$")
+
+
+def _blob_dir():
+    return os.path.join(settings.workdir, "blobs")
+
+
+def is_blob_ref(value):
+    """True if `value` is a reference created by `put_text`."""
+    return isinstance(value, str) and BLOB_REF_PATTERN.match(value) is not None
+
+
+def put_text(text, force=False):
+    """
+    Returns what to pass to the next task for `text`: the text itself if it is small,
+    otherwise a reference to a compressed blob. With `force`, small texts are stored as
+    a blob as well (for references that are kept, like pipeline checkpoints).
+    """
+    if text is None or is_blob_ref(text):
+        return text
+    data = text.encode("utf-8")
+    if len(data) < settings.blob_inline_threshold_bytes and not force:
+        return text
+
+    if zstandard is not None:
+        name, compressed = f"{hashlib.sha256(data).hexdigest()}.zst", zstandard.ZstdCompressor(level=3).compress(data)
+    else:
+        name, compressed = f"{hashlib.sha256(data).hexdigest()}.zz", zlib.compress(data, 6)
+
+    os.makedirs(_blob_dir(), exist_ok=True)
+    blob_path = os.path.join(_blob_dir(), name)
+    if os.path.exists(blob_path):
+        # Same content already stored; refresh it so the purge doesn't remove it early
+        os.utime(blob_path)
+    else:
+        with atomic_write(blob_path, "wb") as f:
+            f.write(compressed)
+        logger.info(f"Stored {len(data)} bytes of text as {name} ({len(compressed)} bytes compressed)")
+    return BLOB_REF_PREFIX + name
+
+
+def blob_exists(value):
+    """True if `value` is a reference whose blob is still stored (i.e. not purged yet)."""
+    match = BLOB_REF_PATTERN.match(value) if isinstance(value, str) else None
+    return match is not None and os.path.exists(os.path.join(_blob_dir(), match.group(1)))
+
+
+def get_text(value):
+    """Resolves a value produced by `put_text` (a reference or an inline text) to the text."""
+    match = BLOB_REF_PATTERN.match(value) if isinstance(value, str) else None
+    if not match:
+        return value
+
+    name = match.group(1)
+    with open(os.path.join(_blob_dir(), name), "rb") as f:
+        compressed = f.read()
+    if name.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"Blob {name} is zstd-compressed but the zstandard package is not installed")
+        data = zstandard.ZstdDecompressor().decompress(compressed)
+    else:
+        data = zlib.decompress(compressed)
+    return data.decode("utf-8")
+
+
+def put_json(value, force=False):
+    """
+    Like `put_text` for JSON-serializable values (e.g. a list of page texts): returns the
+    value itself if its JSON is small, otherwise a reference to a blob holding the JSON.
+    """
+    if value is None or is_blob_ref(value):
+        return value
+    text = json.dumps(value, ensure_ascii=False)
+    ref = put_text(text, force=force)
+    return value if ref == text else ref
+
+
+def get_json(value):
+    """Resolves a value produced by `put_json` (a reference or the value itself)."""
+    return json.loads(get_text(value)) if is_blob_ref(value) else value
+
+
+def purge_expired_blobs(max_age_seconds=None):
+    """
+    Deletes blobs that have not been written for `max_age_seconds` (default: `blob_ttl_seconds`).
+
+    Returns:
+        int: number of deleted blobs
+    """
+    max_age_seconds = settings.blob_ttl_seconds if max_age_seconds is None else max_age_seconds
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    if not os.path.isdir(_blob_dir()):
+        return removed
+    for entry in os.scandir(_blob_dir()):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info(f"Purged {removed} expired text blobs")
+    return removed
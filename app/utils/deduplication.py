@@ -0,0 +1,262 @@
+"""
+Helpers to detect duplicate documents at ingestion time, before anything is enqueued.
+
+A file is considered a duplicate if its SHA-256 hash is either already stored in the
+`files` table (FileRecord.filehash) by a pipeline that did not fail or stall (a re-upload of
+a failed document goes through, so `process_document` resumes its pipeline), or is
+currently "in flight", i.e. it has been
+enqueued by an ingestion path but `process_document` has not created its FileRecord yet.
+In-flight hashes are tracked in a Redis sorted set scored by the time they were added,
+so entries of pipelines that died before reaching the database expire automatically.
+
+Once a document is inside the pipeline, a per-hash lease makes sure only one pipeline
+runs for identical content at a time, from `process_document` until
+`send_to_all_destinations` has queued the uploads. The lease holds the id of the task
+that took it; that owner token travels with every task the pipeline enqueues (in a
+message header), and only a holder of the token can release the lease.
+"""
+import json
+import time
+import logging
+import contextvars
+
+import redis
+from celery.signals import before_task_publish, task_prerun
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import FileRecord, PipelineState
+from app.utils.pipeline_state import STATUS_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+INFLIGHT_HASHES_KEY = "inflight_filehashes"
+
+redis_client = redis.StrictRedis.from_url(settings.redis_url, decode_responses=True)
+
+
+def _prune_expired(now=None):
+    """Drop in-flight entries older than the configured TTL."""
+    now = now or time.time()
+    redis_client.zremrangebyscore(INFLIGHT_HASHES_KEY, "-inf", now - settings.inflight_hash_ttl_seconds)
+
+
+def find_existing_file_id(filehash, completed_only=False):
+    """
+    Returns the id of the FileRecord with the given hash, or None.
+
+    With `completed_only`, records whose pipeline has not completed are ignored (records
+    without a pipeline state predate checkpoints and count as completed).
+    """
+    with SessionLocal() as db:
+        query = db.query(FileRecord.id).filter(FileRecord.filehash == filehash)
+        if completed_only:
+            query = query.outerjoin(PipelineState, PipelineState.file_id == FileRecord.id).filter(
+                (PipelineState.status == None) | (PipelineState.status == STATUS_COMPLETED)  # noqa: E711
+            )
+        existing = query.one_or_none()
+        return existing.id if existing else None
+
+
+def claim_ingestion(filehash):
+    """
+    Checks whether a file with this hash may be enqueued and, if so, marks it as in flight.
+
+    Returns:
+        dict or None: None if the file is new and has been claimed for processing,
+        otherwise a dict describing the duplicate:
+          {"status": "duplicate_file", "file_id": <id>}  -> already processed
+          {"status": "duplicate_in_flight", "file_id": None} -> currently queued/processing
+        A file whose earlier pipeline failed or stalled is claimed like a new one, so that
+        `process_document` picks the pipeline up again from its last checkpoint.
+    """
+    file_id = find_existing_file_id(filehash, completed_only=True)
+    if file_id is not None:
+        return {"status": "duplicate_file", "file_id": file_id}
+
+    try:
+        _prune_expired()
+        # ZADD NX returns 1 only if the hash was not in the set yet (atomic check-and-set)
+        added = redis_client.zadd(INFLIGHT_HASHES_KEY, {filehash: time.time()}, nx=True)
+    except redis.RedisError as e:
+        # Fail open: a Redis hiccup must not block ingestion, process_document still dedups
+        logger.warning(f"Could not check in-flight hashes in Redis: {e}")
+        return None
+
+    if not added:
+        return {"status": "duplicate_in_flight", "file_id": None}
+    return None
+
+
+def release_ingestion(*filehashes):
+    """
+    Removes hashes from the in-flight set (once they have a FileRecord or were rejected).
+    None entries are ignored, e.g. the source hash of a document that was not converted.
+    """
+    filehashes = [filehash for filehash in filehashes if filehash]
+    if not filehashes:
+        return
+    try:
+        redis_client.zrem(INFLIGHT_HASHES_KEY, *filehashes)
+    except redis.RedisError as e:
+        logger.warning(f"Could not remove {', '.join(h[:10] for h in filehashes)}... from in-flight hashes: {e}")
+
+
+# ---------------------------------------------------------------------------
+# Pipeline lease: one running pipeline per file hash across the whole cluster
+# ---------------------------------------------------------------------------
+
+PIPELINE_LEASE_PREFIX = "pipeline_lease:"
+PIPELINE_RESULT_PREFIX = "pipeline_result:"
+LEASE_OWNER_HEADER = "pipeline_lease_owner"
+
+# Deletes the lease only if it is still held by the given owner (and stores the result
+# for attached arrivals), so a stale task cannot release a lease another pipeline took
+# after this one expired.
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] ~= '' then
+    redis.call('set', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return redis.call('del', KEYS[1])
+"""
+
+# Extends the lease only if it is still held by the given owner
+REFRESH_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('expire', KEYS[1], ARGV[2])
+"""
+
+_lease_owner = contextvars.ContextVar("pipeline_lease_owner", default=None)
+
+
+def current_lease_owner():
+    """Owner token of the pipeline lease the running task works under, None if unknown."""
+    return _lease_owner.get()
+
+
+@before_task_publish.connect
+def _stamp_lease_owner(headers=None, **kwargs):
+    owner = _lease_owner.get()
+    if headers is not None and owner:
+        headers.setdefault(LEASE_OWNER_HEADER, owner)
+
+
+@task_prerun.connect
+def _enter_lease(task=None, **kwargs):
+    """Makes the lease owner of the task's pipeline the current one."""
+    request = task.request
+    _lease_owner.set(getattr(request, LEASE_OWNER_HEADER, None) or (request.headers or {}).get(LEASE_OWNER_HEADER))
+
+
+def acquire_pipeline_lease(filehash, owner):
+    """
+    Tries to take the pipeline lease for `filehash` on behalf of `owner` (a task id).
+
+    The lease is re-entrant for the same owner, so a retried `process_document`
+    keeps its lease instead of locking itself out.
+
+    Returns:
+        str or None: None if the lease is now held by `owner`, otherwise the id of
+        the task that currently owns the running pipeline.
+    """
+    key = PIPELINE_LEASE_PREFIX + filehash
+    ttl = settings.pipeline_lease_ttl_seconds
+    try:
+        if redis_client.set(key, owner, nx=True, ex=ttl):
+            current_owner = None
+        else:
+            current_owner = redis_client.get(key)
+            if current_owner is None:
+                # Lease expired between SET and GET, try once more
+                current_owner = None if redis_client.set(key, owner, nx=True, ex=ttl) else redis_client.get(key)
+            elif current_owner == owner:
+                redis_client.expire(key, ttl)
+                current_owner = None
+    except redis.RedisError as e:
+        # Fail open: the unique constraint on FileRecord.filehash is the last line of defence
+        logger.warning(f"Could not acquire pipeline lease for {filehash[:10]}...: {e}")
+        current_owner = None
+    if current_owner is None:
+        # Everything this task enqueues from here on carries the owner token
+        _lease_owner.set(owner)
+    return current_owner
+
+
+def release_pipeline_lease(filehash, result=None, owner=None):
+    """
+    Releases the pipeline lease for `filehash` if it is held by `owner` (by default the
+    owner of the pipeline the running task belongs to).
+
+    If a `result` dict is given it is kept for a while under a separate key, so
+    arrivals that attached to the running pipeline can look up how it ended.
+
+    Returns:
+        bool: Whether the lease was released
+    """
+    owner = owner or _lease_owner.get()
+    if not owner:
+        # Tasks enqueued before owner tokens existed; the lease expires on its own
+        logger.warning(f"Not releasing pipeline lease for {filehash[:10]}...: owner unknown")
+        return False
+    try:
+        released = redis_client.eval(
+            RELEASE_LEASE_SCRIPT, 2, PIPELINE_LEASE_PREFIX + filehash, PIPELINE_RESULT_PREFIX + filehash,
+            owner, json.dumps(result) if result is not None else "", settings.pipeline_lease_ttl_seconds,
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Could not release pipeline lease for {filehash[:10]}...: {e}")
+        return False
+    if not released:
+        logger.warning(f"Not releasing pipeline lease for {filehash[:10]}...: held by another pipeline")
+    return bool(released)
+
+
+def refresh_pipeline_lease(filehash, owner=None):
+    """
+    Extends the pipeline lease for `filehash` by another `pipeline_lease_ttl_seconds` if it
+    is held by `owner` (by default the owner of the running task's pipeline). Called on
+    every checkpoint, so long pipelines keep their lease.
+
+    Returns:
+        bool: Whether the lease was extended
+    """
+    owner = owner or _lease_owner.get()
+    if not owner:
+        return False
+    try:
+        return bool(redis_client.eval(REFRESH_LEASE_SCRIPT, 1, PIPELINE_LEASE_PREFIX + filehash, owner,
+                                      settings.pipeline_lease_ttl_seconds))
+    except redis.RedisError as e:
+        logger.warning(f"Could not refresh pipeline lease for {filehash[:10]}...: {e}")
+        return False
+
+
+def get_pipeline_result(filehash):
+    """Returns the stored result of the last pipeline run for `filehash`, if any."""
+    try:
+        raw = redis_client.get(PIPELINE_RESULT_PREFIX + filehash)
+    except redis.RedisError:
+        return None
+    return json.loads(raw) if raw else None
+
+
+def find_filehash_by_local_filename(local_filename):
+    """
+    Maps the working copy of a document (<workdir>/tmp/<uuid>.pdf) back to its
+    content hash. Downstream tasks only know the file name, not the hash.
+    """
+    with SessionLocal() as db:
+        record = db.query(FileRecord.filehash).filter_by(local_filename=local_filename).first()
+        return record.filehash if record else None
+
+
+def release_pipeline_lease_for_file(local_filename, result=None, owner=None):
+    """Releases the lease of the pipeline working on `local_filename` (used on terminal failures)."""
+    filehash = find_filehash_by_local_filename(local_filename)
+    if filehash:
+        release_pipeline_lease(filehash, result=result, owner=owner)
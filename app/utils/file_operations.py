@@ -1,4 +1,22 @@
+import os
+import time
+import errno
+import shutil
 import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl  # Only available on Unix; needed for reflinks
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ioctl request number of FICLONE (linux/fs.h), clones a file's extents copy-on-write
+FICLONE = 0x40049409
+
 
 def hash_file(filepath, chunk_size=65536):
     """
@@ -13,3 +31,105 @@ def hash_file(filepath, chunk_size=65536):
                 break
             sha256.update(data)
     return sha256.hexdigest()
+
+
+def _reflink(src, dst):
+    """Clones `src` into `dst` copy-on-write (btrfs, XFS, ...). Raises OSError if unsupported."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+
+def stage_file(src, dst, keep_source=True, allow_hardlink=True):
+    """
+    Places the file `src` at `dst` as cheaply as the filesystem allows.
+
+    Strategies, cheapest first:
+      - "rename":   atomic rename, only if `keep_source` is False (the source is consumed)
+      - "reflink":  copy-on-write clone, the two files share blocks until one is modified
+      - "hardlink": second name for the same inode, only if `allow_hardlink` is True.
+                    Callers must then replace the file (see `atomic_write`) instead of
+                    modifying it in place, or the change would show up in `src` as well.
+      - "copy":     full copy, used when source and target are on different devices
+
+    Returns:
+        str: the strategy that was used
+    """
+    start = time.monotonic()
+    strategy = None
+
+    if not keep_source:
+        try:
+            os.replace(src, dst)
+            strategy = "rename"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    if strategy is None:
+        try:
+            _reflink(src, dst)
+            strategy = "reflink"
+        except OSError:
+            pass
+
+    if strategy is None and allow_hardlink:
+        try:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            strategy = "hardlink"
+        except OSError:
+            pass
+
+    if strategy is None:
+        shutil.copy2(src, dst)
+        strategy = "copy"
+        if not keep_source:
+            os.remove(src)
+
+    logger.info(f"Staged {src} -> {dst} via {strategy} in {(time.monotonic() - start) * 1000:.1f} ms")
+    return strategy
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Context manager that yields the path of a temporary file next to `path` and
+    atomically replaces `path` with it when the block completes without error.
+    Readers never see a half-written file, and because the old inode is replaced
+    rather than modified, hard links created by `stage_file` keep their original
+    content. Useful for libraries that write to a filename themselves
+    (e.g. PyMuPDF's Document.save).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+    try:
+        # mkstemp creates 0600 files; keep the permissions a regular open() would give
+        if os.path.exists(path):
+            os.fchmod(fd, os.stat(path).st_mode & 0o777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(fd, 0o666 & ~umask)
+        os.close(fd)
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def atomic_write(path, mode="wb", **kwargs):
+    """Like `atomic_path`, but yields an open file object for the temporary file."""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
@@ -1,17 +1,94 @@
+"""
+Progress log of pipeline tasks (`ProcessingLog`).
+
+Rows are not written one at a time: each process buffers them and a background thread
+bulk-inserts them in one transaction once `processing_log_batch_size` rows are waiting or
+`processing_log_flush_seconds` have passed, so workers don't queue up on the database lock
+with a commit per step. The buffer is flushed when a worker shuts down and at exit.
+With `processing_log_batch_size` set to 1, every row is written right away.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+
+from celery.signals import worker_shutdown, worker_process_shutdown
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.config import settings
 from app.database import SessionLocal
 from app.models import ProcessingLog
 
+logger = logging.getLogger(__name__)
+
+_buffer = []
+_lock = threading.Lock()
+_flusher_pid = None
+
+
 def log_task_progress(task_id, step_name, status, message=None, file_id=None):
     """
     Logs the progress of a Celery task to the database.
     """
-    with SessionLocal() as db:
-        log_entry = ProcessingLog(
-            task_id=task_id,
-            step_name=step_name,
-            status=status,
-            message=message,
-            file_id=file_id,
-        )
-        db.add(log_entry)
-        db.commit()
+    row = {
+        "task_id": task_id,
+        "step_name": step_name,
+        "status": status,
+        "message": message,
+        "file_id": file_id,
+        "timestamp": datetime.now(timezone.utc),
+    }
+    with _lock:
+        _buffer.append(row)
+        pending = len(_buffer)
+    if pending >= settings.processing_log_batch_size:
+        flush_processing_log()
+    else:
+        _ensure_flusher()
+
+
+def flush_processing_log():
+    """Writes all buffered rows in one transaction. Returns the number of rows written."""
+    with _lock:
+        if not _buffer:
+            return 0
+        rows = _buffer[:]
+        del _buffer[:]
+    try:
+        with SessionLocal() as db:
+            db.execute(insert(ProcessingLog), rows)
+            db.commit()
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not write {len(rows)} processing log rows: {e}")
+        return 0
+    return len(rows)
+
+
+def _ensure_flusher():
+    """Starts the background flush thread of this process (again after a fork)."""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_periodically, name="processing-log-flusher", daemon=True).start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.processing_log_flush_seconds)
+        flush_processing_log()
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def _flush_on_shutdown(**kwargs):
+    flush_processing_log()
+
+
+atexit.register(flush_processing_log)
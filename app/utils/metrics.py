@@ -0,0 +1,184 @@
+"""
+Prometheus metrics for the API and the Celery workers.
+
+Workers record, via Celery signals, how long every task takes (`docuelevate_task_duration_seconds`)
+and how long each upload takes per destination (`docuelevate_upload_duration_seconds`). Steps that
+run in-process in fused mode (see app.tasks.pipeline) are recorded by `observe_step`. Azure
+pages and OpenAI tokens are counted where the calls are made. Workers serve their metrics on
+`metrics_worker_port`. In a prefork pool every child process has its own counters; set
+`PROMETHEUS_MULTIPROC_DIR` to a directory that is writable and empty at start, so the
+metrics of all children are added up.
+
+The API serves `/metrics`. On top of its own metrics it reports the current queue depth per
+queue and lane, outstanding third-party calls, and the number of documents in flight
+(pipelines holding a lease). These are read from Redis on every scrape.
+"""
+import os
+import glob
+import time
+import logging
+
+import redis
+from celery.signals import task_prerun, task_postrun, worker_init, worker_process_shutdown
+from prometheus_client import (
+    Counter,
+    Histogram,
+    CollectorRegistry,
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    start_http_server,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+MULTIPROC_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+UPLOAD_TASK_PREFIX = "app.tasks.upload_to_"
+
+if os.environ.get(MULTIPROC_DIR_ENV):
+    os.makedirs(os.environ[MULTIPROC_DIR_ENV], exist_ok=True)
+
+# Pipeline steps take anywhere from milliseconds (local text) to minutes (OCR of large PDFs)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+TASK_DURATION = Histogram(
+    "docuelevate_task_duration_seconds", "Run time of Celery tasks",
+    ["task", "status"], buckets=DURATION_BUCKETS,
+)
+UPLOAD_DURATION = Histogram(
+    "docuelevate_upload_duration_seconds", "Run time of uploads per destination",
+    ["destination", "status"], buckets=DURATION_BUCKETS,
+)
+AZURE_PAGES = Counter("docuelevate_azure_ocr_pages_total", "Pages analyzed by Azure Document Intelligence")
+OPENAI_TOKENS = Counter("docuelevate_openai_tokens_total", "OpenAI tokens used", ["model", "step", "kind"])
+PDF_OPTIMIZE_BYTES = Counter("docuelevate_pdf_optimize_bytes_total", "Sizes of PDFs before and after optimization",
+                             ["kind"])
+
+_task_started = {}
+
+
+def _short_name(task_name):
+    """"app.tasks.rotate_pdf_pages.rotate_pdf_pages" -> "rotate_pdf_pages" """
+    return task_name.rsplit(".", 1)[-1]
+
+
+def observe_step(task_name, seconds, status):
+    """Records the run time of a task or of a step run in-process."""
+    TASK_DURATION.labels(_short_name(task_name), status).observe(seconds)
+    if task_name.startswith(UPLOAD_TASK_PREFIX):
+        destination = _short_name(task_name)[len("upload_to_"):]
+        UPLOAD_DURATION.labels(destination, status).observe(seconds)
+
+
+def record_azure_pages(result):
+    """Counts the pages of an Azure Document Intelligence result."""
+    AZURE_PAGES.inc(len(getattr(result, "pages", None) or []))
+
+
+def record_openai_usage(step, completion):
+    """Counts the tokens of an OpenAI chat completion, `step` being e.g. "refine" or "metadata"."""
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return
+    model = getattr(completion, "model", None) or settings.openai_model
+    OPENAI_TOKENS.labels(model, step, "prompt").inc(usage.prompt_tokens or 0)
+    OPENAI_TOKENS.labels(model, step, "completion").inc(usage.completion_tokens or 0)
+
+
+def record_pdf_optimization(bytes_before, bytes_after):
+    """Counts the size of a PDF before and after optimization (their difference is the saving)."""
+    PDF_OPTIMIZE_BYTES.labels("before").inc(bytes_before)
+    PDF_OPTIMIZE_BYTES.labels("after").inc(bytes_after)
+
+
+@task_prerun.connect
+def _start_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def _stop_timer(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is None or task is None:
+        return
+    observe_step(task.name, time.monotonic() - started, (state or "unknown").lower())
+
+
+class PipelineCollector:
+    """Gauges read from Redis at scrape time."""
+
+    def describe(self):
+        # Keeps the registry from calling `collect` (i.e. Redis) on registration
+        return []
+
+    def collect(self):
+        from app.celery_app import QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD, QUEUE_DEFAULT
+        from app.utils.admission import outstanding_calls, STAGE_OCR, STAGE_LLM
+        from app.utils.deduplication import redis_client, PIPELINE_LEASE_PREFIX
+        from app.utils.priority_lanes import lane_report
+
+        depth = GaugeMetricFamily("docuelevate_queue_depth", "Tasks waiting per queue and lane", labels=["queue", "lane"])
+        calls = GaugeMetricFamily("docuelevate_outstanding_calls", "Outstanding third-party calls", labels=["stage"])
+        in_flight = GaugeMetricFamily("docuelevate_documents_in_flight", "Document pipelines currently running")
+        try:
+            report = lane_report((QUEUE_PDF, QUEUE_OCR, QUEUE_LLM, QUEUE_UPLOAD, QUEUE_DEFAULT))
+            for queue, lanes in report["queues"].items():
+                for lane, count in lanes.items():
+                    depth.add_metric([queue, lane], count)
+            for stage in (STAGE_OCR, STAGE_LLM):
+                calls.add_metric([stage], outstanding_calls(stage))
+            leases = sum(1 for _ in redis_client.scan_iter(match=PIPELINE_LEASE_PREFIX + "*", count=500))
+            in_flight.add_metric([], leases)
+        except redis.RedisError as e:
+            logger.warning(f"Could not read pipeline gauges: {e}")
+        yield depth
+        yield calls
+        yield in_flight
+
+
+def _registry():
+    """The registry to expose: all processes' metrics in multiprocess mode, the default one otherwise."""
+    if not os.environ.get(MULTIPROC_DIR_ENV):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+_api_registry = None
+
+
+def render_metrics():
+    """Returns (body, content type) of the API's /metrics response."""
+    global _api_registry
+    if _api_registry is None:
+        _api_registry = _registry()
+        _api_registry.register(PipelineCollector())
+    return generate_latest(_api_registry), CONTENT_TYPE_LATEST
+
+
+@worker_init.connect
+def _serve_worker_metrics(**kwargs):
+    if not settings.metrics_enabled:
+        return
+    multiproc_dir = os.environ.get(MULTIPROC_DIR_ENV)
+    if multiproc_dir:
+        # Counters of an earlier run would be added to this one's
+        for stale in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(stale)
+    try:
+        start_http_server(settings.metrics_worker_port, registry=_registry())
+        logger.info(f"Serving worker metrics on port {settings.metrics_worker_port}")
+    except OSError as e:
+        # Several workers on one host: only the first one gets the port
+        logger.warning(f"Could not serve worker metrics on port {settings.metrics_worker_port}: {e}")
+
+
+@worker_process_shutdown.connect
+def _mark_process_dead(pid=None, **kwargs):
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        multiprocess.mark_process_dead(pid or os.getpid())
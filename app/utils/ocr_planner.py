@@ -0,0 +1,93 @@
+"""
+Per-page OCR planning for PDFs that mix born-digital and scanned pages.
+
+Only the pages without a text layer are copied into a sub-PDF and sent to OCR.
+Afterwards the searchable pages returned by OCR are spliced back into the original
+document in their original positions, and the OCR text is merged with the embedded
+text of the other pages in page order.
+"""
+import logging
+
+import fitz  # PyMuPDF
+
+from app.utils.file_operations import atomic_path
+
+logger = logging.getLogger(__name__)
+
+OCR_MODE_NONE = "none"        # every page has a text layer, no OCR needed
+OCR_MODE_FULL = "full"        # no page has a text layer, OCR the whole document
+OCR_MODE_PARTIAL = "partial"  # OCR only the image-only pages
+
+
+def plan_ocr(page_has_text):
+    """
+    Decides which pages of a document need OCR.
+
+    Args:
+        page_has_text: List of booleans, one per page, True if the page has a text layer
+
+    Returns:
+        dict: {"mode": one of the OCR_MODE_* constants, "ocr_pages": [0-based page indices]}
+    """
+    ocr_pages = [i for i, has_text in enumerate(page_has_text) if not has_text]
+    if not ocr_pages:
+        mode = OCR_MODE_NONE
+    elif len(ocr_pages) == len(page_has_text):
+        mode = OCR_MODE_FULL
+    else:
+        mode = OCR_MODE_PARTIAL
+    return {"mode": mode, "ocr_pages": ocr_pages}
+
+
+def build_ocr_subset(pdf_path, ocr_pages, subset_path):
+    """Writes a PDF containing only `ocr_pages` (in that order) of `pdf_path` to `subset_path`."""
+    with fitz.open(pdf_path) as doc:
+        doc.select(ocr_pages)
+        doc.save(subset_path, garbage=3, deflate=True)
+    logger.info(f"Wrote {len(ocr_pages)} image-only pages of {pdf_path} to {subset_path}")
+
+
+def splice_ocr_pages(pdf_path, ocr_pdf_path, ocr_pages):
+    """
+    Replaces the pages listed in `ocr_pages` of `pdf_path` with the searchable pages of
+    `ocr_pdf_path` (page i of the OCR PDF corresponds to ocr_pages[i]).
+    The file is replaced atomically; everything else in the document is kept as is.
+    """
+    with fitz.open(pdf_path) as doc, fitz.open(ocr_pdf_path) as ocr_doc:
+        if ocr_doc.page_count != len(ocr_pages):
+            raise ValueError(
+                f"OCR result has {ocr_doc.page_count} pages, expected {len(ocr_pages)} for {pdf_path}"
+            )
+        # Work from the back so earlier page indices stay valid
+        for sub_index, page_index in sorted(enumerate(ocr_pages), key=lambda item: item[1], reverse=True):
+            doc.delete_page(page_index)
+            doc.insert_pdf(ocr_doc, from_page=sub_index, to_page=sub_index, start_at=page_index)
+        with atomic_path(pdf_path) as tmp_path:
+            doc.save(tmp_path, garbage=3, deflate=True)
+    logger.info(f"Spliced {len(ocr_pages)} OCR pages back into {pdf_path}")
+
+
+def page_texts_from_result(result):
+    """
+    Splits the content of an Azure AnalyzeResult into per-page texts using the
+    character spans of every page.
+    """
+    content = result.content or ""
+    page_texts = []
+    for page in result.pages or []:
+        parts = [content[span.offset:span.offset + span.length] for span in (page.spans or [])]
+        page_texts.append("".join(parts))
+    return page_texts
+
+
+def merge_page_texts(page_texts, ocr_page_texts, ocr_pages):
+    """Returns `page_texts` with the entries listed in `ocr_pages` replaced by the OCR texts."""
+    merged = list(page_texts)
+    for sub_index, page_index in enumerate(ocr_pages):
+        merged[page_index] = ocr_page_texts[sub_index] if sub_index < len(ocr_page_texts) else ""
+    return merged
+
+
+def remap_page_indices(page_data, ocr_pages):
+    """Maps a {sub-PDF page index: value} dict (e.g. rotation angles) to original page indices."""
+    return {ocr_pages[int(sub_index)]: value for sub_index, value in page_data.items()}
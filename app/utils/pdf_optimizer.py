@@ -0,0 +1,103 @@
+"""
+Size optimization of processed PDFs before they are uploaded.
+
+Scanned pages are mostly images, often at a higher resolution than needed to read them.
+The optimizer downsamples images above the target resolution, recompresses them at the
+configured JPEG quality (black-and-white images as CCITT fax), merges identical objects
+such as images embedded once per page, drops unused objects and compresses the rest.
+If pikepdf is installed the result is also linearized ("fast web view"); MuPDF no longer
+writes linearized files.
+
+PDF/A files (e.g. Gotenberg's conversions, recognised by `pdfaid:part` in their XMP
+metadata) are written without object streams and are not linearized: PDF/A-1 forbids
+object streams, and rewriting the file with pikepdf would not keep the archival format intact.
+
+The optimized PDF replaces the original only if it is smaller.
+"""
+import os
+import re
+import logging
+
+import fitz  # PyMuPDF
+
+from app.utils.file_operations import atomic_path
+
+try:
+    import pikepdf
+except ImportError:  # pragma: no cover - linearization is optional
+    pikepdf = None
+
+logger = logging.getLogger(__name__)
+
+# Images are only downsampled if their resolution exceeds the target by this factor
+DOWNSAMPLE_THRESHOLD_FACTOR = 1.5
+
+# PDF/A identification in XMP metadata, as attribute or element: pdfaid:part="2" / <pdfaid:part>2</pdfaid:part>
+PDFA_PART_PATTERN = re.compile(r"pdfaid:part\s*(?:=\s*[\"']|>)\s*(\d)")
+
+
+class _NotSmaller(Exception):
+    """Raised inside `atomic_path` so the optimized file is discarded instead of renamed into place."""
+
+
+def pdfa_part(doc):
+    """PDF/A part (1, 2, 3, ...) a document claims to conform to, None if it is not PDF/A."""
+    match = PDFA_PART_PATTERN.search(doc.get_xml_metadata() or "")
+    return int(match.group(1)) if match else None
+
+
+def _linearize(src_path, dst_path):
+    """Writes a linearized copy of `src_path` to `dst_path` with pikepdf."""
+    with pikepdf.open(src_path) as pdf:
+        pdf.save(dst_path, linearize=True, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+
+
+def _optimize_into(pdf_path, tmp_path, image_dpi, image_quality, linearize):
+    """Writes the optimized version of `pdf_path` to `tmp_path`."""
+    with fitz.open(pdf_path) as doc:
+        encrypted = bool(doc.needs_pass or (doc.metadata or {}).get("encryption"))
+        pdfa = pdfa_part(doc)
+        if image_quality:
+            dpi_threshold = int(image_dpi * DOWNSAMPLE_THRESHOLD_FACTOR) if image_dpi else None
+            doc.rewrite_images(dpi_threshold=dpi_threshold, dpi_target=image_dpi if image_dpi else 0,
+                               quality=image_quality)
+        # garbage=4 also merges duplicate objects, e.g. a logo embedded on every page
+        doc.save(tmp_path, garbage=4, deflate=True, use_objstms=0 if pdfa else 1, encryption=fitz.PDF_ENCRYPT_KEEP)
+
+    if pdfa:
+        logger.info(f"{pdf_path} is PDF/A-{pdfa}, writing it without object streams or linearization")
+    elif linearize and pikepdf is not None and not encrypted:
+        with atomic_path(tmp_path) as linear_path:
+            _linearize(tmp_path, linear_path)
+    elif linearize and pikepdf is None:
+        logger.info("pikepdf is not installed, not linearizing")
+
+
+def optimize_pdf_file(pdf_path, image_dpi, image_quality, linearize=False):
+    """
+    Optimizes the PDF at `pdf_path` in place (see the module docstring).
+
+    Args:
+        pdf_path: Path of the PDF; replaced atomically if the optimized version is smaller
+        image_dpi: Target resolution of downsampled images (0 keeps the resolution)
+        image_quality: JPEG quality (1-100) of recompressed images (0 leaves images untouched)
+        linearize: Linearize the result (needs pikepdf; encrypted and PDF/A files are not linearized)
+
+    Returns:
+        dict: bytes_before, bytes_after, bytes_saved and whether the file was replaced
+    """
+    bytes_before = os.path.getsize(pdf_path)
+    try:
+        with atomic_path(pdf_path) as tmp_path:
+            _optimize_into(pdf_path, tmp_path, image_dpi, image_quality, linearize)
+            bytes_after = os.path.getsize(tmp_path)
+            if bytes_after >= bytes_before:
+                raise _NotSmaller()
+    except _NotSmaller:
+        logger.info(f"Optimizing {pdf_path} would not make it smaller ({bytes_before} -> {bytes_after} bytes)")
+        return {"bytes_before": bytes_before, "bytes_after": bytes_before, "bytes_saved": 0, "replaced": False}
+
+    logger.info(f"Optimized {pdf_path}: {bytes_before} -> {bytes_after} bytes")
+    return {"bytes_before": bytes_before, "bytes_after": bytes_after,
+            "bytes_saved": bytes_before - bytes_after, "replaced": True}
+
@@ -0,0 +1,146 @@
+"""
+Page rotation of PDFs, done in place.
+
+Turning a page only changes its `/Rotate` entry, so the document is saved incrementally:
+the changed page objects are appended to the file instead of the whole PDF being rewritten.
+Callers that save the document anyway (embed_metadata_into_pdf) apply the rotations to
+their open document, so the PDF is written once for both.
+"""
+import os
+import logging
+
+import fitz  # PyMuPDF
+
+from app.utils.file_operations import atomic_path, stage_file
+
+logger = logging.getLogger(__name__)
+
+
+def determine_rotation_angle(detected_angle):
+    """
+    Determine the optimal rotation angle based on detected angle.
+
+    Args:
+        detected_angle: The angle detected by Azure Document Intelligence
+
+    Returns:
+        int: The clockwise angle to turn the page by (a multiple of 90 degrees)
+    """
+    # Normalize angle to be between 0 and 360
+    normalized_angle = detected_angle % 360
+    if normalized_angle < 0:
+        normalized_angle += 360
+
+    # If angle is very small (< 1 degree), don't rotate
+    if abs(normalized_angle) < 1 or abs(normalized_angle - 360) < 1:
+        return 0
+
+    # For angles close to 90, 180, or 270 degrees (±5°), round to nearest 90° increment
+    for target in [90, 180, 270]:
+        if abs(normalized_angle - target) < 5:
+            # /Rotate turns clockwise, so we need to use the complementary angle
+            rotation_value = (360 - target) % 360
+            logger.info(f"Detected angle {detected_angle}° is close to {target}°, will rotate by {rotation_value}°")
+            return rotation_value
+
+    # For other significant angles, round to nearest 90° increment
+    # (pages can only be turned in 90-degree increments)
+    closest_90_multiple = round(normalized_angle / 90) * 90
+    # Convert to a clockwise rotation value
+    rotation_value = (360 - closest_90_multiple) % 360
+    logger.info(f"Detected angle {detected_angle}° rounded to {closest_90_multiple}°, will rotate by {rotation_value}°")
+    return rotation_value
+
+
+def page_rotations(rotation_data):
+    """
+    Turns detected angles into the rotations to apply.
+
+    Args:
+        rotation_data: {page index: detected angle}; keys may be strings (JSON)
+
+    Returns:
+        dict: {page index (int): clockwise angle} of the pages that need turning
+    """
+    rotations = {}
+    for key, value in (rotation_data or {}).items():
+        try:
+            page_idx, detected_angle = int(key), float(value)
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid rotation data key-value: {key}:{value}")
+            continue
+        rotation_angle = determine_rotation_angle(detected_angle)
+        if rotation_angle:
+            rotations[page_idx] = rotation_angle
+        elif detected_angle:
+            logger.info(f"Page {page_idx+1} had detected angle {detected_angle}° but determined it doesn't need rotation")
+    return rotations
+
+
+def apply_page_rotations(doc, rotation_data):
+    """
+    Turns the pages of an open document by their detected angles (see `page_rotations`).
+    Only the pages' `/Rotate` entries change; saving is up to the caller.
+
+    Returns:
+        dict: {page index (str): clockwise angle} of the pages that were turned
+    """
+    applied = {}
+    for page_idx, rotation_angle in page_rotations(rotation_data).items():
+        if not 0 <= page_idx < doc.page_count:
+            logger.warning(f"Rotation data for page {page_idx+1}, but the document has {doc.page_count} pages")
+            continue
+        page = doc[page_idx]
+        page.set_rotation((page.rotation + rotation_angle) % 360)
+        logger.info(f"Page {page_idx+1} rotated by {rotation_angle}°")
+        applied[str(page_idx)] = rotation_angle
+    return applied
+
+
+def unshare_file(path):
+    """
+    Makes sure `path` can be modified in place: a file that is hard linked to other names
+    (see `stage_file`) is replaced by a private copy (a reflink where possible) first.
+
+    Returns:
+        str: the staging strategy of the copy, or None if the file was not shared
+    """
+    if os.stat(path).st_nlink < 2:
+        return None
+    with atomic_path(path) as tmp_path:
+        return stage_file(path, tmp_path, keep_source=True, allow_hardlink=False)
+
+
+def save_in_place(doc, path):
+    """
+    Saves changes of a document opened from `path`: incrementally (appended to the file,
+    encryption preserved) where possible, else as a full rewrite that replaces the file.
+    The file must not be shared (see `unshare_file`).
+
+    Returns:
+        bool: True if the save was incremental
+    """
+    if doc.can_save_incrementally():
+        doc.save(path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        return True
+    # e.g. a document PyMuPDF had to repair on open
+    with atomic_path(path) as tmp_path:
+        doc.save(tmp_path, garbage=1, encryption=fitz.PDF_ENCRYPT_KEEP)
+    return False
+
+
+def rotate_pdf_in_place(pdf_path, rotation_data):
+    """
+    Turns the pages of the PDF at `pdf_path` by their detected angles.
+
+    Returns:
+        dict: {page index (str): clockwise angle} of the pages that were turned
+    """
+    if not page_rotations(rotation_data):
+        return {}
+    unshare_file(pdf_path)
+    with fitz.open(pdf_path) as doc:
+        applied = apply_page_rotations(doc, rotation_data)
+        if applied:
+            save_in_place(doc, pdf_path)
+    return applied
@@ -0,0 +1,89 @@
+"""
+Local text extraction for born-digital PDFs.
+
+The whole document is read in a single pass that yields the text of every page.
+From that, callers derive both the full text and a per-page "has text layer" flag,
+so the PDF does not have to be opened once to check for text and again to extract it.
+Large documents are split into page ranges that are extracted in a process pool.
+"""
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _extract_page_range(pdf_path, start, stop):
+    """Returns the text of pages [start, stop) of the PDF. Runs in pool workers."""
+    with fitz.open(pdf_path) as doc:
+        return [doc[i].get_text("text") for i in range(start, stop)]
+
+
+def _page_ranges(page_count, parts):
+    """Splits `page_count` pages into at most `parts` contiguous (start, stop) ranges."""
+    parts = max(1, min(parts, page_count))
+    size, rest = divmod(page_count, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        stop = start + size + (1 if i < rest else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def extract_page_texts(pdf_path, parallel_page_threshold=None, max_workers=None, doc=None):
+    """
+    Extracts the text of every page of a PDF in one pass.
+
+    Args:
+        pdf_path: Path to the PDF file
+        parallel_page_threshold: Documents with more pages than this are extracted in a
+            process pool (defaults to settings.pdf_text_parallel_page_threshold, 0 disables)
+        max_workers: Size of the process pool (defaults to settings.pdf_text_max_workers,
+            0 means one worker per CPU)
+        doc: The PDF already opened by the caller (e.g. the preflight), so it is not parsed again
+
+    Returns:
+        list: One text string per page, in page order
+    """
+    if parallel_page_threshold is None:
+        parallel_page_threshold = settings.pdf_text_parallel_page_threshold
+    if max_workers is None:
+        max_workers = settings.pdf_text_max_workers
+    max_workers = max_workers or os.cpu_count() or 1
+    if doc is None:
+        with fitz.open(pdf_path) as doc:
+            return extract_page_texts(pdf_path, parallel_page_threshold, max_workers, doc=doc)
+
+    page_count = doc.page_count
+    if not parallel_page_threshold or page_count <= parallel_page_threshold or max_workers < 2:
+        return [page.get_text("text") for page in doc]
+
+    ranges = _page_ranges(page_count, max_workers)
+    logger.info(f"Extracting text from {page_count} pages of {pdf_path} in {len(ranges)} processes")
+    try:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(_extract_page_range, pdf_path, start, stop) for start, stop in ranges]
+            page_texts = []
+            for future in futures:
+                page_texts.extend(future.result())
+            return page_texts
+    except (OSError, AssertionError, RuntimeError) as e:
+        # e.g. pools cannot be started from a daemonic worker process
+        logger.warning(f"Parallel text extraction failed ({e}), falling back to a single process")
+        return _extract_page_range(pdf_path, 0, page_count)
+
+
+def page_has_text_layer(page_text):
+    """A page counts as having a text layer if it contains any non-whitespace text."""
+    return bool(page_text and page_text.strip())
+
+
+def join_page_texts(page_texts):
+    """Joins per-page texts into the document text (one newline after every page)."""
+    return "".join(text + "\n" for text in page_texts)
@@ -0,0 +1,277 @@
+"""
+Checkpoints of each document's pipeline run, persisted in the `pipeline_states` table.
+
+Every step records that it completed, together with the outputs the following steps
+need (the document text as a blob reference, rotation data, metadata, the processed
+file), so a failed or interrupted pipeline can be resumed from the last completed step
+instead of starting over (see app.tasks.resume_pipeline). Each checkpoint and failure is
+also written to `ProcessingLog`.
+
+States, in pipeline order:
+  staged              working copy in <workdir>/tmp, FileRecord created
+  text_extracted      document text known (OCR or embedded text), rotation pending
+  pdf_ready           working copy is final (OCR'd and rotated)
+  metadata_extracted  GPT metadata known
+  embedded            metadata embedded, file moved to <workdir>/processed
+  completed           uploads queued; per-destination results are tracked in `uploads`
+
+Steps locate their document by the working copy's path (FileRecord.local_filename),
+or by the processed file for uploads. Checkpointing never breaks the pipeline: database
+errors are logged and ignored.
+"""
+import os
+import json
+import logging
+
+from celery import current_task
+from celery.signals import task_success, task_failure
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import FileRecord, PipelineState
+from app.utils.logging import log_task_progress
+
+logger = logging.getLogger(__name__)
+
+STATE_STAGED = "staged"
+STATE_TEXT_EXTRACTED = "text_extracted"
+STATE_PDF_READY = "pdf_ready"
+STATE_METADATA_EXTRACTED = "metadata_extracted"
+STATE_EMBEDDED = "embedded"
+STATE_COMPLETED = "completed"
+
+STATUS_RUNNING = "running"
+STATUS_FAILED = "failed"
+STATUS_COMPLETED = "completed"
+
+UPLOAD_TASK_PREFIX = "app.tasks.upload_to_"
+
+
+def _current_task_id():
+    return current_task.request.id if current_task else None
+
+
+def _find_file_id(db, local_filename):
+    record = db.query(FileRecord.id).filter_by(local_filename=local_filename).first()
+    return record.id if record else None
+
+
+def working_file(filename):
+    """Path of a document's working copy, from the file name the pipeline steps pass around."""
+    return os.path.join(settings.workdir, "tmp", os.path.basename(filename))
+
+
+def checkpoint(local_filename, state, text_ref=None, rotation_data=None, metadata=None,
+               processed_file=None, uploads=None):
+    """
+    Records that the pipeline of the document at `local_filename` completed `state` and
+    extends the document's pipeline lease. `text_ref` should be a blob reference
+    (`put_text(text, force=True)`), so the text outlives the task messages.
+    """
+    from app.utils.deduplication import refresh_pipeline_lease
+    try:
+        with SessionLocal() as db:
+            record = db.query(FileRecord.id, FileRecord.filehash).filter_by(local_filename=local_filename).first()
+            if record is None:
+                return
+            file_id = record.id
+            row = db.query(PipelineState).filter_by(file_id=file_id).one_or_none()
+            if row is None:
+                row = PipelineState(file_id=file_id, working_file=local_filename)
+                db.add(row)
+            row.state = state
+            row.status = STATUS_COMPLETED if state == STATE_COMPLETED else STATUS_RUNNING
+            row.last_error = None
+            if text_ref is not None:
+                row.text_ref = text_ref
+            if rotation_data is not None:
+                row.rotation_data = json.dumps(rotation_data)
+            if metadata is not None:
+                row.metadata_json = json.dumps(metadata, ensure_ascii=False)
+            if processed_file is not None:
+                row.processed_file = processed_file
+            if uploads is not None:
+                row.uploads = json.dumps(uploads)
+            db.commit()
+        log_task_progress(_current_task_id(), state, "success", file_id=file_id)
+        if state != STATE_COMPLETED:
+            refresh_pipeline_lease(record.filehash)
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not checkpoint {local_filename} at {state}: {e}")
+
+
+def mark_failed(local_filename, error):
+    """Marks the pipeline of the document at `local_filename` as failed after its last checkpoint."""
+    try:
+        with SessionLocal() as db:
+            file_id = _find_file_id(db, local_filename)
+            if file_id is None:
+                return
+            row = db.query(PipelineState).filter_by(file_id=file_id).one_or_none()
+            if row is None:
+                row = PipelineState(file_id=file_id, working_file=local_filename, state=STATE_STAGED)
+                db.add(row)
+            row.status = STATUS_FAILED
+            row.last_error = str(error)
+            db.commit()
+            step = row.state
+        log_task_progress(_current_task_id(), step, "failure", message=str(error), file_id=file_id)
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not mark {local_filename} as failed: {e}")
+
+
+def fail_pipeline(local_filename, error, lease_owner=None):
+    """
+    Terminal failure of a step: records it and frees the document's pipeline lease
+    (held by `lease_owner`, by default the owner of the running task's pipeline).
+    """
+    from app.utils.deduplication import release_pipeline_lease_for_file
+    mark_failed(local_filename, error)
+    release_pipeline_lease_for_file(local_filename, result={"status": "Failed", "error": str(error)},
+                                    owner=lease_owner)
+
+
+def fail_ingestion(filehash, error, source_hash=None):
+    """
+    Terminal failure of `process_document`, which may fail before the working copy exists:
+    marks the document's pipeline as failed if it has a FileRecord, frees the in-flight
+    claims and the pipeline lease of the running task.
+    """
+    from app.utils.deduplication import release_ingestion, release_pipeline_lease
+    try:
+        with SessionLocal() as db:
+            record = db.query(FileRecord.local_filename).filter_by(filehash=filehash).first()
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not look up the file with hash {filehash[:10]}...: {e}")
+        record = None
+    if record is not None and record.local_filename:
+        mark_failed(record.local_filename, error)
+    release_ingestion(filehash, source_hash)
+    release_pipeline_lease(filehash, result={"status": "Failed", "error": str(error)})
+
+
+def complete_pipeline(processed_file, uploads):
+    """Final checkpoint, recorded when the uploads of `processed_file` have been queued."""
+    try:
+        with SessionLocal() as db:
+            row = db.query(PipelineState).filter_by(processed_file=processed_file).one_or_none()
+            if row is None:
+                return
+            row.state = STATE_COMPLETED
+            row.status = STATUS_COMPLETED
+            row.last_error = None
+            # Fast uploads may have reported their outcome already
+            row.uploads = json.dumps({**uploads, **(json.loads(row.uploads) if row.uploads else {})})
+            db.commit()
+            file_id = row.file_id
+        log_task_progress(_current_task_id(), STATE_COMPLETED, "success", file_id=file_id)
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not checkpoint {processed_file} as completed: {e}")
+
+
+def get_state(file_id):
+    """Returns the checkpoint of a document as a dict, or None if it has none."""
+    with SessionLocal() as db:
+        row = db.query(PipelineState).filter_by(file_id=file_id).one_or_none()
+        if row is None:
+            return None
+        return {
+            "file_id": row.file_id,
+            "state": row.state,
+            "status": row.status,
+            "last_error": row.last_error,
+            "working_file": row.working_file,
+            "text_ref": row.text_ref,
+            "rotation_data": json.loads(row.rotation_data) if row.rotation_data else None,
+            "metadata": json.loads(row.metadata_json) if row.metadata_json else None,
+            "processed_file": row.processed_file,
+            "uploads": json.loads(row.uploads) if row.uploads else {},
+            "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+        }
+
+
+def record_upload(processed_file, destination, status):
+    """Records the outcome of the upload of `processed_file` to `destination`."""
+    try:
+        with SessionLocal() as db:
+            row = db.query(PipelineState).filter_by(processed_file=processed_file).one_or_none()
+            if row is None:
+                return
+            uploads = json.loads(row.uploads) if row.uploads else {}
+            uploads[destination] = status
+            row.uploads = json.dumps(uploads)
+            db.commit()
+            file_id = row.file_id
+        log_task_progress(_current_task_id(), f"upload_{destination}", status, file_id=file_id)
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not record {destination} upload of {processed_file}: {e}")
+
+
+def _upload_destination(task_name):
+    """"app.tasks.upload_to_dropbox.upload_to_dropbox" -> "dropbox" """
+    return task_name[len(UPLOAD_TASK_PREFIX):].split(".", 1)[0]
+
+
+def _pending_document(raw_context):
+    context = json.loads(raw_context)
+    return context.get("splice_into") or context["filename"]
+
+
+PROCESS_DOCUMENT_TASK = "app.tasks.process_document.process_document"
+
+
+def _ingestion_failed(exception, args, kwargs):
+    """`process_document` failed for good: its arguments give the file hash, not a working copy."""
+    from app.utils.file_operations import hash_file
+    original_local_file = kwargs.get("original_local_file") or (args[0] if args else None)
+    filehash = kwargs.get("filehash") or (args[1] if len(args) > 1 else None)
+    if not filehash and original_local_file and os.path.exists(original_local_file):
+        filehash = hash_file(original_local_file)
+    if filehash:
+        fail_ingestion(filehash, exception, kwargs.get("source_hash") or (args[3] if len(args) > 3 else None))
+
+
+# Pipeline steps, and how to get the document's working copy from their arguments
+PIPELINE_TASKS = {
+    "app.tasks.process_with_azure_document_intelligence.process_with_azure_document_intelligence":
+        lambda args, kwargs: kwargs.get("splice_into") or args[0],
+    "app.tasks.process_with_azure_document_intelligence.splice_ocr_result": lambda args, kwargs: args[1],
+    "app.tasks.ocr_shards.split_ocr_shards": lambda args, kwargs: kwargs.get("splice_into") or args[0],
+    "app.tasks.ocr_shards.merge_ocr_shards": lambda args, kwargs: kwargs.get("splice_into") or args[1],
+    "app.tasks.collect_azure_ocr_results.finish_azure_ocr":
+        lambda args, kwargs: _pending_document(args[1]),
+    "app.tasks.rotate_pdf_pages.rotate_pdf_pages": lambda args, kwargs: args[0],
+    "app.tasks.refine_text_with_gpt.refine_text_with_gpt": lambda args, kwargs: args[0],
+    "app.tasks.extract_metadata_with_gpt.extract_metadata_with_gpt": lambda args, kwargs: args[0],
+    "app.tasks.embed_metadata_into_pdf.embed_metadata_into_pdf": lambda args, kwargs: args[0],
+    "app.tasks.finalize_document_storage.finalize_document_storage": lambda args, kwargs: args[0],
+}
+
+
+@task_failure.connect
+def _pipeline_step_failed(sender=None, exception=None, args=None, kwargs=None, **extra):
+    """A step failed for good (retries exhausted): record it and free the lease for a resume."""
+    if getattr(sender, "name", None) == PROCESS_DOCUMENT_TASK:
+        _ingestion_failed(exception, args or [], kwargs or {})
+        return
+    locate = PIPELINE_TASKS.get(getattr(sender, "name", None))
+    if locate is None:
+        return
+    try:
+        filename = locate(args or [], kwargs or {})
+    except (IndexError, KeyError, TypeError, ValueError):
+        return
+    fail_pipeline(working_file(filename), exception)
+
+
+@task_success.connect
+def _upload_succeeded(sender=None, **kwargs):
+    if sender is not None and sender.name.startswith(UPLOAD_TASK_PREFIX) and sender.request.args:
+        record_upload(sender.request.args[0], _upload_destination(sender.name), "success")
+
+
+@task_failure.connect
+def _upload_failed(sender=None, args=None, **kwargs):
+    if sender is not None and sender.name.startswith(UPLOAD_TASK_PREFIX) and args:
+        record_upload(args[0], _upload_destination(sender.name), "failure")
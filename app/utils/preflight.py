@@ -0,0 +1,127 @@
+"""
+Preflight inspection of a document, done once at ingestion.
+
+The facts later steps need about a file's content (page count, which pages have a text
+layer, encryption, PDF version) are worked out in the same pass that extracts the
+embedded text, and stored in the `document_facts` table next to the file's FileRecord,
+keyed by its content hash. Later steps read them from there (`get_facts`) instead of
+parsing the PDF again; file size and MIME type come from the FileRecord itself.
+
+Like checkpoints, storing or reading facts never breaks the pipeline: database errors
+are logged and callers fall back to inspecting the file themselves.
+"""
+import logging
+
+import fitz  # PyMuPDF
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.database import SessionLocal
+from app.models import FileRecord, DocumentFacts
+from app.utils.pdf_text import extract_page_texts, page_has_text_layer
+
+logger = logging.getLogger(__name__)
+
+
+def encode_page_set(pages):
+    """Encodes 0-based page indices as compact ranges, e.g. [0, 1, 2, 3, 7] -> "0-3,7"."""
+    ranges = []
+    for page in sorted(set(pages)):
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ",".join(str(start) if start == stop else f"{start}-{stop}" for start, stop in ranges)
+
+
+def decode_page_set(text):
+    """Decodes the ranges written by `encode_page_set` into a sorted list of page indices."""
+    pages = []
+    for part in (text or "").split(","):
+        if not part:
+            continue
+        start, _, stop = part.partition("-")
+        pages.extend(range(int(start), int(stop or start) + 1))
+    return pages
+
+
+def inspect_document(file_path):
+    """
+    Reads the facts of a document and the text of its pages in one pass.
+
+    Returns:
+        tuple: (facts, page_texts) where facts is a dict with page_count, text_pages (list of
+        page indices with a text layer), encrypted, needs_password and pdf_version, and
+        page_texts has one string per page (None if the document needs a password)
+    """
+    with fitz.open(file_path) as doc:
+        metadata = doc.metadata or {}
+        facts = {
+            "page_count": doc.page_count,
+            "encrypted": bool(doc.needs_pass or metadata.get("encryption")),
+            "needs_password": bool(doc.needs_pass),
+            "pdf_version": metadata.get("format") or None,
+        }
+        if facts["needs_password"]:
+            facts["text_pages"] = []
+            return facts, None
+        # Same open document: the PDF is parsed once for its facts and its text
+        page_texts = extract_page_texts(file_path, doc=doc)
+
+    facts["text_pages"] = [i for i, text in enumerate(page_texts) if page_has_text_layer(text)]
+    return facts, page_texts
+
+
+def store_facts(local_filename, facts):
+    """Stores the facts of the document whose working copy is `local_filename` (replacing older ones)."""
+    try:
+        with SessionLocal() as db:
+            record = db.query(FileRecord.id, FileRecord.filehash).filter_by(local_filename=local_filename).first()
+            if record is None:
+                return
+            row = db.query(DocumentFacts).filter_by(file_id=record.id).one_or_none()
+            if row is None:
+                row = DocumentFacts(file_id=record.id, filehash=record.filehash)
+                db.add(row)
+            row.page_count = facts["page_count"]
+            row.text_pages = encode_page_set(facts["text_pages"])
+            row.encrypted = facts["encrypted"]
+            row.needs_password = facts["needs_password"]
+            row.pdf_version = facts["pdf_version"]
+            db.commit()
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not store the document facts of {local_filename}: {e}")
+
+
+def get_facts(local_filename=None, filehash=None):
+    """
+    Returns the facts of a document, found by its working copy or its content hash,
+    together with the file size and MIME type of its FileRecord.
+
+    Returns:
+        dict or None: None if the document was not inspected (or the database is unavailable)
+    """
+    try:
+        with SessionLocal() as db:
+            query = db.query(DocumentFacts, FileRecord).join(FileRecord, FileRecord.id == DocumentFacts.file_id)
+            if filehash:
+                query = query.filter(DocumentFacts.filehash == filehash)
+            else:
+                query = query.filter(FileRecord.local_filename == local_filename)
+            found = query.first()
+            if found is None:
+                return None
+            row, record = found
+            return {
+                "file_id": record.id,
+                "filehash": row.filehash,
+                "file_size": record.file_size,
+                "mime_type": record.mime_type,
+                "page_count": row.page_count,
+                "text_pages": decode_page_set(row.text_pages),
+                "encrypted": row.encrypted,
+                "needs_password": row.needs_password,
+                "pdf_version": row.pdf_version,
+            }
+    except SQLAlchemyError as e:
+        logger.warning(f"Could not read the document facts of {filehash or local_filename}: {e}")
+        return None
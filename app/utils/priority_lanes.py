@@ -0,0 +1,141 @@
+"""
+Priority lanes for document pipelines.
+
+Every pipeline gets a priority when it is started (interactive uploads first, then IMAP,
+then bulk jobs like /api/processall). The Redis broker keeps one list per queue and
+priority step and always serves the lower number first, so an upload from the web UI
+overtakes a backlog of thousands of bulk documents.
+
+While a task runs, its priority is the "current priority" (`current_priority`); the
+pipeline hands it on to every task it triggers (see app.tasks.pipeline.enqueue). Each
+message carries the time it was published, so the wait time per lane can be reported
+alongside the queue depths (`lane_report`).
+"""
+import time
+import logging
+import contextvars
+
+import redis
+from celery.signals import before_task_publish, task_prerun
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0  # Web UI uploads and single-file API calls
+PRIORITY_IMAP = 3         # Mail ingestion and everything without an explicit lane
+PRIORITY_BULK = 6         # /api/processall and other backfills
+
+LANES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "imap": PRIORITY_IMAP,
+    "bulk": PRIORITY_BULK,
+}
+
+# Broker settings: one Redis list per queue and step, "<queue>:<priority>" (priority 0 is "<queue>")
+PRIORITY_STEPS = sorted(LANES.values())
+PRIORITY_SEP = ":"
+
+WAIT_TIMES_KEY_PREFIX = "lane_wait_times:"
+WAIT_TIMES_SAMPLES = 1000
+ENQUEUED_AT_HEADER = "enqueued_at"
+
+redis_client = redis.StrictRedis.from_url(settings.redis_url, decode_responses=True)
+
+_current_priority = contextvars.ContextVar("pipeline_priority", default=None)
+
+
+def lane_for_priority(priority):
+    """Name of the lane a priority belongs to (the closest lane at or above it)."""
+    if priority is None:
+        priority = PRIORITY_IMAP
+    name = "interactive"
+    for lane, lane_priority in sorted(LANES.items(), key=lambda item: item[1]):
+        if priority >= lane_priority:
+            name = lane
+    return name
+
+
+def current_priority():
+    """Priority of the pipeline the running task belongs to, None outside of tasks."""
+    return _current_priority.get()
+
+
+def configure_priorities(app):
+    """Enables priority steps on the Redis broker."""
+    app.conf.broker_transport_options = {
+        **(app.conf.broker_transport_options or {}),
+        "priority_steps": PRIORITY_STEPS,
+        "sep": PRIORITY_SEP,
+        "queue_order_strategy": "priority",
+    }
+    app.conf.task_default_priority = PRIORITY_IMAP
+
+
+@before_task_publish.connect
+def _stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(ENQUEUED_AT_HEADER, time.time())
+
+
+@task_prerun.connect
+def _enter_lane(task=None, **kwargs):
+    """Makes the task's priority the current priority and records how long it waited."""
+    request = task.request
+    priority = (request.delivery_info or {}).get("priority")
+    _current_priority.set(priority)
+
+    enqueued_at = getattr(request, ENQUEUED_AT_HEADER, None) or (request.headers or {}).get(ENQUEUED_AT_HEADER)
+    if not enqueued_at:
+        return
+    try:
+        key = WAIT_TIMES_KEY_PREFIX + lane_for_priority(priority)
+        pipe = redis_client.pipeline()
+        pipe.lpush(key, round(time.time() - float(enqueued_at), 3))
+        pipe.ltrim(key, 0, WAIT_TIMES_SAMPLES - 1)
+        pipe.execute()
+    except (redis.RedisError, ValueError) as e:
+        logger.warning(f"Could not record queue wait time: {e}")
+
+
+def _queue_key(queue, priority):
+    return queue if not priority else f"{queue}{PRIORITY_SEP}{priority}"
+
+
+def queue_depth(queue, max_priority=None):
+    """
+    Number of messages waiting in `queue` in the lanes up to priority `max_priority`
+    (that lane and the ones served before it), or in all lanes if it is None.
+    """
+    pipe = redis_client.pipeline()
+    for priority in LANES.values():
+        if max_priority is None or priority <= max_priority:
+            pipe.llen(_queue_key(queue, priority))
+    return sum(pipe.execute())
+
+
+def lane_report(queues):
+    """
+    Queue depth per queue and lane, and wait-time statistics (seconds, over the last
+    `WAIT_TIMES_SAMPLES` tasks) per lane.
+    """
+    report = {"queues": {}, "wait_times": {}}
+    try:
+        for queue in queues:
+            report["queues"][queue] = {
+                lane: redis_client.llen(_queue_key(queue, priority)) for lane, priority in LANES.items()
+            }
+        for lane in LANES:
+            samples = sorted(float(v) for v in redis_client.lrange(WAIT_TIMES_KEY_PREFIX + lane, 0, -1))
+            if not samples:
+                report["wait_times"][lane] = {"samples": 0}
+                continue
+            report["wait_times"][lane] = {
+                "samples": len(samples),
+                "avg": round(sum(samples) / len(samples), 3),
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "max": samples[-1],
+            }
+    except redis.RedisError as e:
+        logger.warning(f"Could not read lane statistics: {e}")
+    return report
@@ -0,0 +1,125 @@
+"""
+Result policies for the Celery result backend (Redis).
+
+Intermediate hops of the pipeline hand their output to the next task themselves, so
+nothing ever reads their results; storing them only costs Redis memory. They are
+configured with `ignore_result`. Terminal steps (uploads, `send_to_all_destinations`)
+and tasks started from the API (`process_document`) keep their results, compressed and
+expiring after `celery_result_expires_seconds`. Results that are only needed briefly,
+like OCR shard results collected by a chord, get a shorter TTL of their own.
+
+For the memory report, the name of every task that stored a result is kept next to it
+(`celery-task-name-<id>`, same TTL), as Celery only stores task names with
+`result_extended`, which would store all task arguments as well.
+"""
+import logging
+
+import redis
+from celery.signals import task_postrun
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+RESULT_KEY_PREFIX = "celery-task-meta-"
+TASK_NAME_KEY_PREFIX = "celery-task-name-"
+
+# Tasks whose results nobody reads: they trigger the next step of the pipeline themselves
+INTERMEDIATE_TASKS = (
+    "app.tasks.process_with_azure_document_intelligence.process_with_azure_document_intelligence",
+    "app.tasks.collect_azure_ocr_results.collect_azure_ocr_results",
+    "app.tasks.collect_azure_ocr_results.finish_azure_ocr",
+    "app.tasks.process_with_azure_document_intelligence.splice_ocr_result",
+    "app.tasks.ocr_shards.split_ocr_shards",
+    "app.tasks.ocr_shards.merge_ocr_shards",
+    "app.tasks.rotate_pdf_pages.rotate_pdf_pages",
+    "app.tasks.refine_text_with_gpt.refine_text_with_gpt",
+    "app.tasks.extract_metadata_with_gpt.extract_metadata_with_gpt",
+    "app.tasks.embed_metadata_into_pdf.embed_metadata_into_pdf",
+    "app.tasks.finalize_document_storage.finalize_document_storage",
+    "app.tasks.convert_to_pdf.convert_to_pdf",
+    "app.tasks.imap_tasks.pull_all_inboxes",
+    "app.tasks.uptime_kuma_tasks.ping_uptime_kuma",
+    "app.tasks.purge_blobs.purge_blobs",
+    "app.tasks.ingest_backlog.ingest_backlog",
+)
+
+
+def result_ttls():
+    """Per-task result TTLs in seconds that differ from `celery_result_expires_seconds`."""
+    return {
+        # Only needed until the chord callback has merged the shards
+        "app.tasks.ocr_shards.ocr_pdf_shard": settings.celery_shard_result_expires_seconds,
+    }
+
+
+def configure_result_policies(app):
+    """Applies the result policies to the Celery app."""
+    app.conf.result_expires = settings.celery_result_expires_seconds
+    if settings.celery_result_compression:
+        app.conf.result_compression = settings.celery_result_compression
+    if settings.celery_ignore_intermediate_results:
+        app.conf.task_annotations = {name: {"ignore_result": True} for name in INTERMEDIATE_TASKS}
+
+
+@task_postrun.connect
+def _apply_result_ttl(task_id=None, task=None, **kwargs):
+    """Runs after the result has been stored: applies per-task TTLs and records the task name."""
+    if task is None or task.ignore_result or not task_id:
+        return
+    ttl = result_ttls().get(task.name, settings.celery_result_expires_seconds)
+    try:
+        client = task.backend.client
+        pipe = client.pipeline()
+        if task.name in result_ttls():
+            pipe.expire(task.backend.get_key_for_task(task_id), ttl)
+        pipe.set(TASK_NAME_KEY_PREFIX + task_id, task.name, ex=ttl)
+        pipe.execute()
+    except (AttributeError, redis.RedisError) as e:
+        logger.warning(f"Could not apply result policy to {task.name}[{task_id}]: {e}")
+
+
+def result_backend_report(batch_size=500):
+    """
+    Sums up the Redis memory used by stored task results, per task name.
+
+    Returns:
+        dict: {"keys": <count>, "bytes": <total>, "tasks": {<task name>: {"count", "bytes"}}},
+              tasks ordered by memory, largest first. Results stored before the task name
+              was recorded are reported as "unknown".
+    """
+    from app.celery_app import celery
+
+    client = celery.backend.client
+    per_task = {}
+    keys_total, bytes_total = 0, 0
+
+    def flush(batch):
+        nonlocal keys_total, bytes_total
+        pipe = client.pipeline()
+        for key in batch:
+            task_id = key[len(RESULT_KEY_PREFIX):]
+            pipe.memory_usage(key)
+            pipe.get(TASK_NAME_KEY_PREFIX + task_id)
+        replies = pipe.execute()
+        for size, name in zip(replies[0::2], replies[1::2]):
+            if size is None:  # Expired in between
+                continue
+            name = name.decode() if isinstance(name, bytes) else (name or "unknown")
+            entry = per_task.setdefault(name, {"count": 0, "bytes": 0})
+            entry["count"] += 1
+            entry["bytes"] += size
+            keys_total += 1
+            bytes_total += size
+
+    batch = []
+    for key in client.scan_iter(match=RESULT_KEY_PREFIX + "*", count=batch_size):
+        batch.append(key.decode() if isinstance(key, bytes) else key)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    tasks = dict(sorted(per_task.items(), key=lambda item: item[1]["bytes"], reverse=True))
+    return {"keys": keys_total, "bytes": bytes_total, "tasks": tasks}
@@ -0,0 +1,184 @@
+"""
+Persistent, content-addressed cache for the expensive pipeline steps (Azure OCR and the
+GPT calls), so that retries and re-runs of identical content don't pay for them again.
+
+Entries live under <workdir>/cache/<namespace>/ and are keyed by the SHA-256 of the step's
+input plus the model that produced them (see `cache_key`). Every entry is a JSON file,
+optionally accompanied by a binary blob (e.g. the searchable PDF). Reading an entry
+refreshes its modification time, and once the cache grows beyond
+`result_cache_max_bytes` the least recently used entries are evicted. Eviction walks the
+whole cache, so writes trigger it at most once per EVICT_INTERVAL_SECONDS across all workers.
+
+Hit/miss counters per namespace are kept in Redis. The cache never breaks the pipeline:
+any error while reading or writing it is logged and treated as a miss.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import redis
+
+from app.config import settings
+from app.utils.file_operations import atomic_path, atomic_write, stage_file
+
+logger = logging.getLogger(__name__)
+
+CACHE_STATS_KEY = "result_cache_stats"
+EVICT_LOCK_KEY = "result_cache_evicted"
+EVICT_INTERVAL_SECONDS = 60
+
+redis_client = redis.StrictRedis.from_url(settings.redis_url, decode_responses=True)
+
+
+def cache_key(*parts):
+    """Combines input hash, model id, ... into one cache key."""
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def text_digest(text):
+    """SHA-256 of a text input (e.g. OCR text passed to GPT)."""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def _cache_root():
+    return os.path.join(settings.workdir, "cache")
+
+
+def _entry_paths(namespace, key):
+    """Returns (json path, blob path) of an entry, fanned out by the first two hex digits."""
+    base = os.path.join(_cache_root(), namespace, key[:2], key)
+    return base + ".json", base + ".blob"
+
+
+def _count(namespace, outcome):
+    try:
+        redis_client.hincrby(CACHE_STATS_KEY, f"{namespace}:{outcome}", 1)
+    except redis.RedisError as e:
+        logger.warning(f"Could not update cache statistics: {e}")
+
+
+def get_cached(namespace, key, blob_target=None):
+    """
+    Looks up an entry.
+
+    If `blob_target` is given, the entry's blob is atomically placed at that path as
+    well; an entry without a blob is a miss in that case.
+
+    Returns:
+        dict or None: the cached value, None on a miss
+    """
+    if not settings.result_cache_enabled:
+        return None
+
+    json_path, blob_path = _entry_paths(namespace, key)
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            value = json.load(f)
+        if blob_target:
+            with atomic_path(blob_target) as tmp_path:
+                stage_file(blob_path, tmp_path, keep_source=True)
+        # Mark as recently used for the LRU eviction
+        os.utime(json_path)
+    except FileNotFoundError:
+        _count(namespace, "misses")
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable {namespace} cache entry {key}: {e}")
+        _count(namespace, "misses")
+        return None
+
+    _count(namespace, "hits")
+    logger.info(f"[CACHE] {namespace} hit for {key[:12]}")
+    return value
+
+
+def put_cached(namespace, key, value, blob_source=None):
+    """
+    Stores `value` (JSON-serialisable) and optionally a copy of the file `blob_source`.
+    The blob is written first, so a readable JSON file always has its blob.
+    """
+    if not settings.result_cache_enabled:
+        return
+
+    json_path, blob_path = _entry_paths(namespace, key)
+    try:
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        if blob_source:
+            # Hard links are fine: every pipeline step replaces files instead of modifying them
+            with atomic_path(blob_path) as tmp_path:
+                stage_file(blob_source, tmp_path, keep_source=True)
+        with atomic_write(json_path, "w", encoding="utf-8") as f:
+            json.dump(value, f)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Could not store {namespace} cache entry {key}: {e}")
+        return
+
+    _evict_throttled()
+
+
+def _evict_throttled():
+    """Runs `evict_cache` unless some worker ran it within the last EVICT_INTERVAL_SECONDS."""
+    try:
+        if not redis_client.set(EVICT_LOCK_KEY, 1, nx=True, ex=EVICT_INTERVAL_SECONDS):
+            return
+    except redis.RedisError as e:
+        logger.warning(f"Could not throttle cache eviction: {e}")
+        return
+    evict_cache()
+
+
+def evict_cache(max_bytes=None):
+    """
+    Removes least recently used entries until the cache is at most `max_bytes`
+    (default: `result_cache_max_bytes`) large.
+
+    Returns:
+        int: number of evicted entries
+    """
+    max_bytes = settings.result_cache_max_bytes if max_bytes is None else max_bytes
+    entries = []  # (last use, size, json path, blob path)
+    total = 0
+    for dirpath, _, filenames in os.walk(_cache_root()):
+        for name in filenames:
+            if not name.endswith(".json"):
+                continue
+            json_path = os.path.join(dirpath, name)
+            blob_path = json_path[:-len(".json")] + ".blob"
+            try:
+                stat = os.stat(json_path)
+                size = stat.st_size + (os.path.getsize(blob_path) if os.path.exists(blob_path) else 0)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, json_path, blob_path))
+            total += size
+
+    evicted = 0
+    for _, size, json_path, blob_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in (json_path, blob_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        evicted += 1
+
+    if evicted:
+        logger.info(f"[CACHE] Evicted {evicted} entries, cache is now {total} bytes")
+    return evicted
+
+
+def get_cache_stats():
+    """Returns hit/miss counters per namespace, e.g. {"ocr": {"hits": 3, "misses": 10}}."""
+    try:
+        raw = redis_client.hgetall(CACHE_STATS_KEY)
+    except redis.RedisError as e:
+        logger.warning(f"Could not read cache statistics: {e}")
+        return {}
+    stats = {}
+    for field, count in raw.items():
+        namespace, outcome = field.rsplit(":", 1)
+        stats.setdefault(namespace, {"hits": 0, "misses": 0})[outcome] = int(count)
+    return stats
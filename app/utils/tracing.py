@@ -0,0 +1,162 @@
+"""
+Distributed tracing of document pipelines with OpenTelemetry.
+
+Every document gets a trace when it is ingested (`document_trace`, used by the upload API,
+/api/process and IMAP). The trace context travels in the headers of every Celery message
+the pipeline publishes (W3C `traceparent`), so each task becomes a child span of the task
+that queued it and a document's trace shows all its hops, in-process (fused) steps included.
+Slow parts within a task get spans of their own (`span`): PyMuPDF work, Azure and OpenAI
+calls. Uploads are one task per destination and show up as such.
+
+Spans are exported to `tracing_otlp_endpoint` (OTLP over HTTP, e.g. a Jaeger or Tempo
+collector) or, for offline use, appended as JSON lines to `tracing_file`. Tracing is a no-op
+if neither is configured or the OpenTelemetry packages are not installed.
+"""
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+from celery.signals import (
+    before_task_publish, task_prerun, task_postrun, worker_init, worker_shutdown, worker_process_shutdown,
+)
+
+from app.config import settings
+
+try:
+    from opentelemetry import trace, propagate, context as otel_context
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:  # pragma: no cover - tracing is optional
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "traceparent"
+
+_tracer = None
+_task_spans = {}
+
+
+if trace is not None:
+    class JsonLinesSpanExporter(SpanExporter):
+        """Appends finished spans to a file, one JSON object per line."""
+
+        def __init__(self, path):
+            self.path = path
+            self._lock = threading.Lock()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        def export(self, spans):
+            lines = "".join(json.dumps(json.loads(finished.to_json())) + "\n" for finished in spans)
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            return SpanExportResult.SUCCESS
+
+        def shutdown(self):
+            pass
+
+
+def init_tracing(service_name):
+    """Sets up the tracer provider of this process; a no-op unless an exporter is configured."""
+    global _tracer
+    if trace is None or _tracer is not None:
+        return
+    if settings.tracing_otlp_endpoint:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=settings.tracing_otlp_endpoint)
+    elif settings.tracing_file:
+        exporter = JsonLinesSpanExporter(settings.tracing_file)
+    else:
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("docuelevate")
+    logger.info(f"Tracing enabled for {service_name}")
+
+
+@contextmanager
+def span(name, **attributes):
+    """Records the enclosed block as a span of the current trace."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=_clean(attributes)) as current:
+        yield current
+
+
+@contextmanager
+def document_trace(source, **attributes):
+    """
+    Starts the trace of a newly ingested document; tasks queued inside the block join it.
+    Yields the trace id (hex), or None if tracing is disabled.
+    """
+    if _tracer is None:
+        yield None
+        return
+    # A new root, even when called from within a task (e.g. the IMAP poller)
+    with _tracer.start_as_current_span(f"ingest.{source}", context=otel_context.Context(),
+                                       attributes=_clean(attributes)) as root:
+        yield format(root.get_span_context().trace_id, "032x")
+
+
+def _clean(attributes):
+    return {key: value for key, value in attributes.items() if value is not None}
+
+
+@worker_init.connect
+def _init_worker_tracing(**kwargs):
+    # Prefork children inherit the provider; the SDK restarts its export thread after a fork
+    init_tracing("docuelevate-worker")
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def _flush_spans(**kwargs):
+    if _tracer is not None:
+        trace.get_tracer_provider().shutdown()
+
+
+@before_task_publish.connect
+def _inject_trace_context(headers=None, **kwargs):
+    if _tracer is not None and headers is not None:
+        propagate.inject(headers)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, task=None, args=None, **kwargs):
+    if _tracer is None or task is None:
+        return
+    request = task.request
+    carrier = dict(request.headers or {})
+    traceparent = getattr(request, TRACE_HEADER, None)
+    if traceparent:
+        carrier[TRACE_HEADER] = traceparent
+    parent = propagate.extract(carrier)
+    task_span = _tracer.start_span(
+        f"task.{task.name.rsplit('.', 1)[-1]}", context=parent,
+        attributes=_clean({
+            "celery.task_id": task_id,
+            "celery.task_name": task.name,
+            "document.file": args[0] if args and isinstance(args[0], str) else None,
+        }),
+    )
+    token = otel_context.attach(trace.set_span_in_context(task_span))
+    _task_spans[task_id] = (task_span, token)
+
+
+@task_postrun.connect
+def _end_task_span(task_id=None, state=None, **kwargs):
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    task_span, token = entry
+    task_span.set_attribute("celery.state", state or "unknown")
+    if state == "FAILURE":
+        task_span.set_status(Status(StatusCode.ERROR))
+    task_span.end()
+    otel_context.detach(token)
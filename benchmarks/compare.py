@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Compares two result files of benchmarks/run_pipeline.py or of benchmarks/pdf_ops.py.
+
+Usage:
+    python benchmarks/compare.py benchmarks/results/<before>.json benchmarks/results/<after>.json
+"""
+import sys
+import json
+import argparse
+
+
+PDF_OPS_METRICS = (
+    ("wall_seconds", "wall (s)"),
+    ("cpu_seconds", "cpu (s)"),
+    ("written_mb", "written (MB)"),
+    ("peak_rss_over_baseline_mb", "peak RSS (+MB)"),
+)
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _change(before, after):
+    if not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+        return ""
+    if before == 0:
+        return "" if after == 0 else "   (new)"
+    return f"{(after - before) / before * 100:+8.1f}%"
+
+
+def _row(label, before, after):
+    def fmt(value):
+        return "-" if value is None else f"{value:.3f}" if isinstance(value, float) else str(value)
+    return f"{label:<38} {fmt(before):>12} {fmt(after):>12} {_change(before, after)}"
+
+
+def _header(before, after):
+    return _row("", f"{before['commit']}{'*' if before.get('dirty') else ''}",
+                f"{after['commit']}{'*' if after.get('dirty') else ''}")
+
+
+def _config_warning(before, after):
+    if before.get("config") == after.get("config"):
+        return []
+    changed = sorted(key for key in set(before.get("config", {})) | set(after.get("config", {}))
+                     if before.get("config", {}).get(key) != after.get("config", {}).get(key))
+    return [f"[WARNING] The runs were configured differently: {', '.join(changed)}"]
+
+
+def compare_pdf_ops(before, after):
+    """Returns the comparison of two pdf_ops reports as lines of text."""
+    b, a = before["results"], after["results"]
+    lines = [_header(before, after)]
+    for operation in sorted(set(b) | set(a)):
+        page_counts = sorted(set(b.get(operation, {})) | set(a.get(operation, {})), key=int)
+        for pages in page_counts:
+            b_stats, a_stats = b.get(operation, {}).get(pages, {}), a.get(operation, {}).get(pages, {})
+            for metric, label in PDF_OPS_METRICS:
+                lines.append(_row(f"{operation} {pages}p {label}", b_stats.get(metric), a_stats.get(metric)))
+    return lines + _config_warning(before, after)
+
+
+def compare(before, after):
+    """Returns the comparison of two reports as lines of text."""
+    if before.get("suite") != after.get("suite"):
+        raise ValueError("The reports are of different benchmarks")
+    if before.get("suite") == "pdf_ops":
+        return compare_pdf_ops(before, after)
+    b, a = before["results"], after["results"]
+    lines = [
+        _header(before, after),
+        _row("documents/minute", b["documents_per_minute"], a["documents_per_minute"]),
+        _row("completed", b["completed"], a["completed"]),
+        _row("failed", b["failed"], a["failed"]),
+        _row("timed out", b["timed_out"], a["timed_out"]),
+        _row("peak RSS worker total (MB)", b["peak_rss_mb"].get("worker_total"), a["peak_rss_mb"].get("worker_total")),
+        _row("peak RSS largest process (MB)", b["peak_rss_mb"].get("largest_process"),
+             a["peak_rss_mb"].get("largest_process")),
+    ]
+    b_latency, a_latency = b["latency_seconds"], a["latency_seconds"]
+    for pct in ("p50", "p95"):
+        lines.append(_row(f"end_to_end {pct} (s)", b_latency["end_to_end"][pct], a_latency["end_to_end"][pct]))
+    for step in sorted(set(b_latency["steps"]) | set(a_latency["steps"])):
+        for pct in ("p50", "p95"):
+            lines.append(_row(f"  {step} {pct} (s)", b_latency["steps"].get(step, {}).get(pct),
+                              a_latency["steps"].get(step, {}).get(pct)))
+    return lines + _config_warning(before, after)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+    print("\n".join(compare(_load(args.before), _load(args.after))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Synthetic PDF corpus for the pipeline benchmarks.
+
+Kinds of documents:
+  text     - every page has a text layer (no OCR, local metadata extraction)
+  scanned  - every page is an image without text (full OCR)
+  mixed    - text pages and scanned pages alternate (partial OCR)
+  large    - text pages, `--large-pages` of them (exercises OCR sharding when scanned)
+
+Documents are deterministic for a given seed, and every document is unique, so the
+pipeline's deduplication does not skip any of them.
+
+Usage:
+    python benchmarks/corpus.py --out /tmp/corpus --per-kind 10
+"""
+import os
+import sys
+import random
+import argparse
+
+import fitz  # PyMuPDF
+
+KINDS = ("text", "scanned", "mixed", "large")
+
+WORDS = (
+    "invoice contract payment amount customer account balance delivery order reference "
+    "insurance policy statement period tax office notice letter meeting schedule total "
+    "service provider address date signature agreement renewal premium claim number"
+).split()
+
+LETTER = """{company}
+Musterstrasse {house}, 12345 Musterstadt
+
+Invoice {number}
+Date: 2024-{month:02d}-{day:02d}
+
+Dear customer,
+
+{body}
+
+Total amount: {amount} EUR
+"""
+
+
+def _page_text(rng, doc_id, page_no):
+    body = "\n".join(" ".join(rng.choice(WORDS) for _ in range(12)) for _ in range(20))
+    return LETTER.format(
+        company=f"Benchmark Company {doc_id}",
+        house=rng.randint(1, 200),
+        number=f"BM-{doc_id:05d}-{page_no:04d}",
+        month=rng.randint(1, 12),
+        day=rng.randint(1, 28),
+        body=body,
+        amount=f"{rng.randint(10, 9999)}.{rng.randint(0, 99):02d}",
+    )
+
+
+def _add_text_page(doc, text):
+    page = doc.new_page(width=595, height=842)  # A4
+    page.insert_textbox(fitz.Rect(50, 50, 545, 792), text, fontsize=9)
+
+
+def _add_scanned_page(doc, text, dpi=100):
+    """Renders a text page to an image and inserts only the image, like a scan."""
+    scratch = fitz.open()
+    _add_text_page(scratch, text)
+    pixmap = scratch[0].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    scratch.close()
+    page = doc.new_page(width=595, height=842)
+    page.insert_image(page.rect, stream=pixmap.tobytes("png"))
+
+
+def build_document(path, kind, doc_id, pages, rng):
+    doc = fitz.open()
+    for page_no in range(pages):
+        text = _page_text(rng, doc_id, page_no)
+        scanned = kind == "scanned" or (kind == "mixed" and page_no % 2 == 1)
+        if scanned:
+            _add_scanned_page(doc, text)
+        else:
+            _add_text_page(doc, text)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def generate_corpus(out_dir, per_kind=5, kinds=KINDS, pages=3, large_pages=400, seed=42):
+    """
+    Writes `per_kind` documents of every kind to `out_dir`.
+
+    Returns:
+        list of (path, kind, page count)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    corpus = []
+    doc_id = 0
+    for kind in kinds:
+        for _ in range(per_kind):
+            doc_id += 1
+            page_count = large_pages if kind == "large" else pages
+            path = os.path.join(out_dir, f"{kind}_{doc_id:05d}.pdf")
+            build_document(path, kind, doc_id, page_count, rng)
+            corpus.append((path, kind, page_count))
+    return corpus
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True, help="Directory to write the PDFs to")
+    parser.add_argument("--per-kind", type=int, default=5, help="Documents per kind")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="Comma-separated kinds")
+    parser.add_argument("--pages", type=int, default=3, help="Pages of text/scanned/mixed documents")
+    parser.add_argument("--large-pages", type=int, default=400, help="Pages of large documents")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    corpus = generate_corpus(args.out, args.per_kind, args.kinds.split(","), args.pages, args.large_pages, args.seed)
+    total_pages = sum(pages for _, _, pages in corpus)
+    print(f"[INFO] {len(corpus)} documents, {total_pages} pages in {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
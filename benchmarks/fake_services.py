@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the external services of the pipeline, for benchmarks.
+
+  azure      Azure Document Intelligence (prebuilt-read analyze, result polling, searchable PDF)
+  openai     OpenAI chat completions (text refinement and metadata extraction)
+  gotenberg  Gotenberg conversions (returns a one-page PDF)
+  paperless  Paperless-ngx document upload and task polling
+
+Every service answers after a configurable latency (mean, with +-50% jitter) and fails
+with HTTP 500 at a configurable rate, so retries and backpressure show up in the numbers.
+The servers speak just enough of each API for the pipeline's clients; they run in threads
+of the calling process (`start_services`) or standalone:
+
+    python benchmarks/fake_services.py --azure-latency 2 --openai-latency 1.5 --error-rate 0.01
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import fitz  # PyMuPDF
+
+SERVICES = ("azure", "openai", "gotenberg", "paperless")
+
+
+class ServiceProfile:
+    """Latency and error behaviour of one fake service."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def delay_and_decide(self):
+        """Sleeps for the request's latency; returns True if the request should fail."""
+        with self._lock:
+            self.requests += 1
+            delay = self.latency * self._rng.uniform(0.5, 1.5) if self.latency else 0.0
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    profile = None  # Set per service by `make_server`
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        body = self._body() if method == "POST" else b""
+        if self.profile.delay_and_decide():
+            return self._send(500, {"error": {"code": "InternalServerError", "message": "Injected failure"}})
+        return self.route(method, urlparse(self.path), body)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def route(self, method, url, body):
+        self._send(404, {"error": "not found"})
+
+
+class AzureHandler(FakeServiceHandler):
+    """prebuilt-read with the searchable PDF output; results are kept in memory."""
+    operations = {}
+    operations_lock = threading.Lock()
+
+    ANALYZE = re.compile(r"/documentModels/(?P<model>[^/:]+):analyze$")
+    RESULT = re.compile(r"/documentModels/(?P<model>[^/]+)/analyzeResults/(?P<id>[^/]+)(?P<pdf>/pdf)?$")
+
+    def route(self, method, url, body):
+        match = self.ANALYZE.search(url.path)
+        if method == "POST" and match:
+            operation_id = str(uuid.uuid4())
+            with self.operations_lock:
+                self.operations[operation_id] = {"pdf": body, "model": match.group("model")}
+            location = (f"http://{self.headers['Host']}{url.path.rsplit('/', 1)[0]}/{match.group('model')}"
+                        f"/analyzeResults/{operation_id}?{url.query}")
+            return self._send(202, b"", headers={"Operation-Location": location, "apim-request-id": operation_id})
+
+        match = self.RESULT.search(url.path)
+        if method == "GET" and match:
+            with self.operations_lock:
+                operation = self.operations.get(match.group("id"))
+            if operation is None:
+                return self._send(404, {"error": {"code": "NotFound", "message": "Unknown operation"}})
+            if match.group("pdf"):
+                return self._send(200, operation["pdf"], content_type="application/pdf")
+            return self._send(200, {
+                "status": "succeeded",
+                "createdDateTime": "2024-01-01T00:00:00Z",
+                "lastUpdatedDateTime": "2024-01-01T00:00:01Z",
+                "analyzeResult": self._analyze_result(operation),
+            })
+        return super().route(method, url, body)
+
+    @staticmethod
+    def _analyze_result(operation):
+        try:
+            with fitz.open(stream=operation["pdf"], filetype="pdf") as doc:
+                page_count = doc.page_count
+        except Exception:
+            page_count = 1
+        content, pages = "", []
+        for number in range(1, page_count + 1):
+            text = f"Recognized text of page {number}. Invoice BM-{number:04d}, total amount 100.00 EUR.\n"
+            pages.append({
+                "pageNumber": number, "angle": 0, "width": 8.27, "height": 11.69, "unit": "inch",
+                "spans": [{"offset": len(content), "length": len(text)}],
+            })
+            content += text
+        return {"apiVersion": "2024-11-30", "modelId": operation["model"], "content": content, "pages": pages}
+
+
+class OpenAIHandler(FakeServiceHandler):
+    """Chat completions: metadata prompts get a JSON answer, everything else is echoed."""
+
+    METADATA = {
+        "filename": "2024-01-01_Benchmark_Invoice",
+        "empfaenger": "Unknown",
+        "absender": "Benchmark Company",
+        "correspondent": "Benchmark",
+        "kommunikationsart": "Rechnung",
+        "kommunikationskategorie": "Finanz_und_Vertragsdokumente",
+        "document_type": "Invoice",
+        "tags": ["benchmark", "invoice"],
+        "language": "en",
+        "title": "Benchmark invoice",
+        "confidence_score": 90,
+        "reference_number": "BM-0001",
+        "monetary_amounts": ["100.00 EUR"],
+    }
+
+    def route(self, method, url, body):
+        if method == "POST" and url.path.endswith("/chat/completions"):
+            request = json.loads(body or b"{}")
+            prompt = request.get("messages", [{}])[-1].get("content", "")
+            if "JSON" in prompt:
+                metadata = dict(self.METADATA, filename=f"2024-01-01_Benchmark_{uuid.uuid4().hex[:8]}")
+                answer = json.dumps(metadata)
+            else:
+                answer = prompt
+            prompt_tokens = max(1, len(prompt) // 4)
+            completion_tokens = max(1, len(answer) // 4)
+            return self._send(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4o-mini"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+        return super().route(method, url, body)
+
+
+class GotenbergHandler(FakeServiceHandler):
+    """Any conversion returns a one-page PDF."""
+
+    def route(self, method, url, body):
+        if method == "POST" and url.path.startswith("/forms/"):
+            doc = fitz.open()
+            doc.new_page().insert_text((72, 72), f"Converted by fake Gotenberg ({len(body)} bytes in)")
+            pdf = doc.tobytes()
+            doc.close()
+            return self._send(200, pdf, content_type="application/pdf")
+        if url.path == "/health":
+            return self._send(200, {"status": "up"})
+        return super().route(method, url, body)
+
+
+class PaperlessHandler(FakeServiceHandler):
+    """post_document returns a task id; tasks succeed immediately."""
+    next_document_id = 0
+    counter_lock = threading.Lock()
+
+    def route(self, method, url, body):
+        if method == "POST" and url.path.rstrip("/") == "/api/documents/post_document":
+            return self._send(200, json.dumps(str(uuid.uuid4())))
+        if method == "GET" and url.path.rstrip("/") == "/api/tasks":
+            task_id = parse_qs(url.query).get("task_id", [""])[0]
+            with self.counter_lock:
+                PaperlessHandler.next_document_id += 1
+                document_id = PaperlessHandler.next_document_id
+            return self._send(200, [{"task_id": task_id, "status": "SUCCESS", "related_document": str(document_id)}])
+        return super().route(method, url, body)
+
+
+HANDLERS = {
+    "azure": AzureHandler,
+    "openai": OpenAIHandler,
+    "gotenberg": GotenbergHandler,
+    "paperless": PaperlessHandler,
+}
+
+
+def make_server(service, profile, host="127.0.0.1", port=0):
+    handler = type(f"{service.title()}Handler", (HANDLERS[service],), {"profile": profile})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_services(profiles, host="127.0.0.1"):
+    """
+    Starts one server per service in background threads.
+
+    Args:
+        profiles: {service name: ServiceProfile}
+    Returns:
+        dict: {service name: (server, base URL)}; stop them with `stop_services`
+    """
+    running = {}
+    for service, profile in profiles.items():
+        server = make_server(service, profile, host)
+        threading.Thread(target=server.serve_forever, name=f"fake-{service}", daemon=True).start()
+        running[service] = (server, f"http://{host}:{server.server_address[1]}")
+    return running
+
+
+def stop_services(running):
+    for server, _ in running.values():
+        server.shutdown()
+        server.server_close()
+
+
+def add_profile_arguments(parser):
+    """Adds --<service>-latency/--<service>-error-rate options (and --error-rate for all)."""
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Default error rate of every service")
+    defaults = {"azure": 1.0, "openai": 0.8, "gotenberg": 0.3, "paperless": 0.2}
+    for service in SERVICES:
+        parser.add_argument(f"--{service}-latency", type=float, default=defaults[service],
+                            help=f"Mean latency of {service} in seconds (default: {defaults[service]})")
+        parser.add_argument(f"--{service}-error-rate", type=float, default=None,
+                            help=f"Error rate of {service} (default: --error-rate)")
+
+
+def profiles_from_args(args, seed=None):
+    profiles = {}
+    for service in SERVICES:
+        error_rate = getattr(args, f"{service}_error_rate")
+        profiles[service] = ServiceProfile(
+            latency=getattr(args, f"{service}_latency"),
+            error_rate=args.error_rate if error_rate is None else error_rate,
+            seed=None if seed is None else f"{seed}-{service}",
+        )
+    return profiles
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    running = start_services(profiles_from_args(args), args.host)
+    for service, (_, url) in running.items():
+        print(f"[INFO] Fake {service} listening on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stop_services(running)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
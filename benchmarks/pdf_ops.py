@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the PDF operations every document goes through.
+
+  text_extract      process_document's preflight and text extraction (inspect_document,
+                    join_page_texts)
+  page_count        get_pdf_page_count (only used for files without preflight facts)
+  rotate_one_page   rotate_pdf_pages turning a single page by 90 degrees
+  rotate_all_pages  rotate_pdf_pages turning every page by 90 degrees
+  embed_metadata    embed_metadata_into_pdf (working copy, incremental save, move, JSON sidecar)
+  embed_rotated     embed_metadata_into_pdf also turning a page whose rotation was deferred to it
+  optimize          optimize_pdf with the default image settings
+
+Every operation runs the real task code on documents of 1, 50, 500 and 2000 pages (by
+default; see --pages), each run in a fresh process, so peak memory is that operation's alone.
+Tasks are called directly; the pipeline step they would trigger next is not queued.
+Reports wall time, CPU time (including child processes, e.g. the text extraction pool),
+bytes written and peak RSS, the median over --repeat runs (peak RSS: the maximum), and writes them to
+benchmarks/results/pdf_ops_<time>_<commit>.json; compare two runs with benchmarks/compare.py.
+
+Corpora are generated once per page count and kept in --corpus-dir.
+
+Usage:
+    python benchmarks/pdf_ops.py --repeat 3
+    python benchmarks/pdf_ops.py --pages 1,500 --ops rotate_one_page,embed_metadata
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import platform
+import statistics
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import corpus  # noqa: E402
+from run_pipeline import git_commit  # noqa: E402
+
+PAGE_COUNTS = (1, 50, 500, 2000)
+
+METADATA = {
+    "filename": "2024-01-01_Benchmark_Invoice",
+    "absender": "Benchmark Company",
+    "document_type": "Invoice",
+    "tags": ["benchmark", "invoice"],
+}
+
+
+def _settings_environment(workdir):
+    """Minimal settings of the app, so its modules can be imported without a .env."""
+    return {
+        "WORKDIR": workdir,
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'benchmark.db')}",
+        "REDIS_URL": "redis://localhost:6379/15",
+        "OPENAI_API_KEY": "benchmark",
+        "AZURE_AI_KEY": "benchmark",
+        "AZURE_REGION": "benchmark",
+        "AZURE_ENDPOINT": "http://127.0.0.1:9/",
+        "GOTENBERG_URL": "http://127.0.0.1:9",
+        "METRICS_ENABLED": "false",
+        "TRACING_OTLP_ENDPOINT": "",
+        "TRACING_FILE": "",
+        # rotate_pdf_pages measures the rotation itself, not the hand-over to embed_metadata_into_pdf
+        "PDF_ROTATION_WITH_METADATA": "false",
+    }
+
+
+def _stage(pdf_path, workdir):
+    """Copies a corpus document into <workdir>/tmp, where the tasks expect their files."""
+    tmp_dir = os.path.join(workdir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    target = os.path.join(tmp_dir, os.path.basename(pdf_path))
+    shutil.copyfile(pdf_path, target)
+    return target
+
+
+def _text_extract(path):
+    from app.utils.pdf_text import join_page_texts
+    from app.utils.preflight import inspect_document
+    facts, page_texts = inspect_document(path)
+    join_page_texts(page_texts)
+    return {"pages_with_text": len(facts["text_pages"])}
+
+
+def _page_count(path):
+    from app.tasks.process_with_azure_document_intelligence import get_pdf_page_count
+    return {"page_count": get_pdf_page_count(path)}
+
+
+def _rotate(path, pages):
+    from app.tasks.rotate_pdf_pages import rotate_pdf_pages
+    result = rotate_pdf_pages(os.path.basename(path), "", {page: 90.0 for page in pages})
+    return {"status": result["status"], "error": result.get("error")}
+
+
+def _rotate_one_page(path):
+    return _rotate(path, [0])
+
+
+def _rotate_all_pages(path):
+    import fitz
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
+    return _rotate(path, range(page_count))
+
+
+def _embed_metadata(path, **kwargs):
+    from app.tasks.embed_metadata_into_pdf import embed_metadata_into_pdf
+    result = embed_metadata_into_pdf(path, "", dict(METADATA), **kwargs)
+    return {"status": result.get("status"), "error": result.get("error")}
+
+
+def _embed_rotated(path):
+    return _embed_metadata(path, rotation_data={0: 90.0})
+
+
+def _optimize(path):
+    from app.tasks.optimize_pdf import optimize_pdf
+    result = optimize_pdf(path, path, dict(METADATA))
+    return {"status": result["status"], "bytes_saved": result.get("bytes_saved"), "error": result.get("error")}
+
+
+OPERATIONS = {
+    "text_extract": _text_extract,
+    "page_count": _page_count,
+    "rotate_one_page": _rotate_one_page,
+    "rotate_all_pages": _rotate_all_pages,
+    "embed_metadata": _embed_metadata,
+    "embed_rotated": _embed_rotated,
+    "optimize": _optimize,
+}
+
+# Modules whose next pipeline step must not be queued
+TASK_MODULES = ("app.tasks.rotate_pdf_pages", "app.tasks.embed_metadata_into_pdf", "app.tasks.optimize_pdf")
+
+
+def _maxrss_kb(usage):
+    # KiB on Linux, bytes on macOS
+    return usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+
+
+def _proc_status_kb(field):
+    """A memory figure of this process from /proc/self/status in KiB (None if unavailable)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _bytes_written():
+    """Bytes this process has written so far (write calls and sendfile copies; 0 if unavailable)."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of this process to its current RSS and returns it (KiB). A fresh
+    process starts with its parent's peak (ru_maxrss survives fork and exec), which would
+    hide the operation's own. Needs Linux; elsewhere ru_maxrss is used as it is.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return _maxrss_kb(resource.getrusage(resource.RUSAGE_SELF))
+    return _proc_status_kb("VmRSS")
+
+
+def _run_once(operation, pdf_path, workdir, results):
+    """Runs one operation in this (fresh) process and measures it. Target of the child processes."""
+    import importlib
+    import app.models  # noqa: F401 - registers the tables
+    from app.database import init_db
+
+    init_db()
+    for module_name in TASK_MODULES:
+        importlib.import_module(module_name).enqueue_next = lambda task, *args, **kwargs: None
+    path = _stage(pdf_path, workdir)
+
+    baseline_kb = _reset_peak_rss()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    written_before = _bytes_written()
+    started = time.perf_counter()
+    outcome = OPERATIONS[operation](path)
+    wall = time.perf_counter() - started
+    written = _bytes_written() - written_before
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu = sum(getattr(after, field) - getattr(before, field)
+              for before, after in ((self_before, self_after), (children_before, children_after))
+              for field in ("ru_utime", "ru_stime"))
+    peak_kb = _proc_status_kb("VmHWM") or _maxrss_kb(self_after)
+    results.put({
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "written_mb": written / (1024 * 1024),
+        "peak_rss_mb": peak_kb / 1024,
+        "peak_rss_over_baseline_mb": (peak_kb - baseline_kb) / 1024,
+        "children_peak_rss_mb": _maxrss_kb(children_after) / 1024,
+        "outcome": outcome,
+    })
+
+
+def measure(operation, pdf_path, workdir, repeat):
+    """Runs an operation `repeat` times, each in a fresh process; returns the aggregated numbers."""
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=_run_once, args=(operation, pdf_path, workdir, results))
+        process.start()
+        try:
+            run = results.get(timeout=3600)
+        finally:
+            process.join()
+        runs.append(run)
+        # Every run starts from the same state
+        shutil.rmtree(os.path.join(workdir, "tmp"), ignore_errors=True)
+        shutil.rmtree(os.path.join(workdir, "processed"), ignore_errors=True)
+    return {
+        "runs": len(runs),
+        "wall_seconds": round(statistics.median(run["wall_seconds"] for run in runs), 4),
+        "cpu_seconds": round(statistics.median(run["cpu_seconds"] for run in runs), 4),
+        "written_mb": round(statistics.median(run["written_mb"] for run in runs), 3),
+        "peak_rss_mb": round(max(run["peak_rss_mb"] for run in runs), 1),
+        "peak_rss_over_baseline_mb": round(max(run["peak_rss_over_baseline_mb"] for run in runs), 1),
+        "children_peak_rss_mb": round(max(run["children_peak_rss_mb"] for run in runs), 1),
+        "outcome": runs[-1]["outcome"],
+    }
+
+
+def ensure_corpus(corpus_dir, pages, kind, seed):
+    """Returns the path of the `pages`-page document of `kind`, generating it if needed."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    path = os.path.join(corpus_dir, f"{kind}_{pages:05d}p_seed{seed}.pdf")
+    if not os.path.exists(path):
+        print(f"[INFO] Generating {path}")
+        corpus.build_document(path, kind, pages, pages, random.Random(seed))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", default=",".join(map(str, PAGE_COUNTS)), help="Comma-separated page counts")
+    parser.add_argument("--ops", default=",".join(OPERATIONS), help="Comma-separated operations")
+    parser.add_argument("--kind", default="mixed", choices=corpus.KINDS[:3],
+                        help="Kind of corpus documents (see corpus.py)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per operation and page count")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "docuelevate-pdf-corpus"))
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/pdf_ops_<time>_<commit>.json)")
+    args = parser.parse_args(argv)
+
+    operations = args.ops.split(",")
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"Unknown operations: {', '.join(sorted(unknown))}")
+    page_counts = [int(pages) for pages in args.pages.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="docuelevate-pdf-ops-")
+    # Inherited by the child processes; the app reads .env from the working directory
+    os.environ.update(_settings_environment(workdir))
+    os.chdir(workdir)
+
+    results = {}
+    try:
+        for pages in page_counts:
+            pdf_path = ensure_corpus(args.corpus_dir, pages, args.kind, args.seed)
+            for operation in operations:
+                stats = measure(operation, pdf_path, workdir, args.repeat)
+                stats["file_mb"] = round(os.path.getsize(pdf_path) / (1024 * 1024), 2)
+                results.setdefault(operation, {})[str(pages)] = stats
+                print(f"[INFO] {operation:<17} {pages:>5} pages: wall {stats['wall_seconds']:8.3f}s  "
+                      f"cpu {stats['cpu_seconds']:8.3f}s  written {stats['written_mb']:8.2f} MB  peak RSS {stats['peak_rss_mb']:7.1f} MB "
+                      f"(+{stats['peak_rss_over_baseline_mb']:.1f})  {stats['outcome']}")
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = git_commit()
+    report = {
+        "suite": "pdf_ops",
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "host": {"node": platform.node(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {"pages": page_counts, "kind": args.kind, "repeat": args.repeat, "seed": args.seed},
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        BENCH_DIR, "results",
+        f"pdf_ops_{datetime.now().strftime('%Y%m%d-%H%M%S')}_{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
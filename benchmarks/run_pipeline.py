@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the document pipeline.
+
+Generates a synthetic corpus (benchmarks/corpus.py), starts the fake Azure, OpenAI, Gotenberg
+and Paperless services (benchmarks/fake_services.py) and a real Celery worker consuming all
+queues, submits every document with `process_document` and waits until each pipeline has
+completed (all uploads reported) or failed. Reports:
+
+  - documents per minute (submission of the first document to the end of the last one)
+  - p50/p95 end-to-end latency and p50/p95 latency per step, from the pipeline checkpoints
+    in ProcessingLog (each step is measured from the previous checkpoint of the document)
+  - peak RSS of the worker (sum over its processes, sampled) and of its largest process
+  - requests and injected errors per fake service
+
+and writes them to benchmarks/results/<time>_<commit>.json; compare two runs with
+benchmarks/compare.py.
+
+Needs a Redis server. The run uses its own work directory and SQLite database, and FLUSHES
+the Redis database given by --redis-url (db 15 by default) before it starts.
+
+Usage:
+    python benchmarks/run_pipeline.py --per-kind 10 --concurrency 4 --openai-latency 1.5
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import signal
+import hashlib
+import argparse
+import resource
+import tempfile
+import platform
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import corpus  # noqa: E402
+import fake_services  # noqa: E402
+
+QUEUES = "pdf,ocr,llm,upload,default"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100.0 * len(ordered))) - 1]
+
+
+def summarize(values):
+    if not values:
+        return {"n": 0, "p50": None, "p95": None, "mean": None, "max": None}
+    return {
+        "n": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "mean": round(sum(values) / len(values), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _naive_utc(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--", "app"], cwd=REPO_DIR, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+class RssSampler(threading.Thread):
+    """Samples the RSS of a process tree from /proc (Linux) and keeps the peaks."""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_total_kb = 0
+        self.peak_process_kb = 0
+        self._stopped = threading.Event()
+
+    def _tree(self, pid):
+        pids = [pid]
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    for child in f.read().split():
+                        pids.extend(self._tree(int(child)))
+        except OSError:
+            pass
+        return pids
+
+    @staticmethod
+    def _rss_kb(pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+        while not self._stopped.is_set():
+            sizes = [self._rss_kb(pid) for pid in self._tree(self.pid)]
+            self.peak_total_kb = max(self.peak_total_kb, sum(sizes))
+            self.peak_process_kb = max([self.peak_process_kb] + sizes)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def configure_environment(args, workdir, urls):
+    """Settings of the app under test; must be set before anything from `app` is imported."""
+    env = {
+        "WORKDIR": workdir,
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'benchmark.db')}",
+        "REDIS_URL": args.redis_url,
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": urls["openai"] + "/v1",
+        "AZURE_AI_KEY": "benchmark",
+        "AZURE_REGION": "benchmark",
+        "AZURE_ENDPOINT": urls["azure"] + "/",
+        "GOTENBERG_URL": urls["gotenberg"],
+        "PAPERLESS_HOST": urls["paperless"],
+        "PAPERLESS_NGX_API_TOKEN": "benchmark",
+        "METRICS_ENABLED": "false",
+        "TRACING_OTLP_ENDPOINT": "",
+        "TRACING_FILE": "",
+        "ADMISSION_CONTROL_ENABLED": "false",
+    }
+    for assignment in args.setting:
+        name, _, value = assignment.partition("=")
+        env[name.upper()] = value
+    os.environ.update(env)
+    return env
+
+
+def start_worker(args, workdir):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    log = open(os.path.join(workdir, "worker.log"), "w")
+    command = [
+        sys.executable, "-m", "celery", "-A", "app.celery_worker", "worker",
+        "-Q", QUEUES, "--concurrency", str(args.concurrency), "--loglevel", args.worker_loglevel,
+        "--without-gossip", "--without-mingle", "--hostname", f"benchmark@{platform.node()}",
+    ]
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+def wait_for_worker(worker, timeout=120):
+    """Waits until the worker answers a ping, so its start-up doesn't count as pipeline time."""
+    from app.celery_app import celery
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if worker.poll() is not None:
+            raise RuntimeError("The Celery worker exited during start-up, see worker.log")
+        if celery.control.ping(timeout=1.0):
+            return
+    raise RuntimeError(f"The Celery worker did not come up within {timeout}s, see worker.log")
+
+
+def stop_worker(worker, timeout=60):
+    """Warm shutdown, so buffered ProcessingLog rows are written."""
+    worker.send_signal(signal.SIGTERM)
+    try:
+        worker.wait(timeout)
+    except subprocess.TimeoutExpired:
+        worker.kill()
+        worker.wait()
+
+
+def wait_for_pipelines(hashes, timeout, poll_interval=1.0):
+    """
+    Waits until every document has failed, or completed with no upload still queued.
+
+    Returns:
+        dict: {file hash: final PipelineState dict or None (timed out)}
+    """
+    from app.database import SessionLocal
+    from app.models import FileRecord
+    from app.utils.pipeline_state import get_state, STATUS_FAILED, STATUS_COMPLETED
+
+    deadline = time.monotonic() + timeout
+    finished = {}
+    while time.monotonic() < deadline and len(finished) < len(hashes):
+        with SessionLocal() as db:
+            file_ids = dict(db.query(FileRecord.filehash, FileRecord.id).filter(FileRecord.filehash.in_(hashes)))
+        for filehash, file_id in file_ids.items():
+            if filehash in finished:
+                continue
+            state = get_state(file_id)
+            if state is None:
+                continue
+            if state["status"] == STATUS_FAILED or (
+                    state["status"] == STATUS_COMPLETED and "queued" not in state["uploads"].values()):
+                finished[filehash] = dict(state, file_id=file_id)
+        print(f"\r[INFO] {len(finished)}/{len(hashes)} documents finished", end="", flush=True)
+        if len(finished) < len(hashes):
+            time.sleep(poll_interval)
+    print()
+    return {filehash: finished.get(filehash) for filehash in hashes}
+
+
+def step_latencies(file_id, submitted_at):
+    """
+    Per-step latencies of one document from its ProcessingLog checkpoints.
+
+    Returns:
+        (dict {step: seconds}, time of the last checkpoint or None)
+    """
+    from app.database import SessionLocal
+    from app.models import ProcessingLog
+
+    with SessionLocal() as db:
+        rows = (db.query(ProcessingLog.step_name, ProcessingLog.status, ProcessingLog.timestamp)
+                .filter(ProcessingLog.file_id == file_id)
+                .order_by(ProcessingLog.timestamp, ProcessingLog.id).all())
+    steps = {}
+    previous = _naive_utc(submitted_at)
+    completed_at = None
+    end = None
+    for step, status, timestamp in rows:
+        if timestamp is None:
+            continue
+        timestamp = _naive_utc(timestamp)
+        if step.startswith("upload_"):
+            # Uploads run in parallel once the pipeline has queued them
+            steps[step] = (timestamp - (completed_at or previous)).total_seconds()
+        else:
+            steps[step] = (timestamp - previous).total_seconds()
+            previous = timestamp
+            if step == "completed":
+                completed_at = timestamp
+        end = max(end, timestamp) if end else timestamp
+    return steps, end
+
+
+def analyze(documents, finished, started, waited_until):
+    """Aggregates the results of a run; `documents` are (path, kind, pages, hash, submitted_at)."""
+    started = _naive_utc(started)
+    ended = None
+    step_values = {}
+    end_to_end = []
+    by_kind = {}
+    outcome = {"completed": 0, "failed": 0, "timed_out": 0}
+    for path, kind, pages, filehash, submitted_at in documents:
+        state = finished.get(filehash)
+        if state is None:
+            outcome["timed_out"] += 1
+            continue
+        outcome["completed" if state["status"] == "completed" else "failed"] += 1
+        steps, end = step_latencies(state["file_id"], submitted_at)
+        for step, seconds in steps.items():
+            step_values.setdefault(step, []).append(seconds)
+        if end is None:
+            continue
+        ended = max(ended, end) if ended else end
+        if state["status"] == "completed":
+            total = (end - _naive_utc(submitted_at)).total_seconds()
+            end_to_end.append(total)
+            by_kind.setdefault(kind, []).append(total)
+    # Timed out documents never ended: the run lasted until we stopped waiting
+    if ended is None or outcome["timed_out"]:
+        ended = _naive_utc(waited_until)
+    wall = max((ended - started).total_seconds(), 1e-9)
+    return {
+        "documents": len(documents),
+        "pages": sum(pages for _, _, pages, _, _ in documents),
+        **outcome,
+        "wall_seconds": round(wall, 3),
+        "documents_per_minute": round(outcome["completed"] / wall * 60, 3),
+        "latency_seconds": {
+            "end_to_end": summarize(end_to_end),
+            "end_to_end_by_kind": {kind: summarize(values) for kind, values in sorted(by_kind.items())},
+            "steps": {step: summarize(values) for step, values in sorted(step_values.items())},
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--per-kind", type=int, default=5, help="Documents per corpus kind")
+    parser.add_argument("--kinds", default=",".join(corpus.KINDS), help="Comma-separated corpus kinds")
+    parser.add_argument("--pages", type=int, default=3, help="Pages of text/scanned/mixed documents")
+    parser.add_argument("--large-pages", type=int, default=400, help="Pages of large documents")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=4, help="Worker processes")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15", help="Flushed before the run!")
+    parser.add_argument("--timeout", type=float, default=1800, help="Seconds to wait for all documents")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra setting of the app under test, e.g. FUSED_PIPELINE_MAX_PAGES=0")
+    parser.add_argument("--worker-loglevel", default="WARNING")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the work directory (DB, worker log)")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/<time>_<commit>.json)")
+    fake_services.add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="docuelevate-bench-")
+    profiles = fake_services.profiles_from_args(args, seed=args.seed)
+    services = fake_services.start_services(profiles)
+    urls = {service: url for service, (_, url) in services.items()}
+    configure_environment(args, workdir, urls)
+    # The app reads .env from the working directory; keep a developer's .env out of the run
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    import redis
+    import app.models  # noqa: F401 - registers the tables
+    from app.database import init_db
+
+    redis.Redis.from_url(args.redis_url).flushdb()
+    init_db()
+
+    print(f"[INFO] Generating corpus in {workdir}")
+    kinds = args.kinds.split(",")
+    generated = corpus.generate_corpus(os.path.join(workdir, "corpus"), args.per_kind, kinds,
+                                       args.pages, args.large_pages, args.seed)
+    inbox = os.path.join(workdir, "inbox")
+    os.makedirs(inbox, exist_ok=True)
+
+    worker, worker_log = start_worker(args, workdir)
+    sampler = RssSampler(worker.pid)
+    sampler.start()
+
+    from app.tasks.process_document import process_document
+
+    commit, dirty = git_commit()
+    documents = []
+    try:
+        wait_for_worker(worker)
+        started = datetime.now(timezone.utc)
+        for path, kind, pages in generated:
+            target = os.path.join(inbox, os.path.basename(path))
+            shutil.copyfile(path, target)
+            filehash = _sha256(target)
+            submitted_at = datetime.now(timezone.utc)
+            process_document.apply_async((target,), {"filehash": filehash, "file_size": os.path.getsize(target)})
+            documents.append((path, kind, pages, filehash, submitted_at))
+        print(f"[INFO] Submitted {len(documents)} documents ({sum(d[2] for d in documents)} pages)")
+
+        finished = wait_for_pipelines([d[3] for d in documents], args.timeout)
+        waited_until = datetime.now(timezone.utc)
+    finally:
+        sampler.stop()
+        stop_worker(worker)
+        worker_log.close()
+        fake_services.stop_services(services)
+
+    # ru_maxrss of waited-for children is in KiB on Linux, bytes on macOS
+    children_maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        children_maxrss //= 1024
+
+    results = analyze(documents, finished, started, waited_until)
+    results["peak_rss_mb"] = {
+        "worker_total": round(sampler.peak_total_kb / 1024, 1) or None,
+        "largest_process": round(max(sampler.peak_process_kb, children_maxrss) / 1024, 1),
+    }
+    results["service_requests"] = {
+        service: {"requests": profile.requests, "errors": profile.errors} for service, profile in profiles.items()
+    }
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": {"node": platform.node(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ("output", "keep_workdir", "worker_loglevel")
+        },
+        "results": results,
+    }
+
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    latency = results["latency_seconds"]
+    print(f"[INFO] {results['completed']} completed, {results['failed']} failed, {results['timed_out']} timed out "
+          f"in {results['wall_seconds']}s: {results['documents_per_minute']} documents/minute")
+    print(f"[INFO] End-to-end p50 {latency['end_to_end']['p50']}s, p95 {latency['end_to_end']['p95']}s")
+    for step, stats in latency["steps"].items():
+        print(f"[INFO]   {step:<22} p50 {stats['p50']}s  p95 {stats['p95']}s  (n={stats['n']})")
+    print(f"[INFO] Peak RSS: {results['peak_rss_mb']}")
+    print(f"[INFO] Results written to {output}")
+
+    if args.keep_workdir:
+        print(f"[INFO] Work directory kept: {workdir}")
+    else:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if results["timed_out"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
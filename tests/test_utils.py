@@ -1,9 +1,131 @@
 import os
 import tempfile
 import unittest
-from app.utils import hash_file
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from app.database import Base
+from app.utils import hash_file, stage_file, atomic_write
+from app.utils.pdf_text import extract_page_texts, page_has_text_layer, join_page_texts
+from app.utils.ocr_planner import plan_ocr, merge_page_texts, remap_page_indices
+from app.utils import result_cache, blob_store
+
+class FakeRedis:
+    """In-memory stand-in for the few Redis commands the tested helpers use"""
+
+    def __init__(self, scripts=None):
+        self.data = {}
+        self.scripts = scripts or {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    # Strings
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def scan_iter(self, match="*", count=None):
+        prefix = match.rstrip("*")
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+    def memory_usage(self, key):
+        return len(self.data[key]) if key in self.data else None
+
+    # Lists
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(str(v) for v in values)
+        return len(self.data[key])
+
+    def llen(self, key):
+        return len(self.data.get(key, []))
+
+    # Hashes
+    def hset(self, key, field, value):
+        added = field not in self.data.setdefault(key, {})
+        self.data[key][field] = str(value)
+        return int(added)
+
+    def hdel(self, key, *fields):
+        hash_ = self.data.get(key, {})
+        return sum(1 for field in fields if hash_.pop(field, None) is not None)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    # Sorted sets
+    def zadd(self, key, mapping, nx=False):
+        zset = self.data.setdefault(key, {})
+        added = 0
+        for member, score in mapping.items():
+            if member in zset and nx:
+                continue
+            added += member not in zset
+            zset[member] = score
+        return added
+
+    def zrem(self, key, *members):
+        zset = self.data.get(key, {})
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+
+    def zremrangebyscore(self, key, low, high):
+        zset = self.data.get(key, {})
+        low = float("-inf") if low == "-inf" else float(low)
+        stale = [member for member, score in zset.items() if low <= score <= float(high)]
+        for member in stale:
+            del zset[member]
+        return len(stale)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    # Scripts: there is no Lua here, tests register a Python equivalent of each script
+    def eval(self, script, numkeys, *args):
+        return self.scripts[script](self, args[:numkeys], args[numkeys:])
+
+
+class FakePipeline:
+    """Queues commands of a FakeRedis and runs them on execute()"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((getattr(self.client, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self.calls]
+        self.calls = []
+        return results
+
 
 class TestUtils(unittest.TestCase):
+    def _in_memory_db(self):
+        """Returns a session factory for a fresh in-memory SQLite database with all tables"""
+        import app.models  # noqa: F401 - registers the tables
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        return sessionmaker(bind=engine)
+
     def test_hash_file_empty(self):
         """Test hashing an empty file"""
         with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
@@ -45,5 +167,986 @@ class TestUtils(unittest.TestCase):
         finally:
             os.unlink(tmp_file.name)
 
+    def test_stage_file_keeps_source(self):
+        """Test staging a file while keeping the source in place"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "src.pdf")
+            dst = os.path.join(tmp_dir, "dst.pdf")
+            with open(src, "wb") as f:
+                f.write(b"%PDF-1.4 test")
+
+            strategy = stage_file(src, dst, keep_source=True)
+
+            self.assertIn(strategy, ("reflink", "hardlink", "copy"))
+            self.assertTrue(os.path.exists(src))
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), b"%PDF-1.4 test")
+
+    def test_stage_file_consumes_source(self):
+        """Test that staging without keeping the source renames on the same filesystem"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "src.pdf")
+            dst = os.path.join(tmp_dir, "dst.pdf")
+            with open(src, "wb") as f:
+                f.write(b"data")
+
+            self.assertEqual(stage_file(src, dst, keep_source=False), "rename")
+            self.assertFalse(os.path.exists(src))
+            self.assertTrue(os.path.exists(dst))
+
+    def test_atomic_write_does_not_touch_hardlinks(self):
+        """Test that atomic_write replaces the file instead of writing through a hardlink"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "src.pdf")
+            dst = os.path.join(tmp_dir, "dst.pdf")
+            with open(src, "wb") as f:
+                f.write(b"original")
+            os.link(src, dst)
+
+            with atomic_write(dst, "wb") as f:
+                f.write(b"replaced")
+
+            with open(src, "rb") as f:
+                self.assertEqual(f.read(), b"original")
+            with open(dst, "rb") as f:
+                self.assertEqual(f.read(), b"replaced")
+            # No temporary .part file is left behind
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["dst.pdf", "src.pdf"])
+
+    def test_extract_page_texts_parallel_matches_sequential(self):
+        """Test that page-parallel extraction returns the same pages in the same order"""
+        import fitz
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path = os.path.join(tmp_dir, "doc.pdf")
+            with fitz.open() as doc:
+                for i in range(7):
+                    page = doc.new_page()
+                    if i != 3:  # page 4 has no text layer
+                        page.insert_text((72, 72), f"Page number {i + 1}")
+                doc.save(pdf_path)
+
+            sequential = extract_page_texts(pdf_path, parallel_page_threshold=0)
+            parallel = extract_page_texts(pdf_path, parallel_page_threshold=2, max_workers=3)
+
+            self.assertEqual(sequential, parallel)
+            self.assertEqual([page_has_text_layer(t) for t in parallel],
+                             [True, True, True, False, True, True, True])
+            self.assertIn("Page number 7", join_page_texts(parallel))
+
+    def test_plan_ocr_only_image_pages(self):
+        """Test that only image-only pages are planned for OCR and spliced back in order"""
+        self.assertEqual(plan_ocr([True, True])["mode"], "none")
+        self.assertEqual(plan_ocr([False, False])["mode"], "full")
+
+        plan = plan_ocr([True, False, True, False])
+        self.assertEqual(plan, {"mode": "partial", "ocr_pages": [1, 3]})
+
+        merged = merge_page_texts(["cover", "", "body", ""], ["scan 1", "scan 2"], plan["ocr_pages"])
+        self.assertEqual(merged, ["cover", "scan 1", "body", "scan 2"])
+        self.assertEqual(remap_page_indices({"1": 90.0}, plan["ocr_pages"]), {3: 90.0})
+
+    def test_result_cache_roundtrip_and_eviction(self):
+        """Test that cached values and blobs come back and old entries are evicted first"""
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(result_cache.settings, "workdir", tmp_dir), \
+                mock.patch.object(result_cache, "_count"):
+            blob = os.path.join(tmp_dir, "searchable.pdf")
+            with open(blob, "wb") as f:
+                f.write(b"%PDF-1.4 ocr")
+            key = result_cache.cache_key("filehash", "prebuilt-read")
+            result_cache.put_cached("ocr", key, {"content": "text"}, blob_source=blob)
+
+            restored = os.path.join(tmp_dir, "restored.pdf")
+            self.assertEqual(result_cache.get_cached("ocr", key, blob_target=restored), {"content": "text"})
+            with open(restored, "rb") as f:
+                self.assertEqual(f.read(), b"%PDF-1.4 ocr")
+            self.assertIsNone(result_cache.get_cached("ocr", result_cache.cache_key("other", "prebuilt-read")))
+
+            newer = result_cache.cache_key("newer")
+            result_cache.put_cached("refine", newer, {"cleaned_text": "x"})
+            os.utime(result_cache._entry_paths("ocr", key)[0], (0, 0))
+            self.assertEqual(result_cache.evict_cache(max_bytes=40), 1)
+            self.assertIsNone(result_cache.get_cached("ocr", key))
+            self.assertIsNotNone(result_cache.get_cached("refine", newer))
+
+    def test_result_cache_evicts_at_most_once_per_interval(self):
+        """Test that storing entries does not walk the whole cache on every write"""
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(result_cache.settings, "workdir", tmp_dir), \
+                mock.patch.object(result_cache, "redis_client", FakeRedis()), \
+                mock.patch.object(result_cache, "evict_cache") as evict_cache:
+            for i in range(3):
+                result_cache.put_cached("refine", result_cache.cache_key(i), {"cleaned_text": "x"})
+        evict_cache.assert_called_once_with()
+
+    def test_ocr_cache_key_is_derived_from_the_file_hash(self):
+        """Test that OCR results are cached by the document's hash and, for sub-PDFs, its pages"""
+        import importlib
+        azure = importlib.import_module("app.tasks.process_with_azure_document_intelligence")
+        self.assertEqual(azure.ocr_cache_key("abc"), result_cache.cache_key("abc", azure.OCR_MODEL_ID))
+        self.assertNotEqual(azure.ocr_cache_key("abc", [1, 2]), azure.ocr_cache_key("abc"))
+        self.assertNotEqual(azure.ocr_cache_key("abc", [1, 2]), azure.ocr_cache_key("abc", [1, 3]))
+        with mock.patch.object(azure, "find_filehash_by_local_filename", return_value=None):
+            self.assertIsNone(azure._lookup_ocr_cache_key("/w/tmp/doc.pdf"))
+
+    def test_blob_store_passes_large_texts_by_reference(self):
+        """Test that large texts become short references and small texts stay inline"""
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(blob_store.settings, "workdir", tmp_dir), \
+                mock.patch.object(blob_store.settings, "blob_inline_threshold_bytes", 1024):
+            self.assertEqual(blob_store.put_text("short text"), "short text")
+
+            text = "Seite mit Text äöü\n" * 1000
+            ref = blob_store.put_text(text)
+            self.assertTrue(blob_store.is_blob_ref(ref))
+            self.assertLess(len(ref), 100)
+            self.assertEqual(blob_store.put_text(text), ref)  # content-addressed
+            self.assertEqual(blob_store.get_text(ref), text)
+            self.assertEqual(blob_store.get_text("short text"), "short text")
+
+            # Per-page texts: the list itself if small, a reference to its JSON otherwise
+            self.assertEqual(blob_store.put_json(["a", "b"]), ["a", "b"])
+            pages_ref = blob_store.put_json([text, "", text])
+            self.assertTrue(blob_store.is_blob_ref(pages_ref))
+            self.assertEqual(blob_store.get_json(pages_ref), [text, "", text])
+            self.assertEqual(blob_store.get_json(["a"]), ["a"])
+
+            self.assertEqual(blob_store.purge_expired_blobs(max_age_seconds=3600), 0)
+            self.assertEqual(blob_store.purge_expired_blobs(max_age_seconds=-1), 2)
+
+    def test_enqueue_next_runs_inline_when_fused(self):
+        """Test that fused mode calls the next step directly and queues it if it fails"""
+        from app.tasks.pipeline import enqueue_next, fused_pipeline
+
+        class FakeStep:
+            name = "fake_step"
+
+            def __init__(self, fail=False):
+                self.fail, self.called, self.queued = fail, [], []
+
+            def __call__(self, *args):
+                self.called.append(args)
+                if self.fail:
+                    raise RuntimeError("service unavailable")
+                return "inline"
+
+            def apply_async(self, args, kwargs, priority=None):
+                self.queued.append(args)
+                return "queued"
+
+        step = FakeStep()
+        self.assertEqual(enqueue_next(step, "doc.pdf"), "queued")
+        with fused_pipeline():
+            self.assertEqual(enqueue_next(step, "doc.pdf"), "inline")
+
+        failing = FakeStep(fail=True)
+        with fused_pipeline():
+            self.assertEqual(enqueue_next(failing, "doc.pdf"), "queued")
+        self.assertEqual(failing.called, [("doc.pdf",)])
+        self.assertEqual(failing.queued, [("doc.pdf",)])
+
+    def test_pipeline_state_checkpoints(self):
+        """Test that checkpoints, failures and upload outcomes are recorded per document"""
+        from app.models import FileRecord
+        from app.utils import pipeline_state
+        from app.utils.logging import flush_processing_log
+
+        Session = self._in_memory_db()
+        with Session() as db:
+            db.add(FileRecord(filehash="abc", original_filename="a.pdf", local_filename="/w/tmp/a.pdf",
+                              file_size=1, mime_type="application/pdf"))
+            db.commit()
+
+        with mock.patch.object(pipeline_state, "SessionLocal", Session), \
+                mock.patch("app.utils.logging.SessionLocal", Session), \
+                mock.patch("app.utils.deduplication.release_pipeline_lease_for_file"):
+            pipeline_state.checkpoint("/w/tmp/a.pdf", pipeline_state.STATE_STAGED)
+            pipeline_state.checkpoint("/w/tmp/a.pdf", pipeline_state.STATE_TEXT_EXTRACTED,
+                                      text_ref="blob://x", rotation_data={0: 90})
+            pipeline_state.fail_pipeline("/w/tmp/a.pdf", "OCR failed")
+            state = pipeline_state.get_state(1)
+            self.assertEqual((state["state"], state["status"]), ("text_extracted", "failed"))
+            self.assertEqual(state["rotation_data"], {"0": 90})
+
+            pipeline_state.checkpoint("/w/tmp/a.pdf", pipeline_state.STATE_EMBEDDED, processed_file="/w/p/a.pdf")
+            pipeline_state.record_upload("/w/p/a.pdf", "dropbox", "failure")
+            pipeline_state.complete_pipeline("/w/p/a.pdf", {"dropbox": "queued", "s3": "queued"})
+            flush_processing_log()
+            state = pipeline_state.get_state(1)
+            self.assertEqual(state["status"], "completed")
+            self.assertEqual(state["uploads"], {"dropbox": "failure", "s3": "queued"})
+
+    def test_processing_log_is_written_in_batches(self):
+        """Test that progress rows are buffered and bulk-inserted on flush"""
+        from app.models import ProcessingLog
+        from app.utils import logging as processing_log
+
+        Session = self._in_memory_db()
+
+        with mock.patch.object(processing_log, "SessionLocal", Session), \
+                mock.patch.object(processing_log.settings, "processing_log_batch_size", 3):
+            processing_log.log_task_progress("t1", "staged", "success", file_id=1)
+            processing_log.log_task_progress("t1", "pdf_ready", "success", file_id=1)
+            with Session() as db:
+                self.assertEqual(db.query(ProcessingLog).count(), 0)
+
+            # Reaching the batch size writes the whole batch
+            processing_log.log_task_progress("t2", "embedded", "failure", message="boom", file_id=1)
+            with Session() as db:
+                self.assertEqual(db.query(ProcessingLog).count(), 3)
+
+            processing_log.log_task_progress("t3", "completed", "success", file_id=1)
+            self.assertEqual(processing_log.flush_processing_log(), 1)
+            with Session() as db:
+                self.assertEqual([row.step_name for row in db.query(ProcessingLog).order_by(ProcessingLog.id)],
+                                 ["staged", "pdf_ready", "embedded", "completed"])
+
+    def test_rotate_pdf_in_place_appends_and_keeps_hardlinks(self):
+        """Test that rotation only appends to the PDF and doesn't write through a hardlink"""
+        import fitz
+        from app.utils.pdf_rotation import rotate_pdf_in_place, page_rotations
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src = os.path.join(tmp_dir, "src.pdf")
+            dst = os.path.join(tmp_dir, "dst.pdf")
+            with fitz.open() as doc:
+                for _ in range(3):
+                    doc.new_page()
+                doc.save(src)
+            with open(src, "rb") as f:
+                original = f.read()
+            os.link(src, dst)
+
+            # Azure reports the angle of the content; /Rotate turns the page back clockwise
+            self.assertEqual(page_rotations({"1": 270, "2": 0.4}), {1: 90})
+            applied = rotate_pdf_in_place(dst, {"1": 270, "2": 0.4})
+
+            self.assertEqual(applied, {"1": 90})
+            with fitz.open(dst) as doc:
+                self.assertEqual([page.rotation for page in doc], [0, 90, 0])
+            with open(dst, "rb") as f:
+                self.assertTrue(f.read().startswith(original))  # incremental save
+            with open(src, "rb") as f:
+                self.assertEqual(f.read(), original)
+
+    def test_embed_metadata_saves_next_to_destination(self):
+        """Test that embedding turns the working copy into the processed file, or restores it on failure"""
+        import fitz
+        from app.tasks import embed_metadata_into_pdf as embed_module
+        with tempfile.TemporaryDirectory() as workdir:
+            tmp_dir, processed_dir = os.path.join(workdir, "tmp"), os.path.join(workdir, "processed")
+            os.makedirs(tmp_dir)
+            working = os.path.join(tmp_dir, "doc.pdf")
+            with fitz.open() as doc:
+                doc.new_page()
+                doc.save(working)
+            with open(working, "rb") as f:
+                original = f.read()
+            metadata = {"filename": "2024-01-01_Invoice", "tags": ["invoice"]}
+
+            with mock.patch.object(embed_module.settings, "workdir", workdir), \
+                    mock.patch.object(embed_module, "enqueue_next"), \
+                    mock.patch.object(embed_module, "checkpoint"), \
+                    mock.patch.object(embed_module, "fail_pipeline"):
+                with mock.patch.object(embed_module, "save_in_place", side_effect=RuntimeError("disk full")):
+                    self.assertIn("error", embed_module.embed_metadata_into_pdf(working, "", metadata))
+                with open(working, "rb") as f:
+                    self.assertEqual(f.read(), original)
+                self.assertEqual(os.listdir(processed_dir), [])
+
+                result = embed_module.embed_metadata_into_pdf(working, "", metadata)
+
+            self.assertEqual(result["staging"], {"working_copy": "rename"})
+            self.assertFalse(os.path.exists(working))
+            self.assertEqual(sorted(os.listdir(processed_dir)), ["2024-01-01_Invoice.json", "2024-01-01_Invoice.pdf"])
+            with open(result["file"], "rb") as f:
+                self.assertTrue(f.read().startswith(original))  # only the metadata update was appended
+            with fitz.open(result["file"]) as doc:
+                self.assertEqual(doc.metadata["keywords"], "invoice")
+
+    def test_preflight_facts_are_stored_by_hash(self):
+        """Test that preflight records page count and text pages once and reads them back"""
+        import fitz
+        from app.models import FileRecord
+        from app.utils import preflight
+
+        self.assertEqual(preflight.encode_page_set([7, 0, 1, 2, 3]), "0-3,7")
+        self.assertEqual(preflight.decode_page_set("0-3,7"), [0, 1, 2, 3, 7])
+
+        Session = self._in_memory_db()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "doc.pdf")
+            with fitz.open() as doc:
+                for i in range(3):
+                    page = doc.new_page()
+                    if i != 1:
+                        page.insert_text((72, 72), f"Page {i}")
+                doc.save(path)
+            with Session() as db:
+                db.add(FileRecord(filehash="abc", original_filename="doc.pdf", local_filename=path,
+                                  file_size=os.path.getsize(path), mime_type="application/pdf"))
+                db.commit()
+
+            with mock.patch.object(fitz, "open", wraps=fitz.open) as fitz_open:
+                facts, page_texts = preflight.inspect_document(path)
+            fitz_open.assert_called_once_with(path)  # facts and texts come from one parse
+            self.assertEqual((facts["page_count"], facts["text_pages"]), (3, [0, 2]))
+            self.assertEqual(len(page_texts), 3)
+            with mock.patch.object(preflight, "SessionLocal", Session):
+                preflight.store_facts(path, facts)
+                stored = preflight.get_facts(filehash="abc")
+                self.assertEqual(preflight.get_facts(local_filename=path), stored)
+        self.assertEqual(stored["text_pages"], [0, 2])
+        self.assertEqual((stored["page_count"], stored["encrypted"], stored["mime_type"]),
+                         (3, False, "application/pdf"))
+
+    def test_optimize_pdf_shrinks_images_and_keeps_smaller_file_only(self):
+        """Test that optimization recompresses images and never replaces a PDF by a larger one"""
+        import fitz
+        from app.utils.pdf_optimizer import optimize_pdf_file
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "scan.pdf")
+            pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 1200, 1600), False)
+            pix.clear_with(180)
+            with fitz.open() as doc:
+                for _ in range(2):
+                    page = doc.new_page()
+                    page.insert_image(page.rect, pixmap=pix)
+                    page.insert_text((72, 72), "Invoice")
+                doc.save(path)
+
+            result = optimize_pdf_file(path, image_dpi=75, image_quality=60)
+            self.assertTrue(result["replaced"])
+            self.assertEqual(result["bytes_saved"], result["bytes_before"] - os.path.getsize(path))
+            with fitz.open(path) as doc:
+                self.assertEqual([page.get_text().strip() for page in doc], ["Invoice", "Invoice"])
+
+            with open(path, "rb") as f:
+                optimized = f.read()
+            result = optimize_pdf_file(path, image_dpi=75, image_quality=60)
+            self.assertEqual((result["replaced"], result["bytes_saved"]), (False, 0))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), optimized)
+            self.assertEqual([name for name in os.listdir(tmp_dir) if name.endswith(".part")], [])
+
+    def test_optimize_pdf_keeps_pdfa_free_of_object_streams(self):
+        """Test that PDF/A files are written without object streams and are not linearized"""
+        import shutil
+        import fitz
+        from app.utils import pdf_optimizer
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = {}
+            for name, xmp in (("plain", None), ("pdfa", '<rdf:Description pdfaid:part="1" pdfaid:conformance="B"/>')):
+                paths[name] = os.path.join(tmp_dir, f"{name}.pdf")
+                with fitz.open() as doc:
+                    for _ in range(3):
+                        doc.new_page().insert_text((72, 72), "Invoice")
+                    if xmp:
+                        doc.set_xml_metadata(xmp)
+                    doc.save(paths[name])
+
+            with mock.patch.object(pdf_optimizer, "_linearize", side_effect=shutil.copyfile) as linearize:
+                for name, path in paths.items():
+                    pdf_optimizer._optimize_into(path, path + ".out", 150, 0, linearize=True)
+            with fitz.open(paths["pdfa"]) as doc:
+                self.assertEqual(pdf_optimizer.pdfa_part(doc), 1)
+            with open(paths["plain"] + ".out", "rb") as f:
+                self.assertIn(b"/ObjStm", f.read())
+            with open(paths["pdfa"] + ".out", "rb") as f:
+                self.assertNotIn(b"/ObjStm", f.read())
+            if pdf_optimizer.pikepdf is not None:
+                self.assertEqual(linearize.call_count, 1)
+
+    def test_admission_keeps_headroom_for_higher_lanes(self):
+        """Test that a bulk backlog is refused before it can block uploads and IMAP"""
+        from app.utils import admission, priority_lanes
+        from app.utils.priority_lanes import PRIORITY_INTERACTIVE, PRIORITY_IMAP, PRIORITY_BULK
+        fake = FakeRedis()
+        with mock.patch.object(priority_lanes, "redis_client", fake), \
+                mock.patch.object(admission, "redis_client", fake), \
+                mock.patch.multiple(admission.settings, admission_control_enabled=True,
+                                    admission_max_queue_depth=10, admission_max_outstanding_ocr=4,
+                                    admission_max_outstanding_llm=4, admission_bulk_share=0.5,
+                                    admission_retry_after_seconds=7):
+            fake.rpush("pdf:6", *range(5))  # bulk lane at its share of the budget
+            refusal = admission.check_admission(PRIORITY_BULK)
+            self.assertEqual((refusal["stage"], refusal["retry_after"]), ("pdf", 7))
+            self.assertIsNone(admission.check_admission(PRIORITY_IMAP))
+            self.assertIsNone(admission.check_admission(PRIORITY_INTERACTIVE))
+
+            fake.rpush("pdf:3", *range(10))  # IMAP backlog: counts for IMAP and bulk, not for uploads
+            self.assertEqual(admission.check_admission(PRIORITY_IMAP)["stage"], "pdf")
+            self.assertIsNone(admission.check_admission(PRIORITY_INTERACTIVE))
+            fake.delete("pdf:3", "pdf:6")
+
+            with admission.outstanding_call(admission.STAGE_OCR), admission.outstanding_call(admission.STAGE_OCR):
+                self.assertEqual(admission.check_admission(PRIORITY_BULK)["stage"], "ocr")
+                self.assertIsNone(admission.check_admission(PRIORITY_IMAP))
+            self.assertIsNone(admission.check_admission(PRIORITY_BULK))
+
+    def test_require_admission_answers_429_with_retry_after(self):
+        """Test that refused API calls get 429 and the suggested retry delay"""
+        from fastapi import HTTPException
+        from app.api.common import require_admission
+        from app.utils.priority_lanes import PRIORITY_INTERACTIVE
+        refusal = {"stage": "ocr", "reason": "4 Azure operations outstanding", "retry_after": 30}
+        with mock.patch("app.utils.admission.check_admission", return_value=refusal) as check:
+            with self.assertRaises(HTTPException) as raised:
+                require_admission()
+        check.assert_called_once_with(PRIORITY_INTERACTIVE)
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(raised.exception.headers, {"Retry-After": "30"})
+        with mock.patch("app.utils.admission.check_admission", return_value=None):
+            require_admission()
+
+    def test_ingest_backlog_defers_the_rest_when_refused(self):
+        """Test that a backlog enqueues files until refused and re-schedules the rest"""
+        from app.tasks import ingest_backlog as backlog
+        from app.utils.priority_lanes import PRIORITY_BULK
+        refusal = {"stage": "pdf", "reason": "busy", "retry_after": 30}
+        with mock.patch.object(backlog, "check_admission", side_effect=[None, None, refusal]) as check, \
+                mock.patch.object(backlog.process_document, "apply_async") as enqueue, \
+                mock.patch.object(backlog.ingest_backlog, "apply_async") as reschedule:
+            result = backlog.ingest_backlog(["a.pdf", "b.pdf", "c.pdf", "d.pdf"])
+        self.assertEqual(result, {"enqueued": 2, "deferred": 2})
+        check.assert_called_with(PRIORITY_BULK)
+        self.assertEqual([c.args[0] for c in enqueue.call_args_list], [("a.pdf",), ("b.pdf",)])
+        reschedule.assert_called_once_with((["c.pdf", "d.pdf"],), countdown=30, priority=PRIORITY_BULK)
+
+    def test_claim_ingestion_rejects_duplicates_until_released(self):
+        """Test that a claimed hash is a duplicate until it is released or has a FileRecord"""
+        from app.models import FileRecord
+        from app.utils import deduplication
+        Session = self._in_memory_db()
+        with Session() as db:
+            db.add(FileRecord(filehash="done", original_filename="a.pdf", local_filename="/w/tmp/a.pdf",
+                              file_size=1, mime_type="application/pdf"))
+            db.commit()
+        with mock.patch.object(deduplication, "SessionLocal", Session), \
+                mock.patch.object(deduplication, "redis_client", FakeRedis()):
+            self.assertIsNone(deduplication.claim_ingestion("new"))
+            self.assertEqual(deduplication.claim_ingestion("new"), {"status": "duplicate_in_flight", "file_id": None})
+            self.assertEqual(deduplication.claim_ingestion("done"), {"status": "duplicate_file", "file_id": 1})
+
+            deduplication.release_ingestion("new", None)
+            self.assertIsNone(deduplication.claim_ingestion("new"))
+
+    def test_reupload_of_failed_document_resumes_its_pipeline(self):
+        """Test that a re-upload of a document whose pipeline failed is resumed, not rejected"""
+        import contextvars
+        import importlib
+        from app.models import FileRecord, PipelineState
+        from app.utils import deduplication, pipeline_state
+        processing = importlib.import_module("app.tasks.process_document")
+        Session = self._in_memory_db()
+        with Session() as db:
+            for file_id, (filehash, status) in enumerate([("failed", "failed"), ("done", "completed")], start=1):
+                db.add(FileRecord(filehash=filehash, original_filename=f"{filehash}.pdf",
+                                  local_filename=f"/w/tmp/{filehash}.pdf", file_size=1, mime_type="application/pdf"))
+                db.add(PipelineState(file_id=file_id, state="text_extracted", status=status,
+                                     working_file=f"/w/tmp/{filehash}.pdf"))
+            db.commit()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(deduplication, "SessionLocal", Session), \
+                mock.patch.object(processing, "SessionLocal", Session), \
+                mock.patch.object(pipeline_state, "SessionLocal", Session), \
+                mock.patch.object(deduplication, "redis_client", FakeRedis()), \
+                mock.patch("app.tasks.resume_pipeline.resume_document", return_value={"resumed": True}) as resume:
+            self.assertEqual(deduplication.claim_ingestion("done"), {"status": "duplicate_file", "file_id": 2})
+            self.assertIsNone(deduplication.claim_ingestion("failed"))
+
+            upload = os.path.join(tmp_dir, "failed.pdf")
+            with open(upload, "wb") as f:
+                f.write(b"%PDF-1.4")
+            # In a context of its own, like in a worker, so the lease owner does not leak into other tests
+            result = contextvars.Context().run(processing.process_document, upload, filehash="failed", file_size=8)
+            self.assertEqual(result, {"resumed": True})
+        resume.assert_called_once_with(1, source_file=upload)
+
+    def test_failed_process_document_marks_the_pipeline_failed_and_frees_it(self):
+        """Test that a process_document that fails for good releases its lease and in-flight claims"""
+        from app.models import FileRecord
+        from app.utils import pipeline_state
+        Session = self._in_memory_db()
+        with Session() as db:
+            db.add(FileRecord(filehash="abc", original_filename="a.pdf", local_filename="/w/tmp/a.pdf",
+                              file_size=1, mime_type="application/pdf"))
+            db.commit()
+        sender = mock.Mock()
+        sender.name = pipeline_state.PROCESS_DOCUMENT_TASK
+        with mock.patch.object(pipeline_state, "SessionLocal", Session), \
+                mock.patch.object(pipeline_state, "log_task_progress"), \
+                mock.patch("app.utils.deduplication.release_ingestion") as release_ingestion, \
+                mock.patch("app.utils.deduplication.release_pipeline_lease") as release_lease:
+            pipeline_state._pipeline_step_failed(sender=sender, exception=RuntimeError("corrupt PDF"),
+                                                 args=["/w/a.pdf"], kwargs={"filehash": "abc", "source_hash": "src"})
+            state = pipeline_state.get_state(1)
+        self.assertEqual((state["status"], state["state"], state["last_error"]), ("failed", "staged", "corrupt PDF"))
+        release_ingestion.assert_called_once_with("abc", "src")
+        release_lease.assert_called_once_with("abc", result={"status": "Failed", "error": "corrupt PDF"})
+
+    def test_convert_to_pdf_hands_on_or_releases_the_source_hash(self):
+        """Test that the claimed hash of a converted file is released by the pipeline or on failure"""
+        from app.tasks import convert_to_pdf as conversion
+        with mock.patch.object(conversion, "_convert_with_gotenberg", return_value="/w/scan.pdf"), \
+                mock.patch.object(conversion, "enqueue") as enqueue, \
+                mock.patch.object(conversion, "release_ingestion") as release:
+            self.assertEqual(conversion.convert_to_pdf("/w/scan.png", source_hash="abc"), "/w/scan.pdf")
+        enqueue.assert_called_once_with(conversion.process_document, "/w/scan.pdf", source_hash="abc")
+        release.assert_not_called()
+
+        with mock.patch.object(conversion, "_convert_with_gotenberg", return_value=None), \
+                mock.patch.object(conversion, "enqueue") as enqueue, \
+                mock.patch.object(conversion, "release_ingestion") as release:
+            self.assertIsNone(conversion.convert_to_pdf("/w/scan.png", source_hash="abc"))
+        enqueue.assert_not_called()
+        release.assert_called_once_with("abc")
+
+    def test_pipeline_lease_is_released_by_its_owner_only(self):
+        """Test acquiring, attaching to and releasing the pipeline lease of a hash"""
+        import contextvars
+        from app.utils import deduplication
+
+        def release_lease(client, keys, args):
+            lease_key, result_key = keys
+            owner, result, ttl = args
+            if client.get(lease_key) != owner:
+                return 0
+            if result:
+                client.set(result_key, result, ex=ttl)
+            return client.delete(lease_key)
+
+        def refresh_lease(client, keys, args):
+            return client.expire(keys[0], args[1]) if client.get(keys[0]) == args[0] else 0
+
+        fake = FakeRedis({deduplication.RELEASE_LEASE_SCRIPT: release_lease,
+                          deduplication.REFRESH_LEASE_SCRIPT: refresh_lease})
+        with mock.patch.object(deduplication, "redis_client", fake):
+            def first_pipeline():
+                self.assertIsNone(deduplication.acquire_pipeline_lease("abc", "task-1"))
+                self.assertEqual(deduplication.current_lease_owner(), "task-1")
+                # A retry of the same task keeps its lease, another arrival attaches to it
+                self.assertIsNone(deduplication.acquire_pipeline_lease("abc", "task-1"))
+                self.assertEqual(contextvars.Context().run(deduplication.acquire_pipeline_lease, "abc", "task-2"),
+                                 "task-1")
+
+            contextvars.Context().run(first_pipeline)
+            # Checkpoints keep the lease alive, but only for its owner
+            self.assertTrue(deduplication.refresh_pipeline_lease("abc", owner="task-1"))
+            self.assertFalse(deduplication.refresh_pipeline_lease("abc", owner="task-2"))
+            # Neither a task of another pipeline nor one without an owner token can release it
+            self.assertFalse(deduplication.release_pipeline_lease("abc", owner="task-2"))
+            self.assertFalse(contextvars.Context().run(deduplication.release_pipeline_lease, "abc"))
+            self.assertEqual(fake.get(deduplication.PIPELINE_LEASE_PREFIX + "abc"), "task-1")
+
+            self.assertTrue(deduplication.release_pipeline_lease("abc", result={"status": "Queued"}, owner="task-1"))
+            self.assertIsNone(fake.get(deduplication.PIPELINE_LEASE_PREFIX + "abc"))
+            self.assertEqual(deduplication.get_pipeline_result("abc"), {"status": "Queued"})
+
+            # The owner token travels in the headers of the messages the pipeline publishes
+            headers = {}
+            contextvars.Context().run(lambda: (deduplication.acquire_pipeline_lease("def", "task-3"),
+                                               deduplication._stamp_lease_owner(headers=headers)))
+            self.assertEqual(headers, {deduplication.LEASE_OWNER_HEADER: "task-3"})
+
+    def test_azure_collector_keeps_operations_until_finished(self):
+        """Test that handed-over OCR operations stay claimed until finish_azure_ocr ends"""
+        import json
+        from app.tasks import collect_azure_ocr_results as collector
+
+        def hand_over(client, keys, args):
+            if not client.hdel(keys[0], args[0]):
+                return 0
+            return client.hset(keys[1], args[0], args[1]) or 1
+
+        def unlock(client, keys, args):
+            return client.delete(keys[0]) if client.get(keys[0]) == args[0] else 0
+
+        fake = FakeRedis({collector.HANDOVER_SCRIPT: hand_over, collector.UNLOCK_SCRIPT: unlock})
+        with mock.patch.object(collector, "redis_client", fake), \
+                mock.patch.object(collector, "find_filehash_by_local_filename", return_value=None), \
+                mock.patch.object(collector, "get_analysis_status", return_value=("succeeded", None, None)), \
+                mock.patch.object(collector.finish_azure_ocr, "apply_async") as apply_async:
+            collector.register_pending_ocr("op-1", "https://azure/op-1", "a.pdf")
+            self.assertEqual(collector.collect_azure_ocr_results(), {"finished": 1, "failed": 0, "running": 0})
+            self.assertEqual(fake.hgetall(collector.PENDING_KEY), {})
+            self.assertEqual(list(fake.hgetall(collector.PROCESSING_KEY)), ["op-1"])
+            self.assertIsNone(fake.get(collector.SWEEP_LOCK_KEY))
+            apply_async.assert_called_once()
+
+            # A handover that did not end in time is dispatched again, a failed finish is dropped
+            context = json.loads(fake.hgetall(collector.PROCESSING_KEY)["op-1"])
+            context["handed_over_at"] -= collector.HANDOVER_TIMEOUT_SECONDS
+            fake.hset(collector.PROCESSING_KEY, "op-1", json.dumps(context))
+            collector.collect_azure_ocr_results()
+            self.assertEqual(apply_async.call_count, 2)
+            collector._finish_failed(sender=collector.finish_azure_ocr, args=("op-1", "{}"))
+            self.assertEqual(fake.hgetall(collector.PROCESSING_KEY), {})
+
+            # A sweep whose lock expired does not release the lock of the next one
+            with mock.patch.object(collector.uuid, "uuid4", return_value=mock.Mock(hex="mine")), \
+                    mock.patch.object(fake, "hgetall", side_effect=lambda key: fake.set(collector.SWEEP_LOCK_KEY, "next") and {}):
+                collector.collect_azure_ocr_results()
+            self.assertEqual(fake.get(collector.SWEEP_LOCK_KEY), "next")
+
+    def test_pdf_work_of_ocr_runs_on_the_pdf_queue(self):
+        """Test that shards are split and partial OCR results spliced by tasks on the CPU queue"""
+        import importlib
+        import fitz
+        from app.celery_app import celery
+        from app.tasks import ocr_shards
+        # The package exports the task under the module's name
+        azure = importlib.import_module("app.tasks.process_with_azure_document_intelligence")
+        router = celery.amqp.router
+        for task in (ocr_shards.split_ocr_shards, ocr_shards.merge_ocr_shards, azure.splice_ocr_result):
+            self.assertEqual(router.route({}, task.name)["queue"].name, "pdf")
+        for task in (ocr_shards.ocr_pdf_shard, azure.process_with_azure_document_intelligence):
+            self.assertEqual(router.route({}, task.name)["queue"].name, "ocr")
+
+        with tempfile.TemporaryDirectory() as workdir:
+            tmp_dir = os.path.join(workdir, "tmp")
+            os.makedirs(tmp_dir)
+            with fitz.open() as doc:
+                for _ in range(5):
+                    doc.new_page()
+                doc.save(os.path.join(tmp_dir, "doc.pdf"))
+
+            with mock.patch.object(ocr_shards.settings, "workdir", workdir), \
+                    mock.patch.object(ocr_shards, "chord") as chord:
+                ocr_shards.split_ocr_shards("doc.pdf", [[0, 2], [2, 4], [4, 5]])
+            self.assertEqual(len(chord.call_args.args[0]), 3)
+            page_counts = []
+            for shard_index in range(3):
+                with fitz.open(os.path.join(tmp_dir, ocr_shards.shard_filename("doc.pdf", shard_index))) as shard:
+                    page_counts.append(shard.page_count)
+            self.assertEqual(page_counts, [2, 2, 1])
+
+        with mock.patch.object(azure, "enqueue_next") as enqueue_next, \
+                mock.patch.object(azure, "splice_partial_ocr") as splice:
+            self.assertEqual(azure.continue_after_ocr("doc_ocr.pdf", "text", ["b"], {0: 90}, splice_into="doc.pdf",
+                                                      ocr_pages=[1], page_texts=["a", ""]), "doc.pdf")
+        splice.assert_not_called()
+        enqueue_next.assert_called_once_with(azure.splice_ocr_result, "doc_ocr.pdf", "doc.pdf", [1], ["a", ""],
+                                             ["b"], {0: 90})
+
+    def test_metadata_extraction_checkpoints_text_references_as_they_are(self):
+        """Test that the pdf_ready checkpoint keeps a text reference, in fused runs as well"""
+        import importlib
+        from app.tasks.pipeline import fused_pipeline
+        gpt = importlib.import_module("app.tasks.extract_metadata_with_gpt")
+        ref = "blob://" + "a" * 64 + ".zst"
+        with mock.patch.object(gpt, "get_text", return_value="text"), \
+                mock.patch.object(gpt, "put_text", wraps=gpt.put_text) as put_text, \
+                mock.patch.object(gpt, "get_cached", return_value={"metadata": {"title": "x"}}), \
+                mock.patch.object(gpt, "enqueue_next"), \
+                mock.patch.object(gpt, "checkpoint") as checkpoint:
+            for fused in (False, True):
+                checkpoint.reset_mock()
+                with fused_pipeline(fused):
+                    gpt.extract_metadata_with_gpt("doc.pdf", ref)
+                self.assertEqual([call.args[1] for call in checkpoint.call_args_list],
+                                 [gpt.STATE_PDF_READY, gpt.STATE_METADATA_EXTRACTED])
+                self.assertEqual(checkpoint.call_args_list[0].kwargs["text_ref"], ref)
+        put_text.assert_called_with(ref, force=True)
+
+    def test_azure_result_polled_by_the_collector_is_not_fetched_again(self):
+        """Test that finish_azure_ocr uses the analysis result the sweep already downloaded"""
+        from azure.ai.documentintelligence.models import AnalyzeResult
+        from app.tasks import collect_azure_ocr_results as collector
+
+        def hand_over(client, keys, args):
+            return client.hset(keys[1], args[0], args[1]) if client.hdel(keys[0], args[0]) else 0
+
+        result = AnalyzeResult({"modelId": "prebuilt-read", "content": "Invoice", "pages": []})
+        fake = FakeRedis({collector.HANDOVER_SCRIPT: hand_over, collector.UNLOCK_SCRIPT: lambda *args: 1})
+        with tempfile.TemporaryDirectory() as workdir, \
+                mock.patch.object(blob_store.settings, "workdir", workdir), \
+                mock.patch.object(collector, "redis_client", fake), \
+                mock.patch.object(collector, "find_filehash_by_local_filename", return_value=None), \
+                mock.patch.object(collector, "get_analysis_status", return_value=("succeeded", result, None)) as poll, \
+                mock.patch.object(collector.finish_azure_ocr, "apply_async") as apply_async, \
+                mock.patch.object(collector, "record_azure_pages"), \
+                mock.patch.object(collector, "check_page_rotation", return_value={}), \
+                mock.patch.object(collector, "download_searchable_pdf") as download, \
+                mock.patch.object(collector, "continue_after_ocr", return_value="a.pdf") as continue_after_ocr:
+            collector.register_pending_ocr("op-1", "https://azure/op-1", "a.pdf")
+            collector.collect_azure_ocr_results()
+            collector.finish_azure_ocr(*apply_async.call_args.args[0])
+        poll.assert_called_once()
+        self.assertEqual(download.call_args.args[0].content, "Invoice")
+        self.assertEqual(continue_after_ocr.call_args.args[1], "Invoice")
+        self.assertEqual(fake.hgetall(collector.PROCESSING_KEY), {})
+
+    def test_resume_after_rotation_does_not_turn_pages_again(self):
+        """Test that a pipeline that failed after turning its pages resumes past the rotation"""
+        import importlib
+        import fitz
+        from app.models import FileRecord
+        from app.utils import pipeline_state
+        rotation = importlib.import_module("app.tasks.rotate_pdf_pages")
+        resume = importlib.import_module("app.tasks.resume_pipeline")
+        Session = self._in_memory_db()
+        with tempfile.TemporaryDirectory() as workdir:
+            os.makedirs(os.path.join(workdir, "tmp"))
+            path = os.path.join(workdir, "tmp", "doc.pdf")
+            with fitz.open() as doc:
+                doc.new_page()
+                doc.save(path)
+            with Session() as db:
+                db.add(FileRecord(filehash="abc", original_filename="doc.pdf", local_filename=path,
+                                  file_size=1, mime_type="application/pdf"))
+                db.commit()
+
+            with mock.patch.object(pipeline_state.settings, "workdir", workdir), \
+                    mock.patch.object(rotation.settings, "pdf_rotation_with_metadata", False), \
+                    mock.patch.object(pipeline_state, "SessionLocal", Session), \
+                    mock.patch.object(resume, "SessionLocal", Session), \
+                    mock.patch.object(pipeline_state, "log_task_progress"), \
+                    mock.patch.object(rotation, "enqueue_next"), \
+                    mock.patch.object(resume, "enqueue") as enqueue:
+                pipeline_state.checkpoint(path, pipeline_state.STATE_TEXT_EXTRACTED,
+                                          text_ref=blob_store.put_text("text", force=True), rotation_data={0: 270})
+                self.assertEqual(rotation.rotate_pdf_pages("doc.pdf", "text", {0: 270})["status"], "rotated")
+                pipeline_state.mark_failed(path, "worker lost")
+                resume.resume_document(1)
+
+            with fitz.open(path) as doc:
+                self.assertEqual(doc[0].rotation, 90)
+        from app.tasks.extract_metadata_with_gpt import extract_metadata_with_gpt
+        self.assertEqual(enqueue.call_args.args[0], extract_metadata_with_gpt)
+
+    def test_stream_upload_hashes_while_writing_and_aborts_past_the_limit(self):
+        """Test that uploads are hashed while streamed and rejected with 413 once too large"""
+        import asyncio
+        import hashlib
+        from fastapi import HTTPException
+        from app.api import files
+
+        class ChunkedUpload:
+            def __init__(self, data):
+                self.data, self.reads = data, 0
+
+            async def read(self, size):
+                chunk, self.data = self.data[:size], self.data[size:]
+                self.reads += 1
+                return chunk
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(files, "UPLOAD_CHUNK_SIZE", 4):
+            target = os.path.join(tmp_dir, "upload.pdf")
+            data = b"%PDF-1.4 small"
+            self.assertEqual(asyncio.run(files._stream_upload_to_disk(ChunkedUpload(data), target, 100)),
+                             (hashlib.sha256(data).hexdigest(), len(data)))
+            with open(target, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+            upload = ChunkedUpload(b"x" * 40)
+            with self.assertRaises(HTTPException) as raised:
+                asyncio.run(files._stream_upload_to_disk(upload, target, 10))
+            self.assertEqual(raised.exception.status_code, 413)
+            self.assertEqual(upload.reads, 3)  # stopped at the chunk that crossed the limit
+            self.assertFalse(os.path.exists(target))
+
+    def test_ocr_shards_merge_in_page_order_with_document_page_indices(self):
+        """Test that shard results are merged in page order and rotations refer to document pages"""
+        import fitz
+        from app.tasks import ocr_shards
+        with tempfile.TemporaryDirectory() as workdir:
+            tmp_dir = os.path.join(workdir, "tmp")
+            os.makedirs(tmp_dir)
+            with mock.patch.object(ocr_shards.settings, "workdir", workdir), \
+                    mock.patch.object(ocr_shards, "analyze_document",
+                                      return_value=(mock.Mock(content="c", pages=[]), "op")), \
+                    mock.patch.object(ocr_shards, "download_searchable_pdf"), \
+                    mock.patch.object(ocr_shards, "page_texts_from_result", return_value=["p3", "p4"]), \
+                    mock.patch.object(ocr_shards, "check_page_rotation", return_value={"1": 90}):
+                self.assertEqual(ocr_shards.ocr_pdf_shard("doc.pdf", 1, 2, 4)["rotation_data"], {3: 90})
+
+            shard_results = []
+            for shard_index, (start, stop) in enumerate(ocr_shards.shard_page_ranges(5, 2)):
+                path = os.path.join(tmp_dir, ocr_shards.shard_filename("doc.pdf", shard_index))
+                with fitz.open() as doc:
+                    for page in range(start, stop):
+                        doc.new_page().insert_text((72, 72), f"Page {page}")
+                    doc.save(path)
+                shard_results.append({
+                    "shard_index": shard_index, "start_page": start, "path": path,
+                    "content": f"shard {shard_index}", "page_texts": [f"Page {p}" for p in range(start, stop)],
+                    "rotation_data": {str(start): 90 * shard_index},
+                })
+
+            with mock.patch.object(ocr_shards.settings, "workdir", workdir), \
+                    mock.patch.object(ocr_shards, "store_ocr_result") as store, \
+                    mock.patch.object(ocr_shards, "continue_after_ocr", return_value="doc.pdf") as continue_after_ocr:
+                result = ocr_shards.merge_ocr_shards(list(reversed(shard_results)), "doc.pdf", cache_key="key")
+
+            self.assertEqual(result["shards"], 3)
+            with fitz.open(os.path.join(tmp_dir, "doc.pdf")) as doc:
+                self.assertEqual([page.get_text().strip() for page in doc], [f"Page {p}" for p in range(5)])
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["doc.pdf"])
+        _, content, page_texts, rotation_data = continue_after_ocr.call_args.args
+        self.assertEqual(content, "shard 0\nshard 1\nshard 2")
+        self.assertEqual(page_texts, [f"Page {p}" for p in range(5)])
+        self.assertEqual(rotation_data, {0: 0, 2: 90, 4: 180})
+        store.assert_called_once()
+
+    def test_result_policies_keep_only_read_results_and_report_their_memory(self):
+        """Test that intermediate results are ignored, TTLs applied and stored results reported per task"""
+        import types
+        import redis
+        from app.utils import result_backend
+        app = types.SimpleNamespace(conf=types.SimpleNamespace())
+        with mock.patch.object(result_backend.settings, "celery_result_compression", "zlib"), \
+                mock.patch.object(result_backend.settings, "celery_ignore_intermediate_results", True):
+            result_backend.configure_result_policies(app)
+        self.assertEqual(app.conf.result_expires, result_backend.settings.celery_result_expires_seconds)
+        self.assertEqual(app.conf.result_compression, "zlib")
+        self.assertEqual(set(app.conf.task_annotations), set(result_backend.INTERMEDIATE_TASKS))
+        self.assertNotIn("app.tasks.process_document.process_document", app.conf.task_annotations)
+
+        client = FakeRedis()
+
+        def task(name, ignore_result=False):
+            backend = mock.Mock(client=client)
+            backend.get_key_for_task.side_effect = lambda task_id: result_backend.RESULT_KEY_PREFIX + task_id
+            stub = mock.Mock(backend=backend, ignore_result=ignore_result)
+            stub.name = name  # name= would only name the mock
+            return stub
+
+        shard, upload = "app.tasks.ocr_shards.ocr_pdf_shard", "app.tasks.upload_to_s3.upload_to_s3"
+        client.set(result_backend.RESULT_KEY_PREFIX + "a", "x" * 10)
+        client.set(result_backend.RESULT_KEY_PREFIX + "b", "x" * 30)
+        client.set(result_backend.RESULT_KEY_PREFIX + "c", "x" * 5)
+        with mock.patch.object(client, "expire", wraps=client.expire) as expire:
+            result_backend._apply_result_ttl(task_id="a", task=task(shard))
+            result_backend._apply_result_ttl(task_id="b", task=task(upload))
+            result_backend._apply_result_ttl(task_id="d", task=task(shard, ignore_result=True))
+        expire.assert_called_once_with(result_backend.RESULT_KEY_PREFIX + "a",
+                                       result_backend.settings.celery_shard_result_expires_seconds)
+        self.assertEqual(client.get(result_backend.TASK_NAME_KEY_PREFIX + "b"), upload)
+        self.assertIsNone(client.get(result_backend.TASK_NAME_KEY_PREFIX + "d"))
+
+        with mock.patch.object(client, "pipeline", side_effect=redis.ConnectionError("down")), \
+                self.assertLogs(result_backend.logger, "WARNING"):
+            result_backend._apply_result_ttl(task_id="e", task=task(upload))
+
+        with mock.patch("app.celery_app.celery", mock.Mock(backend=mock.Mock(client=client))):
+            report = result_backend.result_backend_report(batch_size=2)
+        self.assertEqual(report["keys"], 3)
+        self.assertEqual(report["bytes"], 45)
+        self.assertEqual(list(report["tasks"]), [upload, shard, "unknown"])
+        self.assertEqual(report["tasks"][shard], {"count": 1, "bytes": 10})
+
+    def test_metrics_time_tasks_count_usage_and_report_queue_gauges(self):
+        """Test that task timings, usage counters and the scraped pipeline gauges end up in /metrics"""
+        import types
+        import redis
+        from fastapi import HTTPException
+        from prometheus_client import REGISTRY
+        from app import main
+        from app.utils import deduplication, metrics
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        upload = mock.Mock()
+        upload.name = "app.tasks.upload_to_dropbox.upload_to_dropbox"
+        before = (sample("docuelevate_task_duration_seconds_count", task="upload_to_dropbox", status="success"),
+                  sample("docuelevate_upload_duration_seconds_count", destination="dropbox", status="failure"))
+        metrics._start_timer(task_id="t1")
+        metrics._stop_timer(task_id="t1", task=upload, state="SUCCESS")
+        metrics._stop_timer(task_id="t1", task=upload, state="SUCCESS")  # no start time left: not counted
+        metrics.observe_step(upload.name, 2.0, "failure")
+        self.assertEqual(sample("docuelevate_task_duration_seconds_count", task="upload_to_dropbox", status="success"),
+                         before[0] + 1)
+        self.assertEqual(sample("docuelevate_upload_duration_seconds_count", destination="dropbox", status="failure"),
+                         before[1] + 1)
+
+        pages = sample("docuelevate_azure_ocr_pages_total")
+        tokens = sample("docuelevate_openai_tokens_total", model="gpt-test", step="refine", kind="completion")
+        saved = sample("docuelevate_pdf_optimize_bytes_total", kind="before")
+        metrics.record_azure_pages(mock.Mock(pages=[1, 2, 3]))
+        metrics.record_azure_pages(mock.Mock(pages=None))
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=20)
+        metrics.record_openai_usage("refine", types.SimpleNamespace(model="gpt-test", usage=usage))
+        metrics.record_openai_usage("refine", types.SimpleNamespace(model="gpt-test", usage=None))
+        metrics.record_pdf_optimization(1000, 400)
+        self.assertEqual(sample("docuelevate_azure_ocr_pages_total"), pages + 3)
+        self.assertEqual(sample("docuelevate_openai_tokens_total", model="gpt-test", step="refine", kind="completion"),
+                         tokens + 20)
+        self.assertEqual(sample("docuelevate_pdf_optimize_bytes_total", kind="before"), saved + 1000)
+
+        client = FakeRedis()
+        client.set(deduplication.PIPELINE_LEASE_PREFIX + "abc", "owner")
+        report = {"queues": {"ocr": {"imap": 2, "bulk": 5}}}
+        with mock.patch("app.utils.priority_lanes.lane_report", return_value=report), \
+                mock.patch("app.utils.admission.outstanding_calls", return_value=4), \
+                mock.patch("app.utils.deduplication.redis_client", client), \
+                mock.patch.object(metrics, "_api_registry", None):
+            body = main.metrics().body.decode()
+        self.assertIn('docuelevate_queue_depth{lane="bulk",queue="ocr"} 5.0', body)
+        self.assertIn('docuelevate_outstanding_calls{stage="ocr"} 4.0', body)
+        self.assertIn("docuelevate_documents_in_flight 1.0", body)
+        self.assertIn("docuelevate_azure_ocr_pages_total", body)
+
+        # Redis being down leaves the gauges empty instead of failing the scrape
+        with mock.patch("app.utils.priority_lanes.lane_report", side_effect=redis.ConnectionError("down")), \
+                self.assertLogs(metrics.logger, "WARNING"):
+            families = {family.name: family for family in metrics.PipelineCollector().collect()}
+        self.assertEqual(families["docuelevate_queue_depth"].samples, [])
+
+        with mock.patch.object(main.settings, "metrics_enabled", False), self.assertRaises(HTTPException) as raised:
+            main.metrics()
+        self.assertEqual(raised.exception.status_code, 404)
+
+    def test_document_trace_follows_the_pipeline_through_task_headers(self):
+        """Test that tasks join the trace of their document and failures mark their spans"""
+        import types
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        from opentelemetry.trace import StatusCode
+        from app.utils import tracing
+
+        with tracing.document_trace("upload") as trace_id, tracing.span("pdf.split") as current:
+            self.assertIsNone(trace_id)  # Disabled: nothing configured
+            self.assertIsNone(current)
+
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+        def run(task_name, headers, task_id, state):
+            task = mock.Mock(request=types.SimpleNamespace(headers=headers))
+            task.name = task_name
+            tracing._start_task_span(task_id=task_id, task=task, args=("doc.pdf",))
+            published = {}
+            tracing._inject_trace_context(headers=published)
+            tracing._end_task_span(task_id=task_id, state=state)
+            return published
+
+        with mock.patch.object(tracing, "_tracer", provider.get_tracer("test")):
+            with tracing.document_trace("upload", filename="doc.pdf", size=None) as trace_id:
+                headers = {}
+                tracing._inject_trace_context(headers=headers)
+            self.assertIn(tracing.TRACE_HEADER, headers)
+            headers = run("app.tasks.process_document.process_document", headers, "t1", "SUCCESS")
+            run("app.tasks.rotate_pdf_pages.rotate_pdf_pages", headers, "t2", "FAILURE")
+            with self.assertRaises(ValueError), tracing.span("azure.analyze", pages=3):
+                raise ValueError("quota")
+
+        spans = {finished.name: finished for finished in exporter.get_finished_spans()}
+        root, first, second = spans["ingest.upload"], spans["task.process_document"], spans["task.rotate_pdf_pages"]
+        self.assertEqual(dict(root.attributes), {"filename": "doc.pdf"})
+        self.assertEqual({format(s.context.trace_id, "032x") for s in (root, first, second)}, {trace_id})
+        self.assertEqual(first.parent.span_id, root.context.span_id)
+        self.assertEqual(second.parent.span_id, first.context.span_id)
+        self.assertEqual(first.attributes["document.file"], "doc.pdf")
+        self.assertEqual(first.attributes["celery.state"], "SUCCESS")
+        self.assertNotEqual(first.status.status_code, StatusCode.ERROR)
+        self.assertEqual(second.status.status_code, StatusCode.ERROR)
+        self.assertEqual(spans["azure.analyze"].status.status_code, StatusCode.ERROR)
+        self.assertIsNone(spans["azure.analyze"].parent)  # The task spans have ended and detached
+        self.assertEqual(tracing._task_spans, {})
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()